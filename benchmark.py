@@ -0,0 +1,483 @@
+"""
+Generador de carga y medición de latencia para servidor.py
+Simula muchos clientes TCP o UDP que hablan el protocolo de comun y mide
+throughput, latencia de difusión (p50/p99/p999) y CPU/RSS del servidor
+
+Uso:
+    python benchmark.py TCP --clientes 1000 --duracion 10 --lanzar
+    python benchmark.py UDP --lanzar --servidor-args="--engine asyncio"
+    python benchmark.py UDP --lanzar --confiable
+    python benchmark.py TCP --lanzar --tamano 2000 --compresion
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import time
+import comun
+
+# Prefijo del contenido de los mensajes de prueba:
+# "bench <emisor> <secuencia> <t_envio_ns> <relleno>"
+PREFIJO = "bench"
+
+# --- CLIENTE SIMULADO ---
+
+class Cliente:
+    """
+    Estado de un cliente simulado.
+
+    Las latencias se guardan en la lista compartida del benchmark para
+    calcular percentiles al final.
+    """
+
+    def __init__(self, nombre, formato, latencias):
+        self.nombre = nombre
+        self.formato = formato
+        self.latencias = latencias
+        self.registrado = asyncio.get_running_loop().create_future()
+        self.enviados = 0
+        self.recibidos = 0
+        self.bytes_recibidos = 0
+        self.errores = 0
+        self.canal = None  # comun.CanalConfiable en UDP con --confiable
+        self.comprimir = False  # El servidor aceptó la compresión
+
+    def recibir(self, datos):
+        """Procesa un mensaje (o lote comprimido) recibido del servidor."""
+        self.bytes_recibidos += len(datos)
+        for mensaje in comun.expandir(datos):
+            self.procesar(mensaje)
+
+    def procesar(self, datos):
+        msg = comun.desempaquetar_mensaje(datos)
+        if not msg:
+            self.errores += 1
+            return
+
+        tipo = msg.get('tipo')
+        if tipo in ("SISTEMA", "ERROR") and not self.registrado.done():
+            self.comprimir = msg.get('compresion') == comun.COMPRESION_ZLIB
+            self.registrado.set_result(tipo == "SISTEMA")
+            return
+        if tipo == "ERROR":
+            self.errores += 1
+            return
+
+        partes = msg.get('contenido', '').split(' ', 4)
+        if tipo in ("PUBLICO", "PRIVADO") and partes[0] == PREFIJO:
+            self.recibidos += 1
+            self.latencias.append((time.perf_counter_ns() - int(partes[3])) / 1e6)
+
+    def mensaje(self, destinos, privados, relleno):
+        """
+        Crea el próximo mensaje de prueba (público o privado).
+
+        Returns:
+            bytes: Mensaje serializado (comprimido si se negoció)
+        """
+        contenido = f"{PREFIJO} {self.nombre} {self.enviados} {time.perf_counter_ns()} {relleno}"
+        self.enviados += 1
+        tipo, destino = "PUBLICO", None
+        if privados and random.random() < privados:
+            destino = random.choice(destinos)
+            if destino != self.nombre:
+                tipo = "PRIVADO"
+            else:
+                destino = None
+        datos = comun.empaquetar_mensaje(tipo, self.nombre, contenido, destino, self.formato)
+        return comun.comprimir(datos) if self.comprimir else datos
+
+class ProtocoloUDPCliente(asyncio.DatagramProtocol):
+    """
+    Recibe los datagramas de un cliente UDP simulado; con "canal"
+    (comun.CanalConfiable) usa la capa confiable y responde con un ack
+    por vuelta del bucle de eventos, como el servidor. Los mensajes
+    fragmentados (--tamano grande) se rearman antes de procesarlos.
+    """
+
+    def __init__(self, cliente, canal=None):
+        self.cliente = cliente
+        self.canal = canal
+        self.transporte = None
+        self.ack_programado = False
+        self.reensamblador = comun.Reensamblador()
+
+    def connection_made(self, transporte):
+        self.transporte = transporte
+
+    def datagram_received(self, datos, addr):
+        tipo = comun.tipo_paquete(datos) if self.canal is not None else None
+        if tipo == comun.PAQUETE_ACK:
+            for paquete in self.canal.procesar_ack(datos, time.monotonic()):
+                self.transporte.sendto(paquete)
+        elif tipo == comun.PAQUETE_DATOS:
+            mensajes = self.canal.recibir_datos(datos)
+            if not self.ack_programado:
+                self.ack_programado = True
+                asyncio.get_running_loop().call_soon(self.enviar_ack)
+            for mensaje in self.reensamblador.rearmar(mensajes, addr):
+                self.cliente.recibir(mensaje)
+        else:
+            for mensaje in self.reensamblador.rearmar([datos], addr):
+                self.cliente.recibir(mensaje)
+
+    def enviar_ack(self):
+        self.ack_programado = False
+        self.transporte.sendto(self.canal.ack())
+
+    def error_received(self, exc):
+        self.cliente.errores += 1
+
+async def conectar_tcp(cliente, host, puerto):
+    """
+    Conecta y registra un cliente TCP.
+
+    Returns:
+        function: enviar(datos)
+    """
+    reader, writer = await asyncio.open_connection(host, puerto)
+
+    async def leer():
+        decodificador = comun.DecodificadorTramas()
+        while True:
+            fragmento = await reader.read(comun.TAM_LECTURA_TCP)
+            if not fragmento:
+                break
+            for datos in decodificador.alimentar(fragmento):
+                cliente.recibir(datos)
+        if not cliente.registrado.done():
+            cliente.registrado.set_result(False)
+
+    cliente.lector = asyncio.get_running_loop().create_task(leer())
+    cliente.cerrar = writer.close
+
+    def enviar(datos):
+        writer.write(comun.enmarcar(datos))
+
+    return enviar
+
+async def conectar_udp(cliente, host, puerto, confiable=False):
+    """
+    Crea el socket de un cliente UDP.
+
+    Args:
+        confiable: Usar la capa confiable de comun (acks y reenvíos)
+
+    Returns:
+        function: enviar(datos)
+    """
+    loop = asyncio.get_running_loop()
+    canal = comun.CanalConfiable() if confiable else None
+    transporte, _ = await loop.create_datagram_endpoint(
+        lambda: ProtocoloUDPCliente(cliente, canal), remote_addr=(host, puerto))
+    if canal is None:
+        cliente.cerrar = transporte.close
+
+        def enviar_simple(datos):
+            for parte in comun.fragmentar(datos):
+                transporte.sendto(parte)
+
+        return enviar_simple
+
+    async def reenviar():
+        while True:
+            await asyncio.sleep(comun.RTO_MIN)
+            for paquete in canal.vencidos(time.monotonic()):
+                transporte.sendto(paquete)
+
+    tarea = loop.create_task(reenviar())
+
+    def enviar(datos):
+        ahora = time.monotonic()
+        for parte in comun.fragmentar(datos):
+            paquete = canal.envolver(parte, ahora)
+            if paquete is not None:
+                transporte.sendto(paquete)
+
+    def cerrar():
+        tarea.cancel()
+        transporte.close()
+
+    cliente.canal = canal
+    cliente.cerrar = cerrar
+    return enviar
+
+async def simular_cliente(cliente, enviar, args, destinos, fin):
+    """Envía mensajes a la tasa configurada hasta el instante fin."""
+    relleno = "x" * args.tamano
+    intervalo = 1.0 / args.tasa
+    # Desfase aleatorio para que los clientes no envíen todos a la vez
+    await asyncio.sleep(random.random() * intervalo)
+    proximo = time.perf_counter()
+    while proximo < fin:
+        enviar(cliente.mensaje(destinos, args.privados, relleno))
+        proximo += intervalo
+        await asyncio.sleep(max(0.0, proximo - time.perf_counter()))
+
+# --- MEDICIÓN DEL SERVIDOR ---
+
+def procesos_del_servidor(pid):
+    """
+    Returns:
+        list: pid del servidor y de sus hijos directos (modo --workers)
+    """
+    pids = [pid]
+    for entrada in os.listdir("/proc"):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entrada}/stat") as f:
+                campos = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(campos[1]) == pid:
+            pids.append(int(entrada))
+    return pids
+
+def uso_servidor(pid):
+    """
+    Lee CPU acumulada y memoria residente del servidor en /proc (Linux).
+
+    Returns:
+        dict: cpu_s y rss_mb, o None si no se puede medir
+    """
+    if pid is None or not os.path.isdir("/proc"):
+        return None
+
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = 0.0
+    rss = 0
+    for p in procesos_del_servidor(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                campos = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(campos[11]) + int(campos[12])) / ticks
+            with open(f"/proc/{p}/status") as f:
+                for linea in f:
+                    if linea.startswith("VmRSS:"):
+                        rss += int(linea.split()[1])
+        except OSError:
+            continue
+    return {"cpu_s": cpu, "rss_mb": rss / 1024}
+
+def percentiles(valores):
+    """
+    Returns:
+        dict: p50, p99, p999, promedio y máximo (ms), o {} si no hay valores
+    """
+    if not valores:
+        return {}
+    ordenados = sorted(valores)
+    n = len(ordenados)
+
+    def p(q):
+        return ordenados[min(n - 1, int(q * n))]
+
+    return {
+        "p50_ms": p(0.50),
+        "p99_ms": p(0.99),
+        "p999_ms": p(0.999),
+        "promedio_ms": sum(ordenados) / n,
+        "max_ms": ordenados[-1],
+    }
+
+# --- EJECUCIÓN ---
+
+def lanzar_servidor(args):
+    """
+    Inicia servidor.py con capacidad suficiente para los clientes simulados
+    y, salvo --con-limites, sin límites de tráfico por usuario: con los de
+    fábrica la carga mediría los rechazos en lugar del servidor.
+
+    Returns:
+        subprocess.Popen: Proceso del servidor
+    """
+    comando = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "servidor.py"),
+               args.protocolo, "--puerto", str(args.puerto),
+               "--max-clientes", str(args.clientes + 1)]
+    if not args.con_limites:
+        comando += ["--limite-mensajes", "0", "--limite-bytes", "0"]
+    comando += shlex.split(args.servidor_args)
+    proceso = subprocess.Popen(comando, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    time.sleep(args.espera_servidor)
+    if proceso.poll() is not None:
+        raise RuntimeError(f"El servidor terminó al iniciar (código {proceso.returncode})")
+    return proceso
+
+async def ejecutar(args, pid_servidor):
+    """
+    Conecta los clientes, genera la carga y junta los resultados.
+
+    Returns:
+        dict: Resultados del benchmark
+    """
+    latencias = []
+    nombres = [f"bench{i}" for i in range(args.clientes)]
+    if args.protocolo == "TCP":
+        conectar = conectar_tcp
+    else:
+        conectar = functools.partial(conectar_udp, confiable=args.confiable)
+
+    # Registro por tandas para no saturar el backlog del servidor
+    clientes = []
+    envios = []
+    inicio_registro = time.perf_counter()
+    for i in range(0, args.clientes, args.tanda):
+        tanda = [Cliente(n, args.formato, latencias) for n in nombres[i:i + args.tanda]]
+        for cliente in tanda:
+            enviar = await conectar(cliente, args.host, args.puerto)
+            registro = comun.crear_mensaje("REGISTRO", cliente.nombre, "")
+            if args.compresion:
+                registro['compresion'] = comun.COMPRESION_ZLIB
+            enviar(comun.serializar_mensaje(registro, cliente.formato))
+            envios.append(enviar)
+        resultados = await asyncio.wait_for(
+            asyncio.gather(*(c.registrado for c in tanda)), args.espera_servidor + 10)
+        if not all(resultados):
+            raise RuntimeError("El servidor rechazó algún registro (¿capacidad o nombres en uso?)")
+        clientes += tanda
+    tiempo_registro = time.perf_counter() - inicio_registro
+
+    # Carga
+    uso_inicial = uso_servidor(pid_servidor)
+    latencias.clear()
+    inicio = time.perf_counter()
+    fin = inicio + args.duracion
+    await asyncio.gather(*(simular_cliente(c, e, args, nombres, fin)
+                           for c, e in zip(clientes, envios)))
+    # Dar tiempo a que lleguen las difusiones pendientes
+    await asyncio.sleep(args.drenaje)
+    transcurrido = time.perf_counter() - inicio
+    uso_final = uso_servidor(pid_servidor)
+
+    for cliente in clientes:
+        cliente.cerrar()
+    retransmitidos = sum(c.canal.retransmitidos for c in clientes if c.canal is not None)
+
+    enviados = sum(c.enviados for c in clientes)
+    recibidos = sum(c.recibidos for c in clientes)
+    servidor = None
+    if uso_inicial and uso_final:
+        cpu = uso_final["cpu_s"] - uso_inicial["cpu_s"]
+        servidor = {
+            "cpu_s": cpu,
+            "cpu_porcentaje": 100 * cpu / transcurrido,
+            "rss_mb": uso_final["rss_mb"],
+        }
+
+    return {
+        "registro_s": tiempo_registro,
+        "mensajes_enviados": enviados,
+        "mensajes_por_s": enviados / args.duracion,
+        "entregas": recibidos,
+        "entregas_por_s": recibidos / transcurrido,
+        "bytes_recibidos": sum(c.bytes_recibidos for c in clientes),
+        "errores": sum(c.errores for c in clientes),
+        "retransmitidos_clientes": retransmitidos,
+        "latencia": percentiles(latencias),
+        "servidor": servidor,
+    }
+
+def mostrar_resultados(resultados):
+    """Imprime un resumen legible."""
+    print("=" * 50)
+    print(f"Mensajes enviados: {resultados['mensajes_enviados']} "
+          f"({resultados['mensajes_por_s']:.0f}/s)")
+    print(f"Entregas: {resultados['entregas']} ({resultados['entregas_por_s']:.0f}/s)")
+    print(f"Bytes recibidos: {resultados['bytes_recibidos']}")
+    print(f"Errores: {resultados['errores']}")
+    latencia = resultados['latencia']
+    if latencia:
+        print(f"Latencia ms: p50={latencia['p50_ms']:.2f} p99={latencia['p99_ms']:.2f} "
+              f"p999={latencia['p999_ms']:.2f} max={latencia['max_ms']:.2f}")
+    servidor = resultados['servidor']
+    if servidor:
+        print(f"Servidor: CPU {servidor['cpu_porcentaje']:.0f}% RSS {servidor['rss_mb']:.1f} MB")
+    print("=" * 50)
+
+def subir_limite_descriptores():
+    """Sube el límite de sockets abiertos al máximo permitido (Unix)."""
+    try:
+        import resource
+        _, maximo = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (maximo, maximo))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga del servidor de chat")
+    parser.add_argument("protocolo", nargs="?", default="TCP", type=str.upper,
+                        choices=["TCP", "UDP"], help="Protocolo de transporte")
+    parser.add_argument("--host", default="127.0.0.1", help="Host del servidor")
+    parser.add_argument("--puerto", type=int, default=comun.PORT, help="Puerto del servidor")
+    parser.add_argument("--clientes", type=int, default=100, help="Clientes simulados")
+    parser.add_argument("--duracion", type=float, default=10.0, help="Segundos de carga")
+    parser.add_argument("--tasa", type=float, default=1.0,
+                        help="Mensajes por segundo de cada cliente")
+    parser.add_argument("--privados", type=float, default=0.0,
+                        help="Fracción de mensajes privados (0 a 1)")
+    parser.add_argument("--tamano", type=int, default=32, help="Bytes de relleno por mensaje")
+    parser.add_argument("--formato", default=comun.FORMATO_PREFERIDO,
+                        choices=[comun.FORMATO_JSON, comun.FORMATO_BINARIO],
+                        help="Formato de los mensajes de los clientes")
+    parser.add_argument("--confiable", action="store_true",
+                        help="UDP con la capa confiable de comun (acks y reenvíos)")
+    parser.add_argument("--compresion", action="store_true",
+                        help="Pedir compresión en el REGISTRO (ver comun.comprimir)")
+    parser.add_argument("--tanda", type=int, default=100,
+                        help="Clientes que se registran a la vez")
+    parser.add_argument("--drenaje", type=float, default=1.0,
+                        help="Segundos de espera tras la carga")
+    parser.add_argument("--lanzar", action="store_true",
+                        help="Iniciar servidor.py en lugar de usar uno existente")
+    parser.add_argument("--con-limites", action="store_true",
+                        help="Mantener los límites de tráfico del servidor (con --lanzar)")
+    parser.add_argument("--servidor-args", default="",
+                        help="Argumentos extra para servidor.py (con --lanzar)")
+    parser.add_argument("--espera-servidor", type=float, default=1.0,
+                        help="Segundos de espera tras lanzar el servidor")
+    parser.add_argument("--pid", type=int, help="pid de un servidor ya iniciado (para CPU/RSS)")
+    parser.add_argument("--salida", help="Archivo JSON donde guardar los resultados")
+    args = parser.parse_args()
+
+    if args.tasa <= 0 or args.clientes < 1 or not 0 <= args.privados <= 1:
+        parser.error("--tasa y --clientes deben ser positivos y --privados estar entre 0 y 1")
+
+    subir_limite_descriptores()
+    proceso = lanzar_servidor(args) if args.lanzar else None
+    pid_servidor = proceso.pid if proceso else args.pid
+    if proceso:
+        print(f"Servidor lanzado {'con' if args.con_limites else 'sin'} límites de tráfico por usuario")
+
+    try:
+        resultados = asyncio.run(ejecutar(args, pid_servidor))
+    finally:
+        if proceso:
+            proceso.terminate()
+            proceso.wait()
+
+    configuracion = vars(args).copy()
+    configuracion.pop("salida")
+    informe = {
+        "fecha": time.strftime(comun.FORMATO_FECHA),
+        "python": platform.python_version(),
+        "sistema": platform.platform(),
+        "configuracion": configuracion,
+        "resultados": resultados,
+    }
+
+    mostrar_resultados(resultados)
+    if args.salida:
+        with open(args.salida, "w", encoding=comun.CODIFICACION) as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Bitácora (log) asíncrona del servidor de chat
+Las líneas se guardan en un buffer circular acotado y un hilo las escribe
+por lotes, así escribir el log nunca frena el envío de mensajes
+"""
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import comun
+
+# --- NIVELES ---
+DEPURACION = 10
+INFO = 20
+AVISO = 30
+ERROR = 40
+
+NOMBRES_NIVEL = {DEPURACION: "depuracion", INFO: "info", AVISO: "aviso", ERROR: "error"}
+NIVELES = {nombre: nivel for nivel, nombre in NOMBRES_NIVEL.items()}
+
+# --- FORMATOS ---
+FORMATO_TEXTO = "texto"  # Solo el texto, como los print() de antes (lo lee gui.py)
+FORMATO_JSON = "json"    # Una línea JSON por entrada, con fecha, nivel y campos
+
+MAX_PENDIENTES = 10000  # Líneas en el buffer; si se llena se pierden las más viejas
+INTERVALO_ESCRITURA = 0.05  # Segundos máximos que una línea espera en el buffer
+
+class Bitacora:
+    """
+    Log con escritura en segundo plano.
+
+    registrar() solo agrega la entrada al buffer y avisa al hilo escritor,
+    que junta todo lo pendiente en una sola escritura y un solo flush.
+    """
+
+    def __init__(self, destino=None, nivel=INFO, formato=FORMATO_TEXTO,
+                 max_pendientes=MAX_PENDIENTES):
+        self.destino = destino
+        self.nivel = nivel
+        self.formato = formato
+        self.pendientes = collections.deque(maxlen=max_pendientes)
+        self.descartadas = 0
+        self._iniciar_hilo()
+
+    def _iniciar_hilo(self):
+        self.condicion = threading.Condition()
+        self.lock_escritura = threading.Lock()  # Mantiene el orden de los lotes
+        self.hilo = threading.Thread(target=self._escribir, daemon=True)
+        self.hilo.start()
+
+    def registrar(self, nivel, texto, **campos):
+        """
+        Agrega una entrada al log si su nivel está habilitado.
+
+        Args:
+            nivel: DEPURACION, INFO, AVISO o ERROR
+            texto: Mensaje legible
+            **campos: Datos adicionales (solo aparecen en formato JSON)
+        """
+        if nivel < self.nivel:
+            return
+        with self.condicion:
+            if len(self.pendientes) == self.pendientes.maxlen:
+                self.descartadas += 1
+            self.pendientes.append((time.time(), nivel, texto, campos))
+            if len(self.pendientes) == 1:
+                self.condicion.notify()
+
+    def _formatear(self, fecha, nivel, texto, campos):
+        if self.formato == FORMATO_JSON:
+            entrada = {
+                "fecha": time.strftime(comun.FORMATO_FECHA, time.localtime(fecha)),
+                "nivel": NOMBRES_NIVEL.get(nivel, str(nivel)),
+                "mensaje": texto.strip(),
+            }
+            entrada.update(campos)
+            return json.dumps(entrada, ensure_ascii=False, default=str)
+        return texto
+
+    def _volcar(self, lote):
+        if not lote:
+            return
+        destino = self.destino or sys.stdout
+        try:
+            destino.write("\n".join(self._formatear(*entrada) for entrada in lote) + "\n")
+            destino.flush()
+        except (OSError, ValueError):
+            pass  # Salida cerrada (por ejemplo, la GUI terminó)
+
+    def _escribir(self):
+        """Hilo escritor: espera entradas y las escribe por lotes."""
+        while True:
+            with self.condicion:
+                while not self.pendientes:
+                    self.condicion.wait()
+                # Dejar que se acumulen más entradas antes de escribir
+                self.condicion.wait(INTERVALO_ESCRITURA)
+            self.vaciar()
+
+    def vaciar(self):
+        """Escribe ya todo lo pendiente (al salir o antes de un fork)."""
+        with self.lock_escritura:
+            with self.condicion:
+                lote = list(self.pendientes)
+                self.pendientes.clear()
+            self._volcar(lote)
+
+    def cerrar(self):
+        """
+        Escribe lo pendiente al terminar, avisando cuántas líneas se
+        perdieron por buffer lleno (para que no pase desapercibido).
+        """
+        self.vaciar()
+        if self.descartadas:
+            texto = f"[!] Se descartaron {self.descartadas} líneas del log por buffer lleno"
+            self._volcar([(time.time(), AVISO, texto, {"descartadas": self.descartadas})])
+
+    def _despues_de_fork(self):
+        # El hilo escritor no sobrevive al fork: el hijo crea el suyo
+        self.pendientes.clear()
+        self.descartadas = 0
+        self._iniciar_hilo()
+
+# Bitácora del proceso
+bitacora = Bitacora()
+atexit.register(bitacora.cerrar)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=bitacora.vaciar, after_in_child=bitacora._despues_de_fork)
+
+def configurar(nivel=None, formato=None):
+    """
+    Cambia el nivel mínimo ("depuracion", "info", "aviso", "error") y/o el
+    formato (FORMATO_TEXTO o FORMATO_JSON) de la bitácora del proceso.
+
+    Raises:
+        ValueError: Si el nivel o el formato no existen
+    """
+    if nivel is not None:
+        if nivel not in NIVELES:
+            raise ValueError(f"Nivel de log inválido: {nivel}")
+        bitacora.nivel = NIVELES[nivel]
+    if formato is not None:
+        if formato not in (FORMATO_TEXTO, FORMATO_JSON):
+            raise ValueError(f"Formato de log inválido: {formato}")
+        bitacora.formato = formato
+
+def registrar(nivel, texto, **campos):
+    """Agrega una entrada a la bitácora del proceso."""
+    bitacora.registrar(nivel, texto, **campos)
+
+def vaciar():
+    """Escribe lo pendiente de la bitácora del proceso."""
+    bitacora.vaciar()
+
+def cerrar():
+    """Vacía la bitácora del proceso al terminar (ver Bitacora.cerrar)."""
+    bitacora.cerrar()
@@ -2,12 +2,42 @@
 Cliente de consola para chat TCP/UDP
 """
 
-import socket
 import threading
+import collections
 import sys
+import time
 import comun
 
-def recibir_mensajes(sock, es_tcp, nombre, host, puerto):
+# En TCP el hilo de latidos y el principal escriben en el mismo socket
+lock_envio = threading.Lock()
+
+# Se activa cuando el servidor acepta la compresión en la bienvenida
+comprimir_envios = False
+
+def enviar_paquete(sock, es_tcp, enlace, paquete):
+    """Envía un mensaje al servidor por TCP (enmarcado) o por el enlace UDP."""
+    if comprimir_envios:
+        paquete = comun.comprimir(paquete)
+    if es_tcp:
+        with lock_envio:
+            sock.sendall(comun.enmarcar(paquete))
+    else:
+        enlace.enviar(paquete)
+
+def enviar_latidos(sock, es_tcp, nombre, enlace):
+    """
+    Hilo que envía un LATIDO cada comun.INTERVALO_LATIDO segundos, para que
+    el servidor no dé de baja al cliente mientras solo lee.
+    """
+    latido = comun.empaquetar_mensaje("LATIDO", nombre, "", formato=comun.FORMATO_PREFERIDO)
+    while True:
+        time.sleep(comun.INTERVALO_LATIDO)
+        try:
+            enviar_paquete(sock, es_tcp, enlace, latido)
+        except OSError:
+            return  # Conexión cerrada
+
+def recibir_mensajes(sock, es_tcp, nombre, enlace=None):
     """
     Hilo para recibir mensajes del servidor.
     
@@ -15,29 +45,38 @@ def recibir_mensajes(sock, es_tcp, nombre, host, puerto):
         sock: Socket conectado
         es_tcp: True para TCP, False para UDP
         nombre: Nombre del usuario
-        host: Host del servidor (para UDP)
-        puerto: Puerto del servidor (para UDP)
+        enlace: comun.EnlaceUDP hacia el servidor (para UDP)
     """
+    global comprimir_envios
+    # TCP: los mensajes llegan enmarcados y se reconstruyen incrementalmente
+    tramas = comun.leer_tramas(sock) if es_tcp else None
+    # La capa confiable (UDP) o un lote comprimido pueden traer varios
+    # mensajes juntos
+    pendientes = collections.deque()
+    
     while True:
         try:
-            if es_tcp:
+            if pendientes:
+                datos = pendientes.popleft()
+            elif es_tcp:
                 # TCP: recv bloqueante
-                datos = sock.recv(comun.BUFSIZE)
-                if not datos:
+                datos = next(tramas, None)
+                if datos is None:
                     print("\n[!] Conexión cerrada por el servidor.")
                     break
+                pendientes.extend(comun.expandir(datos))
+                continue
             else:
-                # UDP: recvfrom con timeout para salir del bucle
-                sock.settimeout(1.0)  # Timeout de 1 segundo
+                # UDP: espera de 1 segundo como máximo (el enlace también
+                # hace los reenvíos de la capa confiable)
                 try:
-                    datos, _ = sock.recvfrom(comun.BUFSIZE)
-                except socket.timeout:
-                    continue  # Timeout, volver a intentar
+                    recibidos = enlace.recibir(1.0)
                 except (ConnectionResetError, OSError):
                     print("\n[!] Error de conexión UDP.")
                     break
-                finally:
-                    sock.settimeout(None)  # Restaurar
+                for datos in recibidos:
+                    pendientes.extend(comun.expandir(datos))
+                continue  # Si fue timeout, volver a intentar
             
             # Procesar mensaje recibido
             msg = comun.desempaquetar_mensaje(datos)
@@ -66,11 +105,17 @@ def recibir_mensajes(sock, es_tcp, nombre, host, puerto):
                     # Mensaje privado recibido
                     print(f"\n[{hora}] (Privado de {usuario}): {contenido}")
             
-            elif tipo == "SISTEMA":
-                print(f"\n[SISTEMA] {contenido}")
+            elif tipo in ("SISTEMA", "SALAS", "HISTORIAL"):
+                if msg.get('compresion') == comun.COMPRESION_ZLIB:
+                    comprimir_envios = True
+                print(f"\n[{tipo}] {contenido}")
             
             else:  # PUBLICO o cualquier otro
-                print(f"\n[{hora}] {usuario}: {contenido}")
+                sala = msg.get('destino')
+                if sala and sala != comun.SALA_GENERAL:
+                    print(f"\n[{hora}] #{sala} {usuario}: {contenido}")
+                else:
+                    print(f"\n[{hora}] {usuario}: {contenido}")
             
             # Mostrar prompt nuevamente
             sys.stdout.write("> ")
@@ -153,13 +198,15 @@ def iniciar_cliente():
     if not sock:
         return
     
+    enlace = None if es_tcp else comun.EnlaceUDP(sock, (host, puerto))
+    
     # Enviar registro al servidor
-    registro = comun.empaquetar_mensaje("REGISTRO", nombre, "Conectándose...")
+    registro = comun.crear_mensaje("REGISTRO", nombre, "Conectándose...")
+    if comun.COMPRESION:
+        registro['compresion'] = comun.COMPRESION_ZLIB
+    registro = comun.serializar_mensaje(registro, comun.FORMATO_PREFERIDO)
     try:
-        if es_tcp:
-            sock.send(registro)
-        else:
-            sock.sendto(registro, (host, puerto))
+        enviar_paquete(sock, es_tcp, enlace, registro)
         print("[+] Registro enviado al servidor...")
     except Exception as e:
         print(f"[ERROR] Error al registrar usuario: {e}")
@@ -168,12 +215,12 @@ def iniciar_cliente():
     
     # Iniciar hilo para recibir mensajes
     hilo_recibir = threading.Thread(target=recibir_mensajes, 
-                                   args=(sock, es_tcp, nombre, host, puerto))
+                                   args=(sock, es_tcp, nombre, enlace))
     hilo_recibir.daemon = True
     hilo_recibir.start()
+    threading.Thread(target=enviar_latidos, args=(sock, es_tcp, nombre, enlace), daemon=True).start()
     
     # Esperar breve momento para recibir confirmación
-    import time
     time.sleep(0.5)
     
     # Mostrar información y comandos
@@ -182,13 +229,20 @@ def iniciar_cliente():
     print("=" * 40)
     print("\nComandos disponibles:")
     print("  /p usuario mensaje  - Enviar mensaje privado")
+    print("  /unirse sala        - Unirse a una sala y escribir en ella")
+    print("  /dejar sala         - Salir de una sala")
+    print("  /salas              - Listar salas")
+    print("  /historial [N]      - Últimos N mensajes de la sala actual")
     print("  /salir              - Salir del chat")
     print("  /ayuda              - Mostrar esta ayuda")
     print("  /usuarios           - Listar usuarios conectados")
-    print("  texto normal        - Mensaje público a todos")
+    print("  texto normal        - Mensaje público a la sala actual")
     print("-" * 40)
     print("\nEscribe tu primer mensaje:")
     
+    # Sala a la que van los mensajes públicos
+    sala_actual = comun.SALA_GENERAL
+    
     # Bucle principal para enviar mensajes
     try:
         while True:
@@ -211,6 +265,10 @@ def iniciar_cliente():
                 if texto.lower() == "/ayuda":
                     print("\nComandos disponibles:")
                     print("  /p usuario mensaje  - Mensaje privado")
+                    print("  /unirse sala        - Unirse a una sala")
+                    print("  /dejar sala         - Salir de una sala")
+                    print("  /salas              - Listar salas")
+                    print("  /historial [N]      - Últimos mensajes de la sala")
                     print("  /salir              - Salir")
                     print("  /ayuda              - Mostrar ayuda")
                     print("  /usuarios           - Listar usuarios")
@@ -223,10 +281,32 @@ def iniciar_cliente():
                 
                 # Determinar tipo de mensaje
                 tipo = "PUBLICO"
-                destino = None
+                destino = None if sala_actual == comun.SALA_GENERAL else sala_actual
                 contenido = texto
                 
-                if texto.startswith("/p "):
+                if texto.lower() == "/salas":
+                    tipo = "SALAS"
+                    destino = None
+                elif texto.lower() == "/historial" or texto.lower().startswith("/historial "):
+                    tipo = "HISTORIAL"
+                    contenido = texto[len("/historial"):].strip()
+                    if contenido and not contenido.isdigit():
+                        print("[ERROR] Formato incorrecto. Usa: /historial [N]")
+                        continue
+                elif texto.startswith(("/unirse ", "/dejar ")):
+                    comando, _, sala = texto.partition(" ")
+                    sala = sala.strip()
+                    if not sala:
+                        print(f"[ERROR] Formato incorrecto. Usa: {comando} sala")
+                        continue
+                    tipo = "UNIRSE" if comando == "/unirse" else "SALIR"
+                    destino = sala
+                    contenido = ""
+                    if tipo == "UNIRSE":
+                        sala_actual = sala
+                    elif sala == sala_actual:
+                        sala_actual = comun.SALA_GENERAL
+                elif texto.startswith("/p "):
                     partes = texto.split(" ", 2)
                     if len(partes) >= 3:
                         tipo = "PRIVADO"
@@ -239,16 +319,15 @@ def iniciar_cliente():
                 else:
                     # Mensaje público - mostrar inmediatamente en consola
                     hora_actual = time.strftime("%H:%M")
-                    print(f"[{hora_actual}] {nombre}: {contenido}")
+                    prefijo = f"#{destino} " if destino else ""
+                    print(f"[{hora_actual}] {prefijo}{nombre}: {contenido}")
                 
                 # Empacar y enviar mensaje
-                paquete = comun.empaquetar_mensaje(tipo, nombre, contenido, destino)
+                paquete = comun.empaquetar_mensaje(tipo, nombre, contenido, destino,
+                                                   formato=comun.FORMATO_PREFERIDO)
                 
                 try:
-                    if es_tcp:
-                        sock.send(paquete)
-                    else:
-                        sock.sendto(paquete, (host, puerto))
+                    enviar_paquete(sock, es_tcp, enlace, paquete)
                 except Exception as e:
                     print(f"[ERROR] Error al enviar mensaje: {e}")
                     
@@ -5,51 +5,1415 @@ Funciones compartidas por servidor y cliente
 
 import socket
 import json
+import os
+import configparser
+import itertools
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 
 # --- CONFIGURACIÓN GLOBAL PARA AMBOS PROTOCOLOS ---
 HOST = '0.0.0.0'  # Escuchar en todas las interfaces
 PORT = 5000
 BUFSIZE = 4096  # Aumentado para mensajes largos
+TAM_LECTURA_TCP = 65536  # Bytes por recv() en TCP (puede traer varios mensajes)
+MAX_TRAMA = 1024 * 1024  # Tamaño máximo de un mensaje TCP enmarcado
 MAX_CLIENTES = 5
+BACKLOG = 1024  # Conexiones pendientes en listen() para el motor asyncio
 CODIFICACION = 'utf-8'
 
-def empaquetar_mensaje(tipo, usuario, contenido, destino=None):
+# --- COLAS DE SALIDA POR CLIENTE (servidor) ---
+DESBORDE_DESCARTAR = "descartar"      # Se descarta la trama más antigua
+DESBORDE_DESCONECTAR = "desconectar"  # Se desconecta al cliente lento
+MAX_COLA_MENSAJES = 1000              # Tramas pendientes por cliente
+MAX_COLA_BYTES = 1024 * 1024          # Bytes pendientes por cliente
+POLITICA_DESBORDE = DESBORDE_DESCARTAR
+VENTANA_ESCRITURA = 0.0               # Segundos que un escritor TCP espera para juntar más tramas; 0 = solo lo ya encolado
+LOTE_ESCRITURA = 256                  # Tramas máximas por escritura al socket (sendmsg; menos que IOV_MAX)
+
+# --- INACTIVIDAD DE LOS CLIENTES ---
+INTERVALO_LATIDO = 30.0         # Segundos entre LATIDO de los clientes de este proyecto
+TIEMPO_INACTIVIDAD = 120.0      # Segundos sin mensajes para dar de baja a un cliente; 0 = nunca
+RESOLUCION_INACTIVIDAD = 1.0    # Ancho de cada ranura de la rueda (ver sesiones.RuedaInactividad)
+ESPERA_CORTE = 5.0              # Segundos para enviar lo pendiente a un cliente dado de baja (asyncio)
+
+# --- CACHÉ DE MENSAJES DEL SERVIDOR ---
+MAX_CACHE_MENSAJES = 256  # Mensajes serializados que se conservan (LRU)
+
+# --- MENSAJES RECIENTES POR SALA (servidor) ---
+RECIENTES_POR_SALA = 50     # Tramas que recibe quien entra a una sala; 0 = desactivado
+MAX_SALAS_RECIENTES = 256  # Salas con buffer de recientes (LRU)
+
+# --- E/S UDP EN LOTES (servidor) ---
+LOTE_UDP = 64  # Datagramas que se leen por despertar del socket
+
+# --- UDP CONFIABLE (ver CanalConfiable) ---
+UDP_CONFIABLE = True    # Los clientes de este proyecto usan la capa confiable
+VENTANA_UDP = 256       # Datagramas sin confirmar por canal
+RTO_INICIAL = 0.25      # Segundos antes del primer reenvío, hasta medir el RTT
+RTO_MIN = 0.05          # Piso del RTO: evita reenvíos por demoras normales de la red
+RTO_MAX = 2.0
+MAX_REINTENTOS = 8      # Reenvíos antes de dar un datagrama por perdido
+MAX_CANALES_UDP = 4096  # Direcciones con canal en el servidor (LRU)
+
+# --- FRAGMENTACIÓN UDP (ver fragmentar y Reensamblador) ---
+MTU_UDP = 1500                          # MTU del camino: ningún datagrama la supera (sin fragmentación IP)
+CABECERAS_IP_UDP = 48                   # IPv6 (40) + UDP (8), lo que la MTU no deja para datos
+MAX_MENSAJE_UDP = 256 * 1024            # Mensaje más grande que se rearma
+TIEMPO_REENSAMBLE = 5.0                 # Segundos para recibir todos los fragmentos de un mensaje
+MAX_REENSAMBLE_BYTES = 8 * 1024 * 1024  # Bytes en rearmado entre todos los orígenes
+MAX_REENSAMBLE_ORIGEN = 2 * MAX_MENSAJE_UDP  # Bytes en rearmado por origen
+TAM_DATAGRAMA_MAX = 65535               # Buffer de lectura de los clientes
+
+# --- COMPRESIÓN (ver comprimir) ---
+COMPRESION = True         # Pedir (clientes) o aceptar (servidor) compresión en el REGISTRO
+UMBRAL_COMPRESION = 256   # Bytes desde los que se comprime un mensaje o un lote
+NIVEL_COMPRESION = 6      # Nivel de zlib (1 = rápido, 9 = más chico); se fija al importar
+
+# --- LÍMITES DE TRÁFICO (servidor, ver limites.py) ---
+# Por segundo; 0 = sin límite. Los de IP vienen desactivados: detrás de
+# un NAT (o en un benchmark local) muchos usuarios comparten la IP.
+LIMITE_MENSAJES = 20            # Mensajes por segundo de cada usuario
+LIMITE_BYTES = 256 * 1024       # Bytes por segundo de cada usuario
+LIMITE_MENSAJES_IP = 0          # Mensajes por segundo de cada IP de origen
+LIMITE_BYTES_IP = 0             # Bytes por segundo de cada IP de origen
+RAFAGA_LIMITE = 2.0             # Segundos de tráfico que se pueden juntar en una ráfaga
+
+# --- MÉTRICAS (servidor) ---
+METRICAS_HOST = '127.0.0.1'  # Solo accesible desde la máquina local
+METRICAS_PUERTO = 0          # Puerto HTTP de /metrics; 0 = desactivado
+
+# --- BITÁCORA DEL SERVIDOR (ver bitacora.py) ---
+LOG_NIVEL = "info"     # depuracion, info, aviso o error
+LOG_FORMATO = "texto"  # texto o json (una línea JSON por entrada)
+LOG_CONTENIDO = False  # Registrar el texto de los mensajes de los usuarios
+
+# --- HISTORIAL DE MENSAJES (servidor, ver historial.py) ---
+HISTORIAL_DIR = ""                     # Directorio del historial; vacío = desactivado
+HISTORIAL_SEGMENTO = 8 * 1024 * 1024   # Bytes por archivo de segmento
+HISTORIAL_SEGMENTOS = 16               # Segmentos que se conservan (los más viejos se borran)
+MAX_HISTORIAL = 200                    # Mensajes por respuesta a un HISTORIAL
+
+# --- FORMATOS DE MENSAJE ---
+# JSON: legible y compatible con clientes anteriores (empieza con "{").
+# Binario: empieza con VERSION_BINARIA; ver _codificar_binario.
+# Cada cliente elige el formato con el que envía su REGISTRO y el servidor
+# le responde en ese mismo formato.
+FORMATO_JSON = "json"
+FORMATO_BINARIO = "binario"
+FORMATO_PREFERIDO = FORMATO_BINARIO  # Formato que usan los clientes de este proyecto
+VERSION_BINARIA = 0x01
+
+# Tipos con etiqueta de 1 byte; la etiqueta 0 indica tipo escrito como texto.
+# Los tipos nuevos se agregan al final para no cambiar las etiquetas.
+TIPOS_BINARIOS = ("PUBLICO", "PRIVADO", "REGISTRO", "ERROR", "SISTEMA",
+                  "UNIRSE", "SALIR", "SALAS", "HISTORIAL", "LATIDO")
+_ETIQUETA_POR_TIPO = {tipo: i + 1 for i, tipo in enumerate(TIPOS_BINARIOS)}
+CAMPOS_BASE = ("tipo", "usuario", "contenido", "destino", "fecha")
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+
+# --- SALAS ---
+# Un mensaje PUBLICO va a la sala indicada en "destino" (la general si no
+# tiene). UNIRSE y SALIR llevan la sala en "destino"; SALAS pide la lista
+# de salas y el servidor responde con otro SALAS.
+SALA_GENERAL = "general"
+TIPOS_SALA = ("UNIRSE", "SALIR", "SALAS")
+MAX_NOMBRE_SALA = 30
+
+# --- HISTORIAL ---
+# Un HISTORIAL del cliente pide mensajes de la sala "destino": los últimos
+# N (N en "contenido"), o desde un cursor (campo "desde") o una fecha
+# (campo "desde_fecha"); "autor" filtra por usuario. El servidor reenvía
+# los mensajes guardados y termina con un HISTORIAL que trae en "cursor"
+# el número desde el que pedir los siguientes.
+
+# --- LATIDO ---
+# Los clientes de este proyecto envían un LATIDO (sin contenido) cada
+# INTERVALO_LATIDO segundos. El servidor no responde: cualquier mensaje
+# cuenta como actividad, y a quien pasa TIEMPO_INACTIVIDAD sin enviar nada
+# lo da de baja (en UDP es la única forma de saber que un cliente se fue).
+
+# Banderas del formato binario
+_BANDERA_DESTINO = 0x01
+_BANDERA_EXTRA = 0x02
+
+def empaquetar_mensaje(tipo, usuario, contenido, destino=None, formato=FORMATO_JSON):
     """
     Crea un diccionario con la estructura del mensaje y lo convierte a bytes.
     
     Args:
-        tipo: "PUBLICO", "PRIVADO", "REGISTRO", "ERROR", "SISTEMA"
+        tipo: "PUBLICO", "PRIVADO", "REGISTRO", "ERROR", "SISTEMA",
+              "UNIRSE", "SALIR", "SALAS", "HISTORIAL", "LATIDO"
         usuario: Nombre del usuario que envía
         contenido: Texto del mensaje
-        destino: Para mensajes privados, usuario destino
+        destino: Usuario destino (PRIVADO) o sala (PUBLICO, UNIRSE, SALIR, HISTORIAL)
+        formato: FORMATO_JSON o FORMATO_BINARIO
     
     Returns:
-        bytes: Mensaje serializado en JSON
+        bytes: Mensaje serializado
     """
-    msg = {
+    if formato == FORMATO_BINARIO:
+        # Sin strftime: el binario lleva la hora como milisegundos
+        return _codificar_binario(tipo, usuario, contenido, destino,
+                                  int(time.time() * 1000), None)
+    
+    return json.dumps(crear_mensaje(tipo, usuario, contenido, destino)).encode(CODIFICACION)
+
+def crear_mensaje(tipo, usuario, contenido, destino=None):
+    """
+    Crea el diccionario de un mensaje con la fecha actual, sin serializarlo.
+    
+    Returns:
+        dict: Mensaje listo para serializar_mensaje
+    """
+    return {
         "tipo": tipo,
         "usuario": usuario,
         "contenido": contenido,
         "destino": destino,
-        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        "fecha": datetime.now().strftime(FORMATO_FECHA)
     }
+
+def serializar_mensaje(msg, formato=FORMATO_JSON):
+    """
+    Serializa un mensaje ya construido (por ejemplo, uno recibido) sin
+    cambiar su fecha.
+    
+    Args:
+        msg: Diccionario del mensaje
+        formato: FORMATO_JSON o FORMATO_BINARIO
+    
+    Returns:
+        bytes: Mensaje serializado
+    """
+    if formato == FORMATO_BINARIO:
+        extra = {k: v for k, v in msg.items() if k not in CAMPOS_BASE}
+        return _codificar_binario(msg.get('tipo'), msg.get('usuario'), msg.get('contenido'),
+                                  msg.get('destino'), _fecha_a_ms(msg.get('fecha')), extra)
     return json.dumps(msg).encode(CODIFICACION)
 
 def desempaquetar_mensaje(datos):
     """
     Convierte bytes a diccionario.
     
+    Acepta ambos formatos: el primer byte indica cuál es. Un mensaje
+    comprimido se descomprime antes (los lotes se separan con expandir()).
+    
     Args:
         datos: Bytes recibidos del socket
     
     Returns:
-        dict: Mensaje deserializado o None si hay error
+        dict: Mensaje deserializado o None si hay error (también si no es
+        un objeto o algún campo base no es texto)
     """
     try:
-        return json.loads(datos.decode(CODIFICACION))
-    except (json.JSONDecodeError, UnicodeDecodeError):
+        if datos[0] == MARCA_COMPRIMIDO:
+            datos = descomprimir(datos)
+        if datos[0] == VERSION_BINARIA:
+            # El decodificador binario ya deja los campos base como texto
+            return _decodificar_binario(datos)
+        msg = json.loads(str(datos, CODIFICACION))
+    except (ValueError, IndexError, TypeError, UnicodeDecodeError):
         return None
+    return msg if _campos_validos(msg) else None
+
+def _campos_validos(msg):
+    """
+    Indica si un mensaje recibido se puede reenviar en cualquier formato:
+    debe ser un objeto y sus campos base, texto o ausentes (un cliente
+    JSON podría mandar "contenido": 5, que el codec binario no acepta).
+    """
+    if not isinstance(msg, dict):
+        return False
+    for campo in CAMPOS_BASE:
+        valor = msg.get(campo)
+        if valor is not None and not isinstance(valor, str):
+            return False
+    return True
+
+def formato_de(datos):
+    """
+    Indica en qué formato viene un mensaje serializado.
+    
+    Returns:
+        str: FORMATO_BINARIO o FORMATO_JSON
+    """
+    return FORMATO_BINARIO if datos[:1] == _PREFIJO_BINARIO else FORMATO_JSON
+
+# --- CODEC BINARIO ---
+# [versión][etiqueta tipo][banderas][tipo texto si etiqueta=0][ms varint]
+# [usuario][contenido][destino si bandera][extra JSON si bandera]
+# Cada texto va como longitud varint + bytes UTF-8.
+_PREFIJO_BINARIO = bytes([VERSION_BINARIA])
+
+def _escribir_varint(buffer, valor):
+    """Agrega un entero sin signo en formato varint (LEB128)."""
+    while valor >= 0x80:
+        buffer.append((valor & 0x7F) | 0x80)
+        valor >>= 7
+    buffer.append(valor)
+
+def _leer_varint(datos, pos):
+    """
+    Returns:
+        tuple: (valor, nueva posición)
+    """
+    valor = 0
+    desplazamiento = 0
+    while True:
+        byte = datos[pos]
+        pos += 1
+        valor |= (byte & 0x7F) << desplazamiento
+        if byte < 0x80:
+            return valor, pos
+        desplazamiento += 7
+        if desplazamiento > 63:
+            raise ValueError("Varint demasiado largo")
+
+def _escribir_texto(buffer, texto):
+    codificado = (texto or "").encode(CODIFICACION)
+    _escribir_varint(buffer, len(codificado))
+    buffer += codificado
+
+def _leer_texto(datos, pos):
+    longitud = datos[pos]
+    if longitud < 0x80:
+        pos += 1  # Caso común: el largo entra en un byte
+    else:
+        longitud, pos = _leer_varint(datos, pos)
+    fin = pos + longitud
+    if fin > len(datos):
+        raise ValueError("Texto truncado")
+    return str(datos[pos:fin], CODIFICACION), fin
+
+def _codificar_binario(tipo, usuario, contenido, destino, ms, extra):
+    etiqueta = _ETIQUETA_POR_TIPO.get(tipo, 0)
+    banderas = 0
+    if destino is not None:
+        banderas |= _BANDERA_DESTINO
+    if extra:
+        banderas |= _BANDERA_EXTRA
+    
+    buffer = bytearray((VERSION_BINARIA, etiqueta, banderas))
+    if etiqueta == 0:
+        _escribir_texto(buffer, tipo)
+    _escribir_varint(buffer, ms)
+    _escribir_texto(buffer, usuario)
+    _escribir_texto(buffer, contenido)
+    if destino is not None:
+        _escribir_texto(buffer, destino)
+    if extra:
+        _escribir_texto(buffer, json.dumps(extra))
+    return bytes(buffer)
+
+def _decodificar_binario(datos):
+    etiqueta = datos[1]
+    banderas = datos[2]
+    pos = 3
+    if etiqueta == 0:
+        tipo, pos = _leer_texto(datos, pos)
+    else:
+        tipo = TIPOS_BINARIOS[etiqueta - 1]
+    ms, pos = _leer_varint(datos, pos)
+    usuario, pos = _leer_texto(datos, pos)
+    contenido, pos = _leer_texto(datos, pos)
+    destino = None
+    if banderas & _BANDERA_DESTINO:
+        destino, pos = _leer_texto(datos, pos)
+    
+    msg = {
+        "tipo": tipo,
+        "usuario": usuario,
+        "contenido": contenido,
+        "destino": destino,
+        "fecha": _ms_a_fecha(ms)
+    }
+    if banderas & _BANDERA_EXTRA:
+        extra, pos = _leer_texto(datos, pos)
+        extra = json.loads(extra)
+        # El codificador nunca pone campos base entre los extra
+        if not isinstance(extra, dict) or not extra.keys().isdisjoint(CAMPOS_BASE):
+            raise ValueError("Campos extra inválidos")
+        msg.update(extra)
+    return msg
+
+# Las fechas de mensajes seguidos suelen caer en el mismo segundo: se
+# recuerda la última conversión en cada sentido.
+_ultima_fecha = (None, None)
+_ultimo_ms = (None, None)
+
+def _ms_a_fecha(ms):
+    global _ultima_fecha
+    segundo = ms // 1000
+    ultima = _ultima_fecha  # Copia local: otro hilo puede reemplazarla
+    if ultima[0] != segundo:
+        try:
+            fecha = datetime.fromtimestamp(segundo)
+        except (ValueError, OverflowError, OSError):
+            # Fuera del rango de datetime: como una fecha que no se entiende
+            fecha = datetime.now()
+        ultima = (segundo, fecha.strftime(FORMATO_FECHA))
+        _ultima_fecha = ultima
+    return ultima[1]
+
+def _fecha_a_ms(fecha):
+    global _ultimo_ms
+    if not fecha:
+        return int(time.time() * 1000)
+    ultimo = _ultimo_ms
+    if ultimo[0] != fecha:
+        try:
+            ms = int(datetime.strptime(fecha, FORMATO_FECHA).timestamp() * 1000)
+        except (ValueError, OverflowError, OSError):
+            ms = -1
+        # El varint del codec binario no tiene signo: antes de 1970, ahora
+        if ms < 0:
+            ms = int(time.time() * 1000)
+        ultimo = (fecha, ms)
+        _ultimo_ms = ultimo
+    return ultimo[1]
+
+# --- CACHÉ DE MENSAJES DEL SERVIDOR ---
+# Los avisos del servidor ("Sala llena", "Usuario 'x' no encontrado", ...)
+# se repiten idénticos durante ráfagas de registros o errores. Como la
+# fecha tiene resolución de un segundo, el mensaje serializado es el mismo
+# dentro de cada segundo y puede reutilizarse.
+
+class CacheMensajes:
+    """
+    Caché LRU de mensajes serializados con cubeta de un segundo.
+    
+    La clave incluye el segundo actual, así una entrada deja de usarse
+    sola cuando cambia la hora y la política LRU termina descartándola.
+    """
+    
+    def __init__(self, capacidad=None):
+        self.capacidad = capacidad or MAX_CACHE_MENSAJES
+        self.entradas = OrderedDict()
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+    
+    def obtener(self, tipo, usuario, contenido, destino=None, formato=FORMATO_JSON, enmarcado=False):
+        """
+        Devuelve el mensaje serializado, creándolo solo si no está en caché.
+        
+        Args:
+            tipo, usuario, contenido, destino: Campos del mensaje
+            formato: FORMATO_JSON o FORMATO_BINARIO
+            enmarcado: True para obtener la trama TCP (con longitud)
+        
+        Returns:
+            bytes: Mensaje serializado (o trama, si enmarcado)
+        """
+        segundo = int(time.time())
+        clave = (tipo, usuario, contenido, destino, formato, enmarcado, segundo)
+        
+        with self.lock:
+            datos = self.entradas.get(clave)
+            if datos is not None:
+                self.entradas.move_to_end(clave)
+                self.aciertos += 1
+                return datos
+            self.fallos += 1
+        
+        msg = {
+            "tipo": tipo,
+            "usuario": usuario,
+            "contenido": contenido,
+            "destino": destino,
+            "fecha": _ms_a_fecha(segundo * 1000)
+        }
+        datos = serializar_mensaje(msg, formato)
+        if enmarcado:
+            datos = enmarcar(datos)
+        
+        with self.lock:
+            self.entradas[clave] = datos
+            while len(self.entradas) > self.capacidad:
+                self.entradas.popitem(last=False)
+        return datos
+
+cache_mensajes = CacheMensajes()
+
+def mensaje_en_cache(tipo, usuario, contenido, destino=None, formato=FORMATO_JSON, enmarcado=False):
+    """
+    Atajo a cache_mensajes.obtener para mensajes con plantilla fija
+    (avisos del servidor).
+    """
+    return cache_mensajes.obtener(tipo, usuario, contenido, destino, formato, enmarcado)
+
+# --- ENTRAMADO PARA TCP ---
+# TCP es un flujo de bytes: un recv() puede traer medio mensaje o varios
+# juntos. Cada mensaje viaja precedido de su longitud (4 bytes, big-endian).
+# UDP conserva los límites de cada datagrama y no usa este entramado.
+CABECERA_TRAMA = struct.Struct("!I")
+
+def enmarcar(datos):
+    """
+    Antepone la longitud a un mensaje para enviarlo por TCP.
+    
+    Args:
+        datos: Mensaje serializado (bytes)
+    
+    Returns:
+        bytes: Trama lista para sendall()
+    """
+    return CABECERA_TRAMA.pack(len(datos)) + datos
+
+class DecodificadorTramas:
+    """
+    Decodificador incremental de tramas TCP.
+    
+    Acepta fragmentos de bytes de cualquier tamaño y devuelve los mensajes
+    completos que se hayan podido reconstruir.
+    """
+    
+    def __init__(self, max_trama=None):
+        self.buffer = bytearray()
+        self.max_trama = max_trama or MAX_TRAMA
+    
+    def alimentar(self, fragmento):
+        """
+        Agrega bytes recibidos al buffer interno.
+        
+        Args:
+            fragmento: Bytes leídos del socket
+        
+        Returns:
+            list: Mensajes completos (bytes, sin la cabecera de longitud)
+        
+        Raises:
+            ValueError: Si una trama anuncia una longitud mayor a max_trama
+        """
+        self.buffer += fragmento
+        mensajes = []
+        inicio = 0
+        disponible = len(self.buffer)
+        
+        while disponible - inicio >= CABECERA_TRAMA.size:
+            (longitud,) = CABECERA_TRAMA.unpack_from(self.buffer, inicio)
+            if longitud > self.max_trama:
+                raise ValueError(f"Trama de {longitud} bytes excede el máximo ({self.max_trama})")
+            
+            fin = inicio + CABECERA_TRAMA.size + longitud
+            if fin > disponible:
+                break
+            
+            mensajes.append(bytes(self.buffer[inicio + CABECERA_TRAMA.size:fin]))
+            inicio = fin
+        
+        # Descartar de una sola vez lo ya consumido
+        if inicio:
+            del self.buffer[:inicio]
+        
+        return mensajes
+
+def leer_tramas(sock, max_trama=None):
+    """
+    Generador que produce los mensajes completos recibidos por un socket TCP.
+    
+    Termina cuando el otro extremo cierra la conexión.
+    
+    Args:
+        sock: Socket TCP conectado
+        max_trama: Tamaño máximo aceptado (por defecto MAX_TRAMA)
+    
+    Yields:
+        bytes: Cada mensaje recibido, sin la cabecera de longitud
+    """
+    decodificador = DecodificadorTramas(max_trama)
+    while True:
+        fragmento = sock.recv(TAM_LECTURA_TCP)
+        if not fragmento:
+            return
+        yield from decodificador.alimentar(fragmento)
+
+# --- COMPRESIÓN ---
+# Se negocia en el REGISTRO: el cliente lo envía con el campo extra
+# "compresion": "zlib" y, si el servidor acepta, la bienvenida trae el
+# mismo campo. Desde ahí cada lado puede enviar, en lugar de un mensaje
+# de UMBRAL_COMPRESION bytes o más, su versión comprimida:
+#   [0x05][deflate sin cabecera, con DICCIONARIO_COMPRESION como diccionario]
+# El contenido descomprimido es un mensaje (empieza con "{" o
+# VERSION_BINARIA) o un lote: varios mensajes con el entramado de TCP
+# (empieza con 0x00, el primer byte de la longitud). El servidor usa los
+# lotes para los mensajes recientes y las respuestas del historial.
+# El diccionario no se puede cambiar sin cambiar también la marca.
+COMPRESION_ZLIB = "zlib"
+MARCA_COMPRIMIDO = 0x05
+_PREFIJO_COMPRIMIDO = bytes([MARCA_COMPRIMIDO])
+
+# Texto frecuente en el chat; lo más común va al final (zlib llega más
+# barato a lo que está más cerca)
+DICCIONARIO_COMPRESION = (
+    "https://www. http:// .com .org .net "
+    "porque cuando también entonces después ahora mañana hoy ayer siempre nunca "
+    "nosotros ustedes ellos tengo tiene tienen puedo puede pueden hacer hecho "
+    "bueno buenas buenos días tardes noches gracias perfecto vale dale listo "
+    "alguien nadie todo todos nada algo mucho poco muy más menos bien mal "
+    "servidor cliente conexión mensaje mensajes privado sala salas usuario usuarios "
+    "HISTORIAL mensajes del historial de  LATIDO UNIRSE SALIR SALAS "
+    "Mensaje privado enviado a  Usuario no encontrado. No estás en la sala "
+    "Bienvenido ! Hay  usuarios conectados.  se ha unido al chat.  ha abandonado el chat. "
+    '"destino": null, "destino": "general", "fecha": "2025-'
+    '{"tipo": "SISTEMA", "usuario": "SERVER", "contenido": "'
+    '{"tipo": "PRIVADO", "usuario": "'
+    '{"tipo": "PUBLICO", "usuario": "", "contenido": "'
+    " que de la el en los las por para con una un es no se lo le al del como pero "
+    " jaja hola sí qué "
+).encode(CODIFICACION)
+
+_compresor = zlib.compressobj(NIVEL_COMPRESION, zlib.DEFLATED, -15, zdict=DICCIONARIO_COMPRESION)
+_descompresor = zlib.decompressobj(-15, zdict=DICCIONARIO_COMPRESION)
+
+def esta_comprimido(datos):
+    return datos[:1] == _PREFIJO_COMPRIMIDO
+
+def comprimir(datos):
+    """
+    Comprime un mensaje (o lote) si supera UMBRAL_COMPRESION y achica.
+
+    Returns:
+        bytes: La versión comprimida, o los mismos datos si no conviene
+    """
+    if len(datos) < UMBRAL_COMPRESION:
+        return datos
+    # copy() evita volver a cargar el diccionario en cada mensaje
+    compresor = _compresor.copy()
+    comprimidos = b"".join((_PREFIJO_COMPRIMIDO, compresor.compress(datos), compresor.flush()))
+    return comprimidos if len(comprimidos) < len(datos) else datos
+
+def descomprimir(datos, maximo=None):
+    """
+    Returns:
+        bytes: El contenido de un mensaje comprimido
+
+    Raises:
+        ValueError: Si está dañado o descomprimido supera "maximo"
+        (MAX_TRAMA por defecto)
+    """
+    maximo = maximo or MAX_TRAMA
+    descompresor = _descompresor.copy()
+    try:
+        resultado = descompresor.decompress(memoryview(datos)[1:], maximo)
+    except zlib.error as e:
+        raise ValueError(f"Mensaje comprimido inválido: {e}")
+    if descompresor.unconsumed_tail:
+        raise ValueError(f"Mensaje comprimido de más de {maximo} bytes")
+    return resultado
+
+def comprimir_lote(mensajes):
+    """
+    Junta varios mensajes serializados en un lote comprimido.
+
+    Returns:
+        bytes: El lote, o None si no se achica (conviene enviarlos sueltos)
+    """
+    lote = b"".join(enmarcar(m) for m in mensajes)
+    comprimido = comprimir(lote)
+    return comprimido if comprimido is not lote else None
+
+def expandir(datos):
+    """
+    Lo que hace un receptor con cada mensaje que le llega: si viene
+    comprimido lo descomprime y, si es un lote, lo separa.
+
+    Returns:
+        list: Mensajes serializados (vacía si el comprimido está dañado)
+    """
+    if not esta_comprimido(datos):
+        return [datos]
+    try:
+        contenido = descomprimir(datos)
+        if contenido[:1] != b"\x00":
+            return [contenido]
+        decodificador = DecodificadorTramas()
+        mensajes = decodificador.alimentar(contenido)
+        return mensajes if not decodificador.buffer else []
+    except ValueError:
+        return []
+
+# --- UDP CONFIABLE ---
+# Capa opcional sobre UDP con números de secuencia, acks acumulativos y
+# selectivos, retransmisión con RTO estimado (RFC 6298) y descarte de
+# duplicados; cada canal entrega en orden. El primer byte de sus paquetes
+# no es "{" ni VERSION_BINARIA, así conviven con los datagramas comunes:
+#   DATOS: [0x02][sesión 4][secuencia 4][mensaje]
+#   ACK:   [0x03][sesión 4][acumulado 4][máscara 8]
+# "sesión" es un número al azar de quien envía los DATOS: si cambia (el
+# otro extremo se reinició) la recepción empieza de nuevo. "acumulado" es
+# la próxima secuencia esperada y el bit i de la máscara confirma además
+# la secuencia acumulado + 1 + i (ack selectivo).
+PAQUETE_DATOS = 0x02
+PAQUETE_ACK = 0x03
+CABECERA_DATOS = struct.Struct("!BII")
+CABECERA_ACK = struct.Struct("!BIIQ")
+BITS_MASCARA = 64
+
+class CanalConfiable:
+    """
+    Estado de la capa confiable entre dos extremos (en ambos sentidos).
+
+    Envío: los datagramas sin confirmar quedan en "pendientes" hasta su
+    ack; los que no entran en la ventana esperan en "espera". Recepción:
+    los que llegan adelantados se guardan hasta completar el orden.
+
+    Los métodos reciben la hora (time.monotonic()) y devuelven los
+    paquetes a enviar; el que llama hace el sendto.
+    """
+
+    def __init__(self, ventana=None):
+        self.lock = threading.Lock()
+        self.ventana = ventana or VENTANA_UDP
+
+        # Envío
+        self.sesion = int.from_bytes(os.urandom(4), "big")
+        self.siguiente = 0
+        self.pendientes = OrderedDict()  # secuencia -> [paquete, vence, enviado, reintentos]
+        self.espera = []
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = RTO_INICIAL
+
+        # Recepción
+        self.sesion_remota = None
+        self.esperado = 0
+        self.adelantados = {}  # secuencia -> mensaje
+        self.ack_pendiente = False
+
+        # Contadores
+        self.retransmitidos = 0
+        self.duplicados = 0
+        self.perdidos = 0  # Sin ack después de MAX_REINTENTOS
+        self.descartados = 0  # No entraron en la espera
+
+    # --- ENVÍO ---
+
+    def _empaquetar(self, datos, ahora):
+        secuencia = self.siguiente
+        self.siguiente = (secuencia + 1) & 0xFFFFFFFF
+        paquete = CABECERA_DATOS.pack(PAQUETE_DATOS, self.sesion, secuencia) + datos
+        self.pendientes[secuencia] = [paquete, ahora + self.rto, ahora, 0]
+        return paquete
+
+    def envolver(self, datos, ahora):
+        """
+        Agrega la cabecera a un mensaje y lo deja pendiente de ack.
+
+        Returns:
+            bytes: Paquete a enviar, o None si la ventana está llena (el
+            mensaje sale cuando llegue un ack)
+        """
+        with self.lock:
+            if len(self.pendientes) < self.ventana:
+                return self._empaquetar(datos, ahora)
+            if len(self.espera) >= MAX_COLA_MENSAJES:
+                self.espera.pop(0)
+                self.descartados += 1
+            self.espera.append(bytes(datos))
+            return None
+
+    def _medir_rtt(self, muestra):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = muestra
+            self.rttvar = muestra / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - muestra)
+            self.srtt = 0.875 * self.srtt + 0.125 * muestra
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + 4 * self.rttvar))
+
+    def procesar_ack(self, paquete, ahora):
+        """
+        Quita de pendientes lo confirmado por un ACK.
+
+        Returns:
+            list: Paquetes que ahora entran en la ventana y hay que enviar
+        """
+        _, sesion, acumulado, mascara = CABECERA_ACK.unpack_from(paquete)
+        with self.lock:
+            if sesion != self.sesion:
+                return []  # Ack de una sesión anterior
+            confirmadas = []
+            # Acumulativo: pendientes está en orden de secuencia
+            for secuencia in self.pendientes:
+                if (secuencia - acumulado) & 0xFFFFFFFF < 0x80000000:
+                    break
+                confirmadas.append(secuencia)
+            # Selectivo: un bit por secuencia recibida después de "acumulado"
+            while mascara:
+                bit = (mascara & -mascara).bit_length()
+                mascara &= mascara - 1
+                confirmadas.append((acumulado + bit) & 0xFFFFFFFF)
+
+            for secuencia in confirmadas:
+                pendiente = self.pendientes.pop(secuencia, None)
+                if pendiente is not None and not pendiente[3]:
+                    # Algoritmo de Karn: solo se mide lo que no se retransmitió
+                    self._medir_rtt(ahora - pendiente[2])
+
+            salientes = []
+            while self.espera and len(self.pendientes) < self.ventana:
+                salientes.append(self._empaquetar(self.espera.pop(0), ahora))
+            return salientes
+
+    def vencidos(self, ahora):
+        """
+        Returns:
+            list: Paquetes cuyo ack no llegó a tiempo, para reenviar
+        """
+        with self.lock:
+            reenviar = []
+            for pendiente in self.pendientes.values():
+                if pendiente[1] > ahora:
+                    continue
+                if pendiente[3] >= MAX_REINTENTOS:
+                    return self._reiniciar(ahora)
+                pendiente[3] += 1
+                # Espera exponencial, por paquete
+                pendiente[1] = ahora + min(RTO_MAX, self.rto * 2 ** pendiente[3])
+                reenviar.append(pendiente[0])
+            self.retransmitidos += len(reenviar)
+            return reenviar
+
+    def _reiniciar(self, ahora):
+        """
+        El otro extremo no confirmó un datagrama en MAX_REINTENTOS: se dan
+        por perdidos los pendientes y se empieza otra sesión, para que la
+        recepción del otro lado no se quede esperando ese datagrama.
+
+        Returns:
+            list: Paquetes de la espera que ya pueden salir
+        """
+        self.perdidos += len(self.pendientes)
+        self.pendientes.clear()
+        self.sesion = int.from_bytes(os.urandom(4), "big")
+        self.siguiente = 0
+        salientes = []
+        while self.espera and len(self.pendientes) < self.ventana:
+            salientes.append(self._empaquetar(self.espera.pop(0), ahora))
+        return salientes
+
+    def proximo_vencimiento(self):
+        """
+        Returns:
+            float: Hora del próximo reenvío, o None si no hay pendientes
+        """
+        with self.lock:
+            return min((p[1] for p in self.pendientes.values()), default=None)
+
+    # --- RECEPCIÓN ---
+
+    def recibir_datos(self, paquete):
+        """
+        Procesa un paquete DATOS.
+
+        Returns:
+            list: Mensajes que ya se pueden entregar, en orden (vacía si
+            era un duplicado o llegó adelantado)
+        """
+        _, sesion, secuencia = CABECERA_DATOS.unpack_from(paquete)
+        datos = paquete[CABECERA_DATOS.size:]
+        with self.lock:
+            self.ack_pendiente = True
+            if sesion != self.sesion_remota:
+                if self.sesion_remota is None and secuencia:
+                    # Canal nuevo a mitad de una sesión (se descartó el canal
+                    # o se reinició este lado): lo anterior ya no va a llegar,
+                    # así que no se guarda ni se confirma. El otro extremo lo
+                    # sigue reenviando y, tras MAX_REINTENTOS, empieza otra
+                    # sesión desde 0 (y lo cuenta en "perdidos"). Si solo se
+                    # adelantó al 0, se acepta cuando se reenvíe
+                    return []
+                # Otra sesión del otro extremo: cada sesión empieza en 0. Lo
+                # que quedó adelantado de la anterior ya se confirmó y el
+                # hueco no se va a llenar: se entrega ahora, en orden
+                entregables = [self.adelantados[s] for s in
+                               sorted(self.adelantados, key=lambda s: (s - self.esperado) & 0xFFFFFFFF)]
+                self.sesion_remota = sesion
+                self.esperado = 0
+                self.adelantados.clear()
+            else:
+                entregables = []
+
+            desplazamiento = (secuencia - self.esperado) & 0xFFFFFFFF
+            if desplazamiento >= 0x80000000 or secuencia in self.adelantados:
+                self.duplicados += 1
+                return entregables
+            if desplazamiento:
+                if desplazamiento <= self.ventana:
+                    self.adelantados[secuencia] = bytes(datos)
+                return entregables
+
+            entregables.append(datos)
+            self.esperado = (self.esperado + 1) & 0xFFFFFFFF
+            while self.esperado in self.adelantados:
+                entregables.append(self.adelantados.pop(self.esperado))
+                self.esperado = (self.esperado + 1) & 0xFFFFFFFF
+            return entregables
+
+    def ack(self):
+        """
+        Returns:
+            bytes: Paquete ACK con lo recibido hasta ahora
+        """
+        with self.lock:
+            self.ack_pendiente = False
+            mascara = 0
+            for secuencia in self.adelantados:
+                desplazamiento = (secuencia - self.esperado) & 0xFFFFFFFF
+                if 0 < desplazamiento <= BITS_MASCARA:
+                    mascara |= 1 << (desplazamiento - 1)
+            return CABECERA_ACK.pack(PAQUETE_ACK, self.sesion_remota or 0, self.esperado, mascara)
+
+    def estadisticas(self):
+        return {
+            "pendientes": len(self.pendientes) + len(self.espera),
+            "retransmitidos": self.retransmitidos,
+            "duplicados": self.duplicados,
+            "perdidos": self.perdidos,
+            "descartados": self.descartados,
+        }
+
+def tipo_paquete(datos):
+    """
+    Returns:
+        int: PAQUETE_DATOS, PAQUETE_ACK, PAQUETE_FRAGMENTO, o None si es
+        un datagrama común
+    """
+    if datos[:1] == b"\x02" and len(datos) >= CABECERA_DATOS.size:
+        return PAQUETE_DATOS
+    if datos[:1] == b"\x03" and len(datos) >= CABECERA_ACK.size:
+        return PAQUETE_ACK
+    if datos[:1] == b"\x04" and len(datos) >= CABECERA_FRAGMENTO.size:
+        return PAQUETE_FRAGMENTO
+    return None
+
+# --- FRAGMENTACIÓN UDP ---
+# Un mensaje que no entra en un datagrama de MTU_UDP se corta en
+# fragmentos numerados, cada uno en su propio datagrama (y, con la capa
+# confiable, en su propio paquete DATOS, así se reenvía solo lo perdido):
+#   FRAGMENTO: [0x04][mensaje 4][índice 2][total 2][trozo]
+# "mensaje" distingue los mensajes de un mismo origen. Solo se envían
+# fragmentos a quien usa EnlaceUDP (los clientes comunes reciben el
+# datagrama entero, como antes).
+PAQUETE_FRAGMENTO = 0x04
+CABECERA_FRAGMENTO = struct.Struct("!BIHH")
+
+# MTU más chica que deja al menos un byte de mensaje en cada fragmento
+MTU_UDP_MIN = CABECERAS_IP_UDP + CABECERA_DATOS.size + CABECERA_FRAGMENTO.size + 1
+
+_numeros_mensaje = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+def fragmentar(datos):
+    """
+    Corta un mensaje para que cada datagrama, con la cabecera de la capa
+    confiable, entre en MTU_UDP.
+
+    Returns:
+        list: [datos] si entra en un datagrama; si no, sus fragmentos
+    """
+    carga = MTU_UDP - CABECERAS_IP_UDP - CABECERA_DATOS.size
+    if len(datos) <= carga:
+        return [datos]
+    carga -= CABECERA_FRAGMENTO.size
+    total = -(-len(datos) // carga)
+    if total > 0xFFFF:
+        raise ValueError(f"Mensaje demasiado largo para UDP: {len(datos)} bytes")
+    numero = next(_numeros_mensaje) & 0xFFFFFFFF
+    vista = memoryview(datos)
+    return [CABECERA_FRAGMENTO.pack(PAQUETE_FRAGMENTO, numero, i, total) + vista[i * carga:(i + 1) * carga]
+            for i in range(total)]
+
+class Reensamblador:
+    """
+    Rearma los mensajes que llegan en fragmentos.
+
+    Los incompletos se guardan en el orden en que llegó su primer
+    fragmento, así los vencidos (más de TIEMPO_REENSAMBLE) están siempre
+    al principio. Si un origen o el total superan su límite de bytes se
+    descartan los incompletos más viejos.
+    """
+
+    def __init__(self, max_bytes=None, max_por_origen=None, tiempo=None):
+        self.max_bytes = max_bytes or MAX_REENSAMBLE_BYTES
+        self.max_por_origen = max_por_origen or MAX_REENSAMBLE_ORIGEN
+        self.tiempo = tiempo or TIEMPO_REENSAMBLE
+        self.lock = threading.Lock()
+        self.incompletos = OrderedDict()  # (origen, mensaje) -> [vence, total, {índice: trozo}, bytes]
+        self.bytes_origen = {}
+        self.bytes = 0
+
+        # Contadores
+        self.rearmados = 0
+        self.vencidos = 0
+        self.descartados = 0  # Por límites de memoria o fragmentos inválidos
+
+    def rearmar(self, mensajes, origen):
+        """
+        Pasa los fragmentos de una lista de mensajes recibidos al rearmado.
+
+        Returns:
+            list: Los mensajes que no son fragmentos y los que se completaron
+        """
+        completos = []
+        for datos in mensajes:
+            if tipo_paquete(datos) != PAQUETE_FRAGMENTO:
+                completos.append(datos)
+                continue
+            mensaje = self.agregar(datos, origen)
+            if mensaje is not None:
+                completos.append(mensaje)
+        return completos
+
+    def agregar(self, paquete, origen, ahora=None):
+        """
+        Guarda un fragmento.
+
+        Returns:
+            bytes: El mensaje completo si era el último fragmento que
+            faltaba, o None
+        """
+        _, numero, indice, total = CABECERA_FRAGMENTO.unpack_from(paquete)
+        trozo = bytes(paquete[CABECERA_FRAGMENTO.size:])
+        ahora = time.monotonic() if ahora is None else ahora
+        clave = (origen, numero)
+        with self.lock:
+            self._vencer(ahora)
+            if indice >= total:
+                self.descartados += 1
+                return None
+            pendiente = self.incompletos.get(clave)
+            if pendiente is None:
+                pendiente = self.incompletos[clave] = [ahora + self.tiempo, total, {}, 0]
+            elif pendiente[1] != total or indice in pendiente[2]:
+                return None  # Duplicado
+            if pendiente[3] + len(trozo) > MAX_MENSAJE_UDP:
+                self._quitar(clave)
+                self.descartados += 1
+                return None
+
+            pendiente[2][indice] = trozo
+            pendiente[3] += len(trozo)
+            self.bytes += len(trozo)
+            self.bytes_origen[origen] = self.bytes_origen.get(origen, 0) + len(trozo)
+            if len(pendiente[2]) == total:
+                self._quitar(clave)
+                self.rearmados += 1
+                trozos = pendiente[2]
+                return b"".join(trozos[i] for i in range(total))
+
+            while self.bytes_origen.get(origen, 0) > self.max_por_origen:
+                viejo = next(c for c in self.incompletos if c[0] == origen)
+                self._quitar(viejo)
+                self.descartados += 1
+            while self.bytes > self.max_bytes:
+                self._quitar(next(iter(self.incompletos)))
+                self.descartados += 1
+            return None
+
+    def _quitar(self, clave):
+        pendiente = self.incompletos.pop(clave)
+        self.bytes -= pendiente[3]
+        restantes = self.bytes_origen.get(clave[0], 0) - pendiente[3]
+        if restantes > 0:
+            self.bytes_origen[clave[0]] = restantes
+        else:
+            self.bytes_origen.pop(clave[0], None)
+
+    def _vencer(self, ahora):
+        while self.incompletos:
+            clave, pendiente = next(iter(self.incompletos.items()))
+            if pendiente[0] > ahora:
+                return
+            self._quitar(clave)
+            self.vencidos += 1
+
+    def limpiar(self, ahora=None):
+        """Descarta los mensajes incompletos vencidos."""
+        with self.lock:
+            self._vencer(time.monotonic() if ahora is None else ahora)
+
+    def olvidar(self, origen):
+        """Descarta los mensajes incompletos de un origen."""
+        with self.lock:
+            for clave in [c for c in self.incompletos if c[0] == origen]:
+                self._quitar(clave)
+
+    def estadisticas(self):
+        return {
+            "incompletos": len(self.incompletos),
+            "bytes": self.bytes,
+            "rearmados": self.rearmados,
+            "vencidos": self.vencidos,
+            "descartados": self.descartados,
+        }
+
+class CapaConfiable:
+    """
+    Lado servidor de la capa confiable: un CanalConfiable por cada
+    dirección que la usa. Los clientes que mandan datagramas comunes
+    siguen recibiéndolos así.
+
+    Tiene sendto() como el socket, así que los escritores y responder()
+    lo usan sin cambios. También corta en fragmentos los mensajes largos
+    para esos clientes y rearma los que ellos envían.
+
+    Pasados max_canales se descartan los canales menos usados, salvo los
+    de direcciones protegidas con proteger() (clientes registrados): el
+    canal nuevo de un cliente activo perdería lo que él ya dio por
+    confirmado, y datagramas con origen falso podrían desalojar a todos.
+    """
+
+    def __init__(self, salida, max_canales=None):
+        self.salida = salida  # Socket o envoltorio con sendto()
+        self.max_canales = max_canales or MAX_CANALES_UDP
+        self.canales = OrderedDict()  # addr -> CanalConfiable (LRU)
+        self.protegidos = set()  # Direcciones cuyo canal no se desaloja
+        self.activos = set()  # Direcciones con datagramas sin confirmar
+        self.con_ack = set()  # Direcciones que recibieron datos sin ack todavía
+        self.reensamblador = Reensamblador()
+        self.lock = threading.Lock()
+
+        # Contadores de los canales ya cerrados
+        self.cerrados = {}
+
+    def sendto(self, datos, addr):
+        canal = self.canales.get(addr)
+        if canal is None:
+            self.salida.sendto(datos, addr)
+            return
+        ahora = time.monotonic()
+        for parte in fragmentar(datos):
+            paquete = canal.envolver(parte, ahora)
+            if paquete is not None:
+                self.salida.sendto(paquete, addr)
+        if addr not in self.activos:
+            with self.lock:
+                self.activos.add(addr)
+
+    def recibir(self, datos, addr):
+        """
+        Procesa un datagrama recibido.
+
+        Returns:
+            list: Mensajes para procesar (el mismo datagrama si no usa la capa)
+        """
+        tipo = tipo_paquete(datos)
+        if tipo is None:
+            return [datos]
+        if tipo == PAQUETE_FRAGMENTO:
+            return self.reensamblador.rearmar([datos], addr)
+
+        if tipo == PAQUETE_ACK:
+            canal = self.canales.get(addr)
+            if canal is not None:
+                for paquete in canal.procesar_ack(datos, time.monotonic()):
+                    self.salida.sendto(paquete, addr)
+            return []
+
+        with self.lock:
+            canal = self.canales.get(addr)
+            if canal is None:
+                canal = self.canales[addr] = CanalConfiable()
+                if len(self.canales) > self.max_canales:
+                    self._desalojar()
+            else:
+                self.canales.move_to_end(addr)
+        self.con_ack.add(addr)
+        return self.reensamblador.rearmar(canal.recibir_datos(datos), addr)
+
+    def enviar_acks(self):
+        """Envía un ack por canal que recibió datos desde la última llamada."""
+        for addr in self.con_ack:
+            canal = self.canales.get(addr)
+            if canal is not None:
+                self.salida.sendto(canal.ack(), addr)
+        self.con_ack.clear()
+
+    def revisar(self):
+        """
+        Reenvía los paquetes vencidos de los canales con pendientes.
+
+        Returns:
+            float: Segundos hasta la próxima revisión: el próximo
+            vencimiento, o RTO_MAX si hay canales sin pendientes (otro
+            hilo puede enviar mientras tanto); None si no hay canales
+        """
+        ahora = time.monotonic()
+        proximo = None
+        self.reensamblador.limpiar(ahora)
+        with self.lock:
+            activos = [(addr, self.canales.get(addr)) for addr in self.activos]
+        for addr, canal in activos:
+            if canal is not None:
+                for paquete in canal.vencidos(ahora):
+                    self.salida.sendto(paquete, addr)
+                vence = canal.proximo_vencimiento()
+            else:
+                vence = None
+            if vence is None:
+                with self.lock:
+                    if canal is None or not canal.pendientes:
+                        self.activos.discard(addr)
+            elif proximo is None or vence < proximo:
+                proximo = vence
+        if proximo is not None:
+            return max(0.0, proximo - ahora)
+        return RTO_MAX if self.canales else None
+
+    def _desalojar(self):
+        # Se saltean (y pasan al final) los protegidos: a lo sumo uno por
+        # cliente registrado
+        for _ in range(len(self.canales)):
+            addr, canal = self.canales.popitem(last=False)
+            if addr not in self.protegidos:
+                self.activos.discard(addr)
+                self._acumular(canal)
+                return
+            self.canales[addr] = canal
+
+    def proteger(self, addr):
+        """Evita que se desaloje el canal de una dirección (se registró)."""
+        with self.lock:
+            self.protegidos.add(addr)
+
+    def olvidar(self, addr):
+        """Descarta el canal de una dirección (el cliente se fue)."""
+        with self.lock:
+            canal = self.canales.pop(addr, None)
+            self.activos.discard(addr)
+            self.protegidos.discard(addr)
+            if canal is not None:
+                self._acumular(canal)
+        self.reensamblador.olvidar(addr)
+
+    def _acumular(self, canal):
+        for clave, valor in canal.estadisticas().items():
+            if clave != "pendientes":
+                self.cerrados[clave] = self.cerrados.get(clave, 0) + valor
+
+    def estadisticas(self):
+        """
+        Returns:
+            dict: Canales abiertos y totales de todos los canales
+        """
+        with self.lock:
+            canales = list(self.canales.values())
+            totales = dict(self.cerrados)
+        totales["canales"] = len(canales)
+        for canal in canales:
+            for clave, valor in canal.estadisticas().items():
+                totales[clave] = totales.get(clave, 0) + valor
+        return totales
+
+class EnlaceUDP:
+    """
+    Lado cliente de UDP: el socket y la dirección del servidor, con o sin
+    capa confiable.
+
+    enviar() puede llamarse desde cualquier hilo; recibir() desde uno solo
+    (el que lee) y se encarga también de los reenvíos, los acks y el
+    rearmado de los mensajes fragmentados.
+    """
+
+    def __init__(self, sock, addr, confiable=None):
+        self.sock = sock
+        self.addr = addr
+        self.canal = CanalConfiable() if (UDP_CONFIABLE if confiable is None else confiable) else None
+        self.reensamblador = Reensamblador()
+
+    def enviar(self, datos):
+        """
+        Envía un mensaje, en fragmentos si no entra en un datagrama.
+
+        Raises:
+            ValueError: Si supera MAX_MENSAJE_UDP (se deja lugar para lo
+            que agrega el servidor al reenviarlo)
+        """
+        if len(datos) > MAX_MENSAJE_UDP - 256:
+            raise ValueError(f"Mensaje demasiado largo para UDP ({len(datos)} bytes, "
+                             f"máximo {MAX_MENSAJE_UDP - 256})")
+        ahora = time.monotonic()
+        for parte in fragmentar(datos):
+            if self.canal is None:
+                self.sock.sendto(parte, self.addr)
+                continue
+            paquete = self.canal.envolver(parte, ahora)
+            if paquete is not None:
+                self.sock.sendto(paquete, self.addr)
+
+    def recibir(self, espera=1.0):
+        """
+        Espera datagramas hasta "espera" segundos.
+
+        Returns:
+            list: Mensajes recibidos (vacía si no llegó ninguno a tiempo)
+        """
+        limite = time.monotonic() + espera
+        while True:
+            ahora = time.monotonic()
+            if self.canal is not None:
+                for paquete in self.canal.vencidos(ahora):
+                    self.sock.sendto(paquete, self.addr)
+                vence = self.canal.proximo_vencimiento()
+                if vence is not None and vence < limite:
+                    limite_lectura = vence
+                else:
+                    limite_lectura = limite
+            else:
+                limite_lectura = limite
+
+            self.sock.settimeout(max(0.001, limite_lectura - ahora))
+            try:
+                datos, _ = self.sock.recvfrom(TAM_DATAGRAMA_MAX)
+            except socket.timeout:
+                if time.monotonic() >= limite:
+                    return []
+                continue
+            finally:
+                self.sock.settimeout(None)
+
+            tipo = tipo_paquete(datos)
+            if tipo == PAQUETE_ACK and self.canal is not None:
+                for paquete in self.canal.procesar_ack(datos, time.monotonic()):
+                    self.sock.sendto(paquete, self.addr)
+                continue
+            if tipo == PAQUETE_DATOS and self.canal is not None:
+                mensajes = self.canal.recibir_datos(datos)
+                self.sock.sendto(self.canal.ack(), self.addr)
+            else:
+                mensajes = [datos]
+            mensajes = self.reensamblador.rearmar(mensajes, self.addr)
+            if mensajes:
+                return mensajes
+
+# --- CONFIGURACIÓN EN TIEMPO DE EJECUCIÓN ---
+# Los valores de arriba son los de por defecto. Se pueden cambiar con un
+# archivo INI (sección [chat]), con variables de entorno CHAT_<OPCION> o
+# con argumentos de línea de comandos, en ese orden de prioridad creciente.
+ARCHIVO_CONFIGURACION = "chat.ini"
+SECCION_CONFIGURACION = "chat"
+PREFIJO_ENTORNO = "CHAT_"
+
+def _booleano(valor):
+    """Convierte "1", "si", "true"... (o un bool) a bool."""
+    if isinstance(valor, bool):
+        return valor
+    texto = str(valor).strip().lower()
+    if texto in ("1", "si", "sí", "true", "yes", "on"):
+        return True
+    if texto in ("0", "no", "false", "off", ""):
+        return False
+    raise ValueError(f"Valor booleano inválido: {valor}")
+
+# opción -> (variable de este módulo, tipo)
+OPCIONES_CONFIGURABLES = {
+    "host": ("HOST", str),
+    "puerto": ("PORT", int),
+    "max_clientes": ("MAX_CLIENTES", int),
+    "cola_mensajes": ("MAX_COLA_MENSAJES", int),
+    "cola_bytes": ("MAX_COLA_BYTES", int),
+    "desborde": ("POLITICA_DESBORDE", str),
+    "ventana_escritura": ("VENTANA_ESCRITURA", float),
+    "lote_udp": ("LOTE_UDP", int),
+    "compresion": ("COMPRESION", _booleano),
+    "umbral_compresion": ("UMBRAL_COMPRESION", int),
+    "mtu_udp": ("MTU_UDP", int),
+    "recientes": ("RECIENTES_POR_SALA", int),
+    "inactividad": ("TIEMPO_INACTIVIDAD", float),
+    "limite_mensajes": ("LIMITE_MENSAJES", float),
+    "limite_bytes": ("LIMITE_BYTES", int),
+    "limite_mensajes_ip": ("LIMITE_MENSAJES_IP", float),
+    "limite_bytes_ip": ("LIMITE_BYTES_IP", int),
+    "rafaga_limite": ("RAFAGA_LIMITE", float),
+    "metricas_host": ("METRICAS_HOST", str),
+    "metricas_puerto": ("METRICAS_PUERTO", int),
+    "log_nivel": ("LOG_NIVEL", str),
+    "log_formato": ("LOG_FORMATO", str),
+    "log_contenido": ("LOG_CONTENIDO", _booleano),
+    "historial_dir": ("HISTORIAL_DIR", str),
+    "historial_segmento": ("HISTORIAL_SEGMENTO", int),
+    "historial_segmentos": ("HISTORIAL_SEGMENTOS", int),
+}
+
+# Rango válido (mínimo, máximo o None) de las opciones numéricas. Las que
+# admiten 0 lo usan para "desactivado" (o "sin límite"). Las de punto
+# flotante además deben ser finitas
+RANGOS_OPCIONES = {
+    "puerto": (1, 65535),
+    "max_clientes": (1, None),
+    "cola_mensajes": (1, None),
+    "cola_bytes": (1, None),
+    "ventana_escritura": (0, 1.0),
+    "lote_udp": (1, None),
+    "umbral_compresion": (0, None),
+    "mtu_udp": (MTU_UDP_MIN, 65535),
+    "recientes": (0, None),
+    "inactividad": (0, 365 * 24 * 3600),
+    "limite_mensajes": (0, None),
+    "limite_bytes": (0, None),
+    "limite_mensajes_ip": (0, None),
+    "limite_bytes_ip": (0, None),
+    "rafaga_limite": (0.001, None),
+    "metricas_puerto": (0, 65535),
+    "historial_segmento": (1, None),
+    "historial_segmentos": (1, None),
+}
+
+def aplicar_opcion(opcion, valor):
+    """
+    Cambia una opción configurable de este módulo.
+    
+    Args:
+        opcion: Clave de OPCIONES_CONFIGURABLES (ej. "max_clientes")
+        valor: Nuevo valor (se convierte al tipo de la opción)
+    
+    Raises:
+        ValueError: Si la opción no existe o el valor no es válido
+    """
+    if opcion not in OPCIONES_CONFIGURABLES:
+        raise ValueError(f"Opción desconocida: {opcion}")
+    
+    variable, tipo = OPCIONES_CONFIGURABLES[opcion]
+    valor = tipo(valor)
+    if opcion == "desborde" and valor not in (DESBORDE_DESCARTAR, DESBORDE_DESCONECTAR):
+        raise ValueError(f"Política de desborde inválida: {valor}")
+    if opcion in RANGOS_OPCIONES:
+        minimo, maximo = RANGOS_OPCIONES[opcion]
+        # "not >=" también rechaza nan
+        if (not valor >= minimo or (maximo is not None and valor > maximo)
+                or (tipo is float and not math.isfinite(valor))):
+            rango = f"estar entre {minimo} y {maximo}" if maximo is not None else f"ser al menos {minimo}"
+            raise ValueError(f"{opcion} debe {rango}: {valor}")
+    globals()[variable] = valor
+
+def cargar_configuracion(ruta=None):
+    """
+    Aplica el archivo de configuración y las variables de entorno.
+    
+    Args:
+        ruta: Archivo INI a leer (por defecto ARCHIVO_CONFIGURACION, si existe)
+    
+    Raises:
+        ValueError: Si una opción tiene un valor inválido o no se puede
+            leer el archivo indicado en "ruta"
+    """
+    parser = configparser.ConfigParser()
+    leidos = parser.read(ruta or ARCHIVO_CONFIGURACION, encoding=CODIFICACION)
+    if ruta and not leidos:
+        raise ValueError(f"No se pudo leer el archivo de configuración: {ruta}")
+    seccion = parser[SECCION_CONFIGURACION] if parser.has_section(SECCION_CONFIGURACION) else {}
+    
+    for opcion in OPCIONES_CONFIGURABLES:
+        valor = os.environ.get(PREFIJO_ENTORNO + opcion.upper(), seccion.get(opcion))
+        if valor is not None:
+            aplicar_opcion(opcion, valor)
 
 def obtener_ip_local():
     """
@@ -68,16 +1432,30 @@ def obtener_ip_local():
     except:
         return "127.0.0.1"
 
-def crear_socket_tcp():
-    """Crea y configura un socket TCP."""
+def crear_socket_tcp(reusar_puerto=False):
+    """
+    Crea y configura un socket TCP.
+    
+    Args:
+        reusar_puerto: Activar SO_REUSEPORT (varios procesos en el mismo puerto)
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusar_puerto:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     return sock
 
-def crear_socket_udp():
-    """Crea y configura un socket UDP."""
+def crear_socket_udp(reusar_puerto=False):
+    """
+    Crea y configura un socket UDP.
+    
+    Args:
+        reusar_puerto: Activar SO_REUSEPORT (varios procesos en el mismo puerto)
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusar_puerto:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     return sock
 
 def formatear_mensaje_para_mostrar(msg):
@@ -100,9 +1478,11 @@ def formatear_mensaje_para_mostrar(msg):
     
     if tipo == "ERROR":
         return f"[ERROR] {contenido}"
-    elif tipo == "SISTEMA":
-        return f"[SISTEMA] {contenido}"
+    elif tipo in ("SISTEMA", "SALAS", "HISTORIAL"):
+        return f"[{tipo}] {contenido}"
     elif tipo == "PRIVADO":
         return f"[{hora}] (PRIVADO de {usuario}): {contenido}"
+    elif msg.get('destino') and msg.get('destino') != SALA_GENERAL:
+        return f"[{hora}] #{msg.get('destino')} {usuario}: {contenido}"
     else:
         return f"[{hora}] {usuario}: {contenido}"
\ No newline at end of file
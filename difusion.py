@@ -0,0 +1,698 @@
+"""
+Difusión de mensajes (fan-out) para el servidor de chat
+Cada mensaje se serializa una vez y se reparte a las colas de salida
+de los destinatarios; la escritura al socket ocurre fuera del lock del registro.
+"""
+
+import asyncio
+import collections
+import selectors
+import socket
+import threading
+import comun
+
+class Trama:
+    """
+    Mensaje saliente que se serializa como máximo una vez por formato
+    (y se comprime como máximo una vez por formato, para los clientes que
+    negociaron compresión).
+
+    Cada vista (memoryview) se comparte entre todas las colas de salida
+    que usan ese formato, sin volver a copiar los bytes.
+
+    Con "plantilla" (tipo, usuario, contenido, destino) la trama sale de
+    comun.cache_mensajes, para avisos del servidor que se repiten.
+
+    "tipo" es el del mensaje, para las métricas; si no se indica se toma
+    de la plantilla o del diccionario (None si solo hay bytes).
+    """
+
+    def __init__(self, es_tcp, datos=None, msg=None, plantilla=None, tipo=None):
+        self.es_tcp = es_tcp
+        self.datos = datos
+        self.msg = msg
+        self.plantilla = plantilla
+        if tipo is None:
+            tipo = plantilla[0] if plantilla else msg.get('tipo') if msg else None
+        self.tipo = tipo
+        self.vistas = {}
+        if datos is not None:
+            self.vistas[comun.formato_de(datos)] = self._vista(datos)
+
+    def _vista(self, datos):
+        return memoryview(comun.enmarcar(datos) if self.es_tcp else datos)
+
+    def mensaje(self, formato):
+        """
+        Returns:
+            memoryview: El mensaje serializado en el formato pedido, sin el
+            entramado de TCP
+        """
+        vista = self.para(formato)
+        return vista[comun.CABECERA_TRAMA.size:] if self.es_tcp else vista
+
+    def para(self, formato, comprimir=False):
+        """
+        Returns:
+            memoryview: La trama en el formato pedido (enmarcada si es TCP),
+            comprimida si se pide y conviene
+        """
+        if comprimir:
+            clave = (formato, comun.COMPRESION_ZLIB)
+            vista = self.vistas.get(clave)
+            if vista is None:
+                datos = self.mensaje(formato)
+                comprimidos = comun.comprimir(datos)
+                vista = self.para(formato) if comprimidos is datos else self._vista(comprimidos)
+                self.vistas[clave] = vista
+            return vista
+        vista = self.vistas.get(formato)
+        if vista is None and self.plantilla:
+            vista = memoryview(comun.mensaje_en_cache(*self.plantilla, formato=formato,
+                                                      enmarcado=self.es_tcp))
+            self.vistas[formato] = vista
+        elif vista is None:
+            if self.msg is None:
+                self.msg = comun.desempaquetar_mensaje(self.datos)
+            vista = self._vista(comun.serializar_mensaje(self.msg, formato))
+            self.vistas[formato] = vista
+        return vista
+
+def crear_trama(datos, es_tcp, msg=None):
+    """
+    Prepara un mensaje recibido para reenviarlo a otros clientes.
+
+    Los destinatarios que usan el mismo formato que el remitente reciben
+    los bytes originales; para el otro formato se serializa una sola vez.
+
+    Args:
+        datos: Mensaje serializado (bytes)
+        es_tcp: True para TCP (se enmarca), False para UDP
+        msg: Diccionario ya deserializado, si se tiene
+
+    Returns:
+        Trama: Trama compartida
+    """
+    return Trama(es_tcp, datos=datos, msg=msg)
+
+def difundir(trama, escritores, excepto=None):
+    """
+    Entrega la misma trama a varios escritores, cada uno en su formato.
+
+    Debe llamarse fuera del lock del registro: encolar() no bloquea, pero
+    así ningún destinatario puede frenar a los demás ni al registro.
+
+    Args:
+        trama: Trama a enviar
+        escritores: Iterable de escritores de salida
+        excepto: Escritor que no debe recibirla (el remitente)
+
+    Returns:
+        list: Escritores que rechazaron la trama (cerrados o desconectados
+        por desborde)
+    """
+    rechazados = []
+    for escritor in escritores:
+        if escritor is excepto:
+            continue
+        if not escritor.encolar(trama.para(escritor.formato, escritor.comprimir)):
+            rechazados.append(escritor)
+    return rechazados
+
+def enviar_lote(tramas, escritor):
+    """
+    Envía varias tramas seguidas a un solo escritor.
+
+    En TCP se juntan en un único buffer: una sola entrada en la cola y una
+    sola escritura al socket. En UDP cada trama sigue siendo un datagrama.
+    Si el destinatario negoció compresión, van todas en un solo lote
+    comprimido (ver comun.comprimir_lote), que en UDP es un solo mensaje.
+
+    Args:
+        tramas: Secuencia de Trama
+        escritor: Escritor de salida del destinatario
+
+    Returns:
+        bool: False si el escritor rechazó el envío
+    """
+    if not tramas:
+        return True
+    es_tcp = tramas[0].es_tcp
+    if escritor.comprimir and len(tramas) > 1:
+        lote = comun.comprimir_lote([t.mensaje(escritor.formato) for t in tramas])
+        if lote is not None and (es_tcp or len(lote) <= comun.MAX_MENSAJE_UDP - 256):
+            return escritor.encolar(comun.enmarcar(lote) if es_tcp else lote)
+    if es_tcp:
+        return escritor.encolar(b"".join(t.para(escritor.formato, escritor.comprimir) for t in tramas))
+    return all([escritor.encolar(t.para(escritor.formato, escritor.comprimir)) for t in tramas])
+
+class Recientes:
+    """
+    Últimas tramas difundidas en cada sala, ya serializadas, para darle
+    contexto a quien entra sin leer el disco ni volver a serializar.
+
+    Cada sala tiene un buffer circular (deque con maxlen). Las salas se
+    olvidan con política LRU cuando hay más de max_salas.
+    """
+
+    def __init__(self, capacidad=None, max_salas=None):
+        self.capacidad = comun.RECIENTES_POR_SALA if capacidad is None else capacidad
+        self.max_salas = max_salas or comun.MAX_SALAS_RECIENTES
+        self.salas = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def agregar(self, sala, trama):
+        """
+        Guarda una trama difundida en una sala.
+
+        Args:
+            sala: Nombre de la sala
+            trama: Trama cuyos datos no dependen de un buffer reutilizable
+        """
+        if not self.capacidad:
+            return
+        with self.lock:
+            buffer = self.salas.get(sala)
+            if buffer is None:
+                buffer = self.salas[sala] = collections.deque(maxlen=self.capacidad)
+                while len(self.salas) > self.max_salas:
+                    self.salas.popitem(last=False)
+            else:
+                self.salas.move_to_end(sala)
+            buffer.append(trama)
+
+    def tramas(self, sala):
+        """
+        Returns:
+            tuple: Tramas recientes de la sala, de la más vieja a la más nueva
+        """
+        with self.lock:
+            buffer = self.salas.get(sala)
+            return tuple(buffer) if buffer else ()
+
+class ColaSalida:
+    """
+    Cola acotada de tramas pendientes de una conexión.
+
+    Los límites (mensajes y bytes) y la política de desborde se toman de
+    comun si no se indican. "formato" es el formato de mensaje del cliente
+    y "comprimir" si negoció compresión (ambos se fijan al registrarse).
+    Al superarse un límite:
+      - DESBORDE_DESCARTAR: se descartan las tramas más antiguas
+      - DESBORDE_DESCONECTAR: se vacía la cola y se marca la conexión
+        como desbordada para cerrarla
+
+    Las subclases protegen las llamadas a _agregar/_sacar con su propio
+    mecanismo (lock o bucle de eventos). Los escritores TCP sacan todo lo
+    pendiente de una vez (_sacar_lote) y lo escriben con una sola llamada.
+    """
+
+    def __init__(self, max_mensajes=None, max_bytes=None, politica=None):
+        self.cola = collections.deque()
+        self.max_mensajes = max_mensajes or comun.MAX_COLA_MENSAJES
+        self.max_bytes = max_bytes or comun.MAX_COLA_BYTES
+        self.politica = politica or comun.POLITICA_DESBORDE
+        self.formato = comun.FORMATO_JSON
+        self.comprimir = False
+        self.cerrado = False
+        self.fallido = False
+        self.desbordado = False
+
+        # Contadores
+        self.bytes_encolados = 0
+        self.escrituras = 0  # Llamadas al socket (una puede llevar varias tramas)
+        self.tramas_enviadas = 0
+        self.bytes_enviados = 0
+        self.tramas_descartadas = 0
+        self.bytes_descartados = 0
+
+    def _agregar(self, trama):
+        """
+        Agrega una trama aplicando los límites.
+
+        Returns:
+            bool: False si la conexión debe cerrarse por desborde
+        """
+        self.cola.append(trama)
+        self.bytes_encolados += len(trama)
+
+        while len(self.cola) > self.max_mensajes or self.bytes_encolados > self.max_bytes:
+            if self.politica == comun.DESBORDE_DESCONECTAR:
+                self.desbordado = True
+                self._vaciar()
+                return False
+
+            # Siempre se conserva al menos la trama recién llegada
+            if len(self.cola) == 1:
+                break
+            vieja = self.cola.popleft()
+            self.bytes_encolados -= len(vieja)
+            self.tramas_descartadas += 1
+            self.bytes_descartados += len(vieja)
+
+        return True
+
+    def _sacar_lote(self, maximo):
+        """
+        Saca hasta "maximo" tramas de la cola.
+
+        Returns:
+            list: Tramas en orden, con al menos una
+        """
+        cola = self.cola
+        lote = [cola.popleft() for _ in range(min(maximo, len(cola)))]
+        if cola:
+            self.bytes_encolados -= sum(map(len, lote))
+        else:
+            self.bytes_encolados = 0
+        return lote
+
+    def _enviada(self, trama):
+        self.tramas_enviadas += 1
+        self.bytes_enviados += len(trama)
+
+    def _enviadas(self, lote):
+        """Cuenta un lote de tramas escrito con una sola llamada."""
+        self.escrituras += 1
+        self.tramas_enviadas += len(lote)
+        self.bytes_enviados += sum(map(len, lote))
+
+    def _vaciar(self):
+        """Descarta todo lo pendiente contándolo como descartado."""
+        self.tramas_descartadas += len(self.cola)
+        self.bytes_descartados += self.bytes_encolados
+        self.cola.clear()
+        self.bytes_encolados = 0
+
+    def estadisticas(self):
+        """
+        Returns:
+            dict: Contadores de la cola de salida
+        """
+        return {
+            "mensajes_encolados": len(self.cola),
+            "bytes_encolados": self.bytes_encolados,
+            "escrituras": self.escrituras,
+            "tramas_enviadas": self.tramas_enviadas,
+            "bytes_enviados": self.bytes_enviados,
+            "tramas_descartadas": self.tramas_descartadas,
+            "bytes_descartados": self.bytes_descartados,
+            "desbordado": self.desbordado,
+        }
+
+def _descontar(vistas, escritos):
+    """
+    Returns:
+        list: Lo que falta escribir de "vistas" después de que una
+        escritura parcial aceptó "escritos" bytes
+    """
+    i = 0
+    while i < len(vistas) and escritos >= len(vistas[i]):
+        escritos -= len(vistas[i])
+        i += 1
+    vistas = vistas[i:]
+    if escritos:
+        vistas[0] = memoryview(vistas[0])[escritos:]
+    return vistas
+
+class EscritorHilo(ColaSalida):
+    """
+    Cola de salida de una conexión TCP con su propio hilo escritor.
+
+    Todo lo que se envía a la conexión pasa por aquí, así las tramas de
+    distintos hilos nunca se intercalan en el socket.
+
+    El hilo escribe todo lo encolado con un solo sendmsg (scatter-gather,
+    sin copiar las tramas a un buffer): lo que llega mientras el socket
+    está ocupado sale junto en la escritura siguiente. Con "ventana"
+    (comun.VENTANA_ESCRITURA) además espera ese tiempo a que se junten
+    más tramas antes de escribir.
+    """
+
+    def __init__(self, conn, ventana=None, **limites):
+        super().__init__(**limites)
+        self.conn = conn
+        self.ventana = comun.VENTANA_ESCRITURA if ventana is None else ventana
+        self.condicion = threading.Condition()
+        self.hilo = threading.Thread(target=self._escribir, daemon=True)
+        self.hilo.start()
+
+    def encolar(self, trama):
+        """
+        Agrega una trama a la cola sin bloquear.
+
+        Returns:
+            bool: False si la conexión ya está cerrada, falló o se desbordó
+        """
+        with self.condicion:
+            if self.cerrado or self.fallido:
+                return False
+            aceptada = self._agregar(trama)
+            if not aceptada:
+                self.fallido = True
+            # Solo hace falta despertar al escritor si la cola estaba vacía;
+            # así tampoco se corta su ventana en cada trama
+            if len(self.cola) <= 1:
+                self.condicion.notify()
+
+        if not aceptada:
+            # Desborde con política de desconexión
+            self._despertar_lector()
+        return aceptada
+
+    def cerrar(self):
+        """Cierra la conexión después de enviar lo pendiente."""
+        with self.condicion:
+            self.cerrado = True
+            self.condicion.notify()
+
+    def cortar(self):
+        """
+        Desconecta al cliente desde el servidor: el hilo lector ve la
+        conexión cerrada y termina como en cualquier desconexión; lo
+        pendiente se sigue enviando hasta que ese hilo llame a cerrar().
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def _despertar_lector(self):
+        """Corta el socket para que el hilo lector detecte la desconexión."""
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _enviar_lote(self, lote):
+        """Escribe todas las tramas del lote, con sendmsg si existe (no en Windows)."""
+        if len(lote) == 1 or not hasattr(self.conn, "sendmsg"):
+            self.conn.sendall(lote[0] if len(lote) == 1 else b"".join(lote))
+            return
+        # sendmsg puede escribir solo una parte: se sigue desde donde quedó
+        vistas = lote
+        while vistas:
+            vistas = _descontar(vistas, self.conn.sendmsg(vistas))
+
+    def _escribir(self):
+        """Hilo escritor: vacía la cola hacia el socket, por lotes."""
+        while True:
+            with self.condicion:
+                while not self.cola and not self.cerrado and not self.fallido:
+                    self.condicion.wait()
+                if self.cola and self.ventana > 0 and not self.cerrado:
+                    # Dejar que se junten más tramas antes de escribir
+                    self.condicion.wait(self.ventana)
+                if not self.cola:
+                    break
+                lote = self._sacar_lote(comun.LOTE_ESCRITURA)
+
+            try:
+                self._enviar_lote(lote)
+            except OSError:
+                with self.condicion:
+                    self.fallido = True
+                    self._vaciar()
+                self._despertar_lector()
+                break
+
+            with self.condicion:
+                self._enviadas(lote)
+
+        # El socket se cierra solo cuando el dueño de la conexión lo pide
+        with self.condicion:
+            while not self.cerrado:
+                self.condicion.wait()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+class EscritorAsyncio(ColaSalida):
+    """
+    Cola de salida de una conexión del motor asyncio.
+
+    Una tarea por conexión vacía la cola con write()/drain(), de modo que
+    un cliente lento solo acumula en su propia cola acotada. Debe usarse
+    desde el hilo del bucle de eventos.
+
+    Esa tarea es la única que llama a drain() (antes de Python 3.10 dos
+    drain() a la vez sobre un transporte fallan); el lector espera a
+    "drenado" para dejar de leer mientras el transporte está lleno.
+    """
+
+    def __init__(self, writer, **limites):
+        super().__init__(**limites)
+        self.writer = writer
+        self.hay_datos = asyncio.Event()
+        self.drenado = asyncio.Event()
+        self.drenado.set()
+        self.tarea = asyncio.get_running_loop().create_task(self._escribir())
+
+    def encolar(self, trama):
+        if self.cerrado or self.fallido:
+            return False
+        if not self._agregar(trama):
+            self.fallido = True
+            self.writer.transport.abort()
+            return False
+        self.hay_datos.set()
+        return True
+
+    def cerrar(self):
+        self.cerrado = True
+        self.hay_datos.set()
+
+    def cortar(self):
+        """
+        Desconecta al cliente desde el servidor: se envía lo pendiente y
+        se cierra el transporte, con lo que el lector recibe fin de
+        datos. Si el cliente no lee, se aborta después de
+        comun.ESPERA_CORTE.
+        """
+        self.cerrar()
+        asyncio.get_running_loop().call_later(comun.ESPERA_CORTE, self.writer.transport.abort)
+
+    async def _escribir(self):
+        """Tarea escritora: vacía la cola hacia el transporte."""
+        try:
+            while not self.fallido:
+                await self.hay_datos.wait()
+                self.hay_datos.clear()
+                while self.cola and not self.fallido:
+                    # Todo lo encolado en una sola escritura del transporte
+                    lote = self._sacar_lote(comun.LOTE_ESCRITURA)
+                    self.writer.writelines(lote)
+                    self._enviadas(lote)
+                    self.drenado.clear()
+                    await self.writer.drain()
+                    self.drenado.set()
+                if self.cerrado:
+                    break
+        except (ConnectionError, OSError):
+            self.fallido = True
+            self._vaciar()
+        finally:
+            self.drenado.set()
+            self.writer.close()
+
+class EscritorReactor(ColaSalida):
+    """
+    Cola de salida de una conexión del motor reactor (ver reactor.py).
+
+    El escritor atiende los eventos del socket: los de lectura se los pasa
+    a "al_leer" y, mientras queda algo sin escribir, pide también el de
+    escritura. encolar() solo agrega a la cola y anota al escritor en el
+    reactor, que al final de la vuelta del bucle llama a vaciar(): todo lo
+    pendiente sale en un sendmsg no bloqueante y lo que el socket no
+    acepta se sigue escribiendo cuando avisa que puede. Debe usarse desde
+    el hilo del reactor.
+    """
+
+    def __init__(self, reactor, conn, al_leer, **limites):
+        super().__init__(**limites)
+        self.reactor = reactor
+        self.conn = conn
+        self.al_leer = al_leer
+        self.leyendo = True
+        self.lote = []    # Tramas sacadas de la cola que se están escribiendo
+        self.vistas = []  # Lo que falta escribir del lote
+        conn.setblocking(False)
+        reactor.registrar(conn, selectors.EVENT_READ, self._evento)
+
+    def _evento(self, eventos):
+        if self.conn.fileno() < 0:
+            return  # Cerrado al atender otro evento de la misma vuelta
+        if eventos & selectors.EVENT_WRITE:
+            self.vaciar()
+        if eventos & selectors.EVENT_READ and self.leyendo:
+            self.al_leer()
+
+    def encolar(self, trama):
+        if self.cerrado or self.fallido:
+            return False
+        if not self._agregar(trama):
+            # Desborde con política de desconexión
+            self.fallido = True
+            self._despertar_lector()
+            return False
+        self.reactor.por_escribir(self)
+        return True
+
+    def cerrar(self):
+        """Deja de leer y cierra el socket después de enviar lo pendiente."""
+        if self.cerrado:
+            return
+        self.cerrado = True
+        self.leyendo = False
+        self.vaciar()
+
+    def cortar(self):
+        """
+        Desconecta al cliente desde el servidor: el lector ve fin de datos
+        y termina como en cualquier desconexión. Si el cliente no lee lo
+        pendiente, se cierra igual después de comun.ESPERA_CORTE.
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        self.reactor.llamar_en(comun.ESPERA_CORTE, self._abortar)
+
+    def _despertar_lector(self):
+        """Corta el socket para que el lector detecte la desconexión."""
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _abortar(self):
+        if self.conn.fileno() >= 0:
+            self.fallido = True
+            self._vaciar()
+            self._cerrar_socket()
+
+    def _cerrar_socket(self):
+        self.reactor.quitar(self.conn)
+        self.conn.close()
+
+    def _enviar(self, vistas):
+        if hasattr(self.conn, "sendmsg"):
+            return self.conn.sendmsg(vistas)
+        return self.conn.send(b"".join(vistas))
+
+    def vaciar(self):
+        """Escribe sin bloquear todo lo que el socket acepte."""
+        if self.conn.fileno() < 0:
+            return
+        try:
+            while not self.fallido:
+                if not self.vistas:
+                    if self.lote:
+                        self._enviadas(self.lote)
+                        self.lote = []
+                    if not self.cola:
+                        break
+                    self.lote = self._sacar_lote(comun.LOTE_ESCRITURA)
+                    self.vistas = list(self.lote)
+                self.vistas = _descontar(self.vistas, self._enviar(self.vistas))
+                if self.vistas:
+                    break  # El socket no aceptó todo: esperar a que se pueda escribir
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.fallido = True
+            self._vaciar()
+            self._despertar_lector()
+
+        if self.fallido:
+            self.lote = []
+            self.vistas = []
+        pendiente = bool(self.vistas or self.cola)
+        if self.cerrado and not pendiente:
+            self._cerrar_socket()
+            return
+        eventos = selectors.EVENT_READ if self.leyendo else 0
+        if pendiente:
+            eventos |= selectors.EVENT_WRITE
+        self.reactor.modificar(self.conn, eventos)
+
+class EscritorUDP(ColaSalida):
+    """
+    Salida de un cliente UDP: cada trama es un datagrama a su dirección.
+
+    No hay cola: sendto() no espera al receptor y, si el buffer del kernel
+    se llena, el datagrama se pierde igual que en la red.
+    """
+
+    def __init__(self, sock, addr, formato=comun.FORMATO_JSON):
+        super().__init__()
+        self.sock = sock
+        self.addr = addr
+        self.formato = formato
+
+    def encolar(self, trama):
+        try:
+            self.sock.sendto(trama, self.addr)
+        except OSError:
+            self.tramas_descartadas += 1
+            self.bytes_descartados += len(trama)
+            return False
+        self._enviada(trama)
+        self.escrituras += 1
+        return True
+
+    def cerrar(self):
+        pass
+
+    def cortar(self):
+        pass  # Sin conexión: alcanza con quitarlo del registro
+
+class SalidaUDPEnLote:
+    """
+    Envoltorio del socket UDP del servidor que junta los envíos.
+
+    Tiene sendto() como el socket, así que EscritorUDP y responder() lo usan
+    sin cambios; los datagramas se guardan y se envían todos juntos con
+    vaciar() al terminar de procesar un lote de lecturas. El socket debe
+    estar en modo no bloqueante: si el buffer del kernel está lleno el
+    datagrama se descarta.
+
+    Las tramas pendientes pueden apuntar a los buffers de lectura, por eso
+    hay que vaciar antes de volver a leer en ellos. Solo el hilo que creó
+    el envoltorio junta envíos; desde otros hilos (el bus de trabajadores)
+    sendto() envía en el momento.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.hilo = threading.get_ident()
+        self.pendientes = []
+
+        # Contadores
+        self.datagramas_enviados = 0
+        self.datagramas_descartados = 0
+
+    def sendto(self, datos, addr):
+        if threading.get_ident() == self.hilo:
+            self.pendientes.append((datos, addr))
+            return
+        try:
+            self.sock.sendto(datos, addr)
+        except OSError:
+            self.datagramas_descartados += 1
+        else:
+            self.datagramas_enviados += 1
+
+    def vaciar(self):
+        """Envía los datagramas pendientes."""
+        sendto = self.sock.sendto
+        enviados = 0
+        for datos, addr in self.pendientes:
+            try:
+                sendto(datos, addr)
+                enviados += 1
+            except OSError:
+                self.datagramas_descartados += 1
+        self.datagramas_enviados += enviados
+        self.pendientes.clear()
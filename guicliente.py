@@ -5,8 +5,8 @@ Interfaz gráfica moderna con tkinter
 
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
-import socket
 import threading
+import collections
 import comun
 import time
 
@@ -34,12 +34,15 @@ class ClienteChat:
         
         # Variables de conexión
         self.sock = None
+        self.enlace = None  # comun.EnlaceUDP en UDP
         self.es_tcp = True
         self.nombre = ""
         self.host = "127.0.0.1"
         self.puerto = 5000
         self.conectado = False
         self.detener_hilo = False
+        self.sala_actual = comun.SALA_GENERAL  # Sala de los mensajes públicos
+        self.compresion = False  # El servidor aceptó comprimir (lo dice la bienvenida)
         
         # Crear interfaz inicial
         self.crear_interfaz_login()
@@ -181,18 +184,19 @@ class ClienteChat:
         frame_comandos.pack(fill="x", pady=(10, 0))
         
         tk.Label(frame_comandos, 
-                 text="Comandos: /p usuario mensaje (privado) | /salir (salir)", 
+                 text="Comandos: /p usuario mensaje (privado) | /unirse sala | /dejar sala | /salas | /historial [N] | /salir", 
                  font=("Segoe UI", 8), bg=COLOR_FONDO, fg="#666666").pack()
 
-    def agregar_mensaje(self, usuario, texto, tipo="PUBLICO", hora="--:--"):
+    def agregar_mensaje(self, usuario, texto, tipo="PUBLICO", hora="--:--", sala=None):
         """
         Agrega un mensaje al área de chat.
         
         Args:
             usuario: Nombre del usuario
             texto: Contenido del mensaje
-            tipo: Tipo de mensaje (PUBLICO, PRIVADO, SISTEMA, ERROR)
+            tipo: Tipo de mensaje (PUBLICO, PRIVADO, SISTEMA, SALAS, HISTORIAL, ERROR)
             hora: Hora del mensaje
+            sala: Sala de un mensaje público (no se muestra la general)
         """
         self.txt_chat.config(state=tk.NORMAL)
         
@@ -200,8 +204,8 @@ class ClienteChat:
         if tipo == "ERROR":
             display_text = f"[{hora}] [ERROR] {texto}"
             tag = "error"
-        elif tipo == "SISTEMA":
-            display_text = f"[{hora}] [SISTEMA] {texto}"
+        elif tipo in ("SISTEMA", "SALAS", "HISTORIAL"):
+            display_text = f"[{hora}] [{tipo}] {texto}"
             tag = "sistema"
         elif tipo == "PRIVADO":
             if usuario == self.nombre:
@@ -218,14 +222,11 @@ class ClienteChat:
                 # Mensaje privado recibido
                 display_text = f"[{hora}] [PRIVADO de {usuario}] {texto}"
             tag = "privado"
-        elif usuario == self.nombre:
-            # Mi mensaje público
-            display_text = f"[{hora}] {usuario}: {texto}"
-            tag = "propio"
         else:
-            # Mensaje público de otro
-            display_text = f"[{hora}] {usuario}: {texto}"
-            tag = "ajeno"
+            prefijo = f"#{sala} " if sala and sala != comun.SALA_GENERAL else ""
+            display_text = f"[{hora}] {prefijo}{usuario}: {texto}"
+            # Mi mensaje público o de otro
+            tag = "propio" if usuario == self.nombre else "ajeno"
         
         # Insertar mensaje
         self.txt_chat.insert(tk.END, display_text + "\n", tag)
@@ -262,13 +263,18 @@ class ClienteChat:
                 self.sock.connect((self.host, self.puerto))
             else:
                 self.sock = comun.crear_socket_udp()
+                self.enlace = comun.EnlaceUDP(self.sock, (self.host, self.puerto))
             
             # Enviar registro al servidor
-            registro = comun.empaquetar_mensaje("REGISTRO", self.nombre, "Conectándose...")
+            registro = comun.crear_mensaje("REGISTRO", self.nombre, "Conectándose...")
+            if comun.COMPRESION:
+                registro['compresion'] = comun.COMPRESION_ZLIB
+            registro = comun.serializar_mensaje(registro, comun.FORMATO_PREFERIDO)
+            self.compresion = False
             if self.es_tcp:
-                self.sock.send(registro)
+                self.sock.sendall(comun.enmarcar(registro))
             else:
-                self.sock.sendto(registro, (self.host, self.puerto))
+                self.enlace.enviar(registro)
             
             # Cambiar estado
             self.conectado = True
@@ -276,6 +282,7 @@ class ClienteChat:
             
             # Iniciar hilo para recibir mensajes
             threading.Thread(target=self.recibir_mensajes, daemon=True).start()
+            self.root.after(int(comun.INTERVALO_LATIDO * 1000), self.enviar_latido)
             
             # Cambiar a interfaz de chat
             self.crear_interfaz_chat()
@@ -295,24 +302,32 @@ class ClienteChat:
 
     def recibir_mensajes(self):
         """Hilo para recibir mensajes del servidor."""
+        # TCP: los mensajes llegan enmarcados y se reconstruyen incrementalmente
+        tramas = comun.leer_tramas(self.sock) if self.es_tcp else None
+        # La capa confiable (UDP) o un lote comprimido pueden traer varios
+        # mensajes juntos
+        pendientes = collections.deque()
+        
         while self.conectado and not self.detener_hilo:
             try:
-                if self.es_tcp:
+                if pendientes:
+                    datos = pendientes.popleft()
+                elif self.es_tcp:
                     # TCP: recv bloqueante
-                    datos = self.sock.recv(comun.BUFSIZE)
-                    if not datos:
+                    datos = next(tramas, None)
+                    if datos is None:
                         break  # Conexión cerrada
+                    pendientes.extend(comun.expandir(datos))
+                    continue
                 else:
-                    # UDP: recvfrom con timeout
-                    self.sock.settimeout(1.0)
+                    # UDP: espera con timeout (y reenvíos de la capa confiable)
                     try:
-                        datos, _ = self.sock.recvfrom(comun.BUFSIZE)
-                    except socket.timeout:
-                        continue  # Timeout, volver a intentar
+                        recibidos = self.enlace.recibir(1.0)
                     except:
                         break  # Error
-                    finally:
-                        self.sock.settimeout(None)
+                    for datos in recibidos:
+                        pendientes.extend(comun.expandir(datos))
+                    continue  # Si fue timeout, volver a intentar
 
                 # Procesar mensaje
                 msg = comun.desempaquetar_mensaje(datos)
@@ -327,10 +342,12 @@ class ClienteChat:
                             self.conectado = False
                             self.root.after(0, self.root.destroy)
                             break
+                    if msg['tipo'] == "SISTEMA" and msg.get('compresion') == comun.COMPRESION_ZLIB:
+                        self.compresion = True
                     
                     # Agregar mensaje a la interfaz
-                    self.root.after(0, lambda: self.agregar_mensaje(
-                        msg['usuario'], msg['contenido'], msg['tipo'], hora))
+                    self.root.after(0, lambda msg=msg, hora=hora: self.agregar_mensaje(
+                        msg['usuario'], msg['contenido'], msg['tipo'], hora, msg.get('destino')))
             
             except (ConnectionResetError, ConnectionAbortedError):
                 break
@@ -363,10 +380,32 @@ class ClienteChat:
         
         # Determinar tipo de mensaje
         tipo = "PUBLICO"
-        destino = None
+        destino = None if self.sala_actual == comun.SALA_GENERAL else self.sala_actual
         contenido = texto
         
-        if texto.startswith("/p "):
+        if texto.lower() == "/salas":
+            tipo = "SALAS"
+            destino = None
+        elif texto.lower() == "/historial" or texto.lower().startswith("/historial "):
+            tipo = "HISTORIAL"
+            contenido = texto[len("/historial"):].strip()
+            if contenido and not contenido.isdigit():
+                self.agregar_mensaje("SISTEMA", "Formato: /historial [N]", "ERROR")
+                return
+        elif texto.startswith(("/unirse ", "/dejar ")):
+            comando, _, sala = texto.partition(" ")
+            sala = sala.strip()
+            if not sala:
+                self.agregar_mensaje("SISTEMA", f"Formato: {comando} sala", "ERROR")
+                return
+            tipo = "UNIRSE" if comando == "/unirse" else "SALIR"
+            destino = sala
+            contenido = ""
+            if tipo == "UNIRSE":
+                self.sala_actual = sala
+            elif sala == self.sala_actual:
+                self.sala_actual = comun.SALA_GENERAL
+        elif texto.startswith("/p "):
             partes = texto.split(" ", 2)
             if len(partes) >= 3:
                 tipo = "PRIVADO"
@@ -380,19 +419,36 @@ class ClienteChat:
         else:
             # Mostrar mensaje público inmediatamente
             hora_actual = time.strftime("%H:%M")
-            self.agregar_mensaje(self.nombre, contenido, "PUBLICO", hora_actual)
+            self.agregar_mensaje(self.nombre, contenido, "PUBLICO", hora_actual, destino)
         
         # Empacar y enviar mensaje
-        paquete = comun.empaquetar_mensaje(tipo, self.nombre, contenido, destino)
+        paquete = comun.empaquetar_mensaje(tipo, self.nombre, contenido, destino,
+                                           formato=comun.FORMATO_PREFERIDO)
+        if self.compresion:
+            paquete = comun.comprimir(paquete)
         
         try:
             if self.es_tcp:
-                self.sock.send(paquete)
+                self.sock.sendall(comun.enmarcar(paquete))
             else:
-                self.sock.sendto(paquete, (self.host, self.puerto))
+                self.enlace.enviar(paquete)
         except Exception as e:
             self.agregar_mensaje("SISTEMA", f"Error al enviar mensaje: {str(e)}", "ERROR")
             
+    def enviar_latido(self):
+        """Avisa al servidor que el cliente sigue activo y se vuelve a programar."""
+        if not self.conectado:
+            return
+        latido = comun.empaquetar_mensaje("LATIDO", self.nombre, "", formato=comun.FORMATO_PREFERIDO)
+        try:
+            if self.es_tcp:
+                self.sock.sendall(comun.enmarcar(latido))
+            else:
+                self.enlace.enviar(latido)
+        except OSError:
+            pass  # El hilo receptor informa la desconexión
+        self.root.after(int(comun.INTERVALO_LATIDO * 1000), self.enviar_latido)
+
     def desconectar(self):
         """Desconecta del servidor y cierra la aplicación."""
         self.conectado = False
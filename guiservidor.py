@@ -38,10 +38,12 @@ class ServidorGUI:
         
         # Variables del servidor
         self.servidor = None
+        self.capa = None  # comun.CapaConfiable del servidor UDP
         self.es_tcp = True
         self.protocolo = "TCP"
         self.clientes = {}
-        self.lock = threading.Lock()
+        # RLock: procesar_mensaje llama a broadcast con el lock tomado
+        self.lock = threading.RLock()
         self.en_ejecucion = False
         self.hilos_clientes = []
         self.detener_hilos = False
@@ -103,7 +105,7 @@ class ServidorGUI:
         stats_grid.pack(pady=10)
         
         # Clientes conectados
-        self.lbl_clientes = tk.Label(stats_grid, text="👥 Clientes: 0/5", 
+        self.lbl_clientes = tk.Label(stats_grid, text=f"👥 Clientes: 0/{comun.MAX_CLIENTES}", 
                                     font=FONT_BOLD, bg="#111111", fg=COLOR_TEXTO)
         self.lbl_clientes.grid(row=0, column=0, padx=20, pady=5)
         
@@ -301,6 +303,7 @@ class ServidorGUI:
             else:
                 self.servidor = comun.crear_socket_udp()
                 self.servidor.bind((comun.HOST, comun.PORT))
+                self.capa = comun.CapaConfiable(self.servidor)
                 
                 self.log(f"Servidor UDP iniciado en {comun.HOST}:{comun.PORT}", "sistema")
                 
@@ -364,7 +367,8 @@ class ServidorGUI:
         try:
             # Primer mensaje debe ser REGISTRO
             conn.settimeout(5.0)  # Timeout para registro
-            datos = conn.recv(comun.BUFSIZE)
+            tramas = comun.leer_tramas(conn)
+            datos = next(tramas, None)
             
             if not datos:
                 conn.close()
@@ -384,13 +388,13 @@ class ServidorGUI:
             with self.lock:
                 if usuario in self.clientes:
                     error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", "Nombre en uso.")
-                    conn.send(error_msg)
+                    conn.sendall(comun.enmarcar(error_msg))
                     conn.close()
                     return
                 
                 if len(self.clientes) >= comun.MAX_CLIENTES:
                     error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", "Sala llena.")
-                    conn.send(error_msg)
+                    conn.sendall(comun.enmarcar(error_msg))
                     conn.close()
                     return
                 
@@ -400,7 +404,7 @@ class ServidorGUI:
             # Enviar confirmación
             confirmacion = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
                                                   f"Bienvenido {usuario}!")
-            conn.send(confirmacion)
+            conn.sendall(comun.enmarcar(confirmacion))
             
             # Notificar a otros usuarios
             sistema_msg = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
@@ -411,18 +415,14 @@ class ServidorGUI:
             conn.settimeout(None)
             
             # Bucle principal para recibir mensajes
-            while self.en_ejecucion and not self.detener_hilos:
-                try:
-                    datos = conn.recv(comun.BUFSIZE)
-                    if not datos:
+            try:
+                for datos in tramas:
+                    if not self.en_ejecucion or self.detener_hilos:
                         break
                     
                     self.procesar_mensaje(datos, addr, conn)
-                    
-                except socket.timeout:
-                    continue
-                except:
-                    break
+            except:
+                pass
                 
         except socket.timeout:
             self.log(f"Timeout en conexión TCP: {addr}", "error")
@@ -448,12 +448,19 @@ class ServidorGUI:
                 pass
     
     def manejar_udp(self):
-        """Maneja mensajes UDP."""
+        """
+        Maneja mensajes UDP a través de la capa confiable, como servidor.py:
+        rearma fragmentos, confirma lo recibido y la espera del socket se
+        acota al próximo reenvío pendiente.
+        """
         while self.en_ejecucion and not self.detener_hilos:
             try:
-                datos, addr = self.servidor.recvfrom(comun.BUFSIZE)
-                self.procesar_mensaje(datos, addr, None)
-            except socket.timeout:
+                self.servidor.settimeout(self.capa.revisar())
+                datos, addr = self.servidor.recvfrom(comun.TAM_DATAGRAMA_MAX)
+                for mensaje in self.capa.recibir(datos, addr):
+                    self.procesar_mensaje(mensaje, addr, None)
+                self.capa.enviar_acks()
+            except (socket.timeout, BlockingIOError):
                 continue
             except:
                 break
@@ -473,12 +480,12 @@ class ServidorGUI:
             if tipo == "REGISTRO" and not self.es_tcp:
                 if usuario in self.clientes:
                     error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", "Nombre en uso.")
-                    self.servidor.sendto(error_msg, addr)
+                    self.capa.sendto(error_msg, addr)
                     return
                 
                 if len(self.clientes) >= comun.MAX_CLIENTES:
                     error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", "Sala llena.")
-                    self.servidor.sendto(error_msg, addr)
+                    self.capa.sendto(error_msg, addr)
                     return
                 
                 self.clientes[usuario] = {"addr": addr, "last_seen": time.time()}
@@ -487,7 +494,7 @@ class ServidorGUI:
                 # Enviar confirmación
                 confirmacion = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
                                                       f"Bienvenido {usuario}!")
-                self.servidor.sendto(confirmacion, addr)
+                self.capa.sendto(confirmacion, addr)
                 
                 # Notificar a otros
                 sistema_msg = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
@@ -520,10 +527,40 @@ class ServidorGUI:
                 else:
                     error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", 
                                                        f"Usuario {destino} no existe.")
-                    if self.es_tcp and conn:
-                        conn.send(error_msg)
-                    else:
-                        self.servidor.sendto(error_msg, addr)
+                    self.responder(error_msg, addr, conn)
+            
+            # SALAS: este servidor solo tiene la sala general
+            elif tipo == "SALAS":
+                respuesta = comun.empaquetar_mensaje("SALAS", "SERVER", 
+                                                   f"Salas: {comun.SALA_GENERAL} ({len(self.clientes)})")
+                self.responder(respuesta, addr, conn)
+            
+            elif tipo in ("UNIRSE", "SALIR"):
+                sala = msg.get('destino') or ""
+                if tipo == "UNIRSE" and sala == comun.SALA_GENERAL:
+                    texto = f"Estás en la sala {sala} ({len(self.clientes)} miembros)."
+                    respuesta = comun.empaquetar_mensaje("SISTEMA", "SERVER", texto, sala)
+                else:
+                    respuesta = comun.empaquetar_mensaje("ERROR", "SERVER", 
+                                                       f"Salas no soportadas en este servidor (solo {comun.SALA_GENERAL}).")
+                self.responder(respuesta, addr, conn)
+            
+            elif tipo == "HISTORIAL":
+                error_msg = comun.empaquetar_mensaje("ERROR", "SERVER", 
+                                                   "Historial no soportado en este servidor.")
+                self.responder(error_msg, addr, conn)
+            
+            # LATIDO: basta con la actualización de last_seen de arriba
+    
+    def responder(self, datos, addr, conn=None):
+        """Envía un mensaje del servidor a quien hizo la petición."""
+        try:
+            if self.es_tcp and conn:
+                conn.sendall(comun.enmarcar(datos))
+            else:
+                self.capa.sendto(datos, addr)
+        except:
+            pass
     
     def enviar_mensaje(self, datos, destino):
         """Envía un mensaje a un cliente específico."""
@@ -532,22 +569,25 @@ class ServidorGUI:
                 if destino in self.clientes:
                     info = self.clientes[destino]
                     if self.es_tcp:
-                        info['conn'].send(datos)
+                        info['conn'].sendall(comun.enmarcar(datos))
                     else:
-                        self.servidor.sendto(datos, info['addr'])
+                        self.capa.sendto(datos, info['addr'])
         except:
             pass
     
     def broadcast(self, datos, excepto=None):
         """Envía un mensaje a todos los clientes excepto al especificado."""
+        # En TCP se enmarca una sola vez para todos los destinatarios
+        trama = comun.enmarcar(datos) if self.es_tcp else datos
+        
         with self.lock:
-            for usuario, info in self.clientes.items():
+            for usuario, info in list(self.clientes.items()):
                 if usuario != excepto:
                     try:
                         if self.es_tcp:
-                            info['conn'].send(datos)
+                            info['conn'].sendall(trama)
                         else:
-                            self.servidor.sendto(datos, info['addr'])
+                            self.capa.sendto(trama, info['addr'])
                     except:
                         # Eliminar cliente si hay error
                         if usuario in self.clientes:
@@ -610,6 +650,9 @@ class ServidorGUI:
 
 
 if __name__ == "__main__":
+    # Capacidad, puerto, etc. desde chat.ini / variables CHAT_*
+    comun.cargar_configuracion()
+    
     root = tk.Tk()
     app = ServidorGUI(root)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
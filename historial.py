@@ -0,0 +1,318 @@
+"""
+Historial persistente de mensajes del servidor de chat
+Registro en disco de solo agregado, dividido en segmentos, con índices
+dispersos por número de mensaje, hora, sala y autor. Las lecturas usan
+mmap y solo toman el lock para copiar el estado, así una consulta larga
+no frena a los que escriben
+"""
+
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import comun
+
+# --- FORMATO EN DISCO ---
+# Cada segmento es un archivo <número del primer mensaje>.log con registros
+# seguidos, todos con la misma cabecera:
+# [largo del registro 4][número 8][ms 8][largo sala 2][largo autor 2]
+# [sala][autor][mensaje serializado]
+# Sala y autor van aparte para filtrar sin deserializar el mensaje.
+CABECERA = struct.Struct("!IQQHH")
+EXTENSION = ".log"
+
+INDICE_CADA = 64  # Un punto del índice disperso cada tantos registros
+
+class Segmento:
+    """
+    Un archivo del historial y su índice disperso: cada INDICE_CADA
+    registros se anotan el número, la hora (ms) y la posición.
+    """
+
+    __slots__ = ("base", "ruta", "fd", "tamano", "numeros", "marcas", "posiciones", "mapa")
+
+    def __init__(self, base, ruta, fd):
+        self.base = base
+        self.ruta = ruta
+        self.fd = fd  # None una vez cerrado (solo se lee por su mapa)
+        self.tamano = 0
+        self.numeros = []
+        self.marcas = []
+        self.posiciones = []
+        self.mapa = None
+
+    def indexar(self, numero, ms, posicion):
+        if (numero - self.base) % INDICE_CADA == 0:
+            self.numeros.append(numero)
+            self.marcas.append(ms)
+            self.posiciones.append(posicion)
+
+    def mapear(self):
+        """
+        Devuelve un mmap que cubre todo lo escrito. Se llama con el lock
+        del historial tomado, así el archivo no se cierra mientras tanto.
+        """
+        if self.tamano and (self.mapa is None or len(self.mapa) < self.tamano):
+            self.mapa = mmap.mmap(self.fd, self.tamano, access=mmap.ACCESS_READ)
+        return self.mapa
+
+class IndiceClave:
+    """
+    Índice disperso de una sala ("#sala") o un autor ("@autor"): el número
+    de uno de cada INDICE_CADA mensajes de la clave.
+    """
+
+    __slots__ = ("total", "muestras", "descartadas")
+
+    def __init__(self):
+        self.total = 0        # Mensajes de la clave desde que existe el historial
+        self.muestras = []    # muestras[i] = número del mensaje (descartadas + i) * INDICE_CADA
+        self.descartadas = 0  # Muestras que apuntaban a segmentos ya borrados
+
+    def agregar(self, numero):
+        if self.total % INDICE_CADA == 0:
+            self.muestras.append(numero)
+        self.total += 1
+
+    def inicio_de_ultimos(self, cantidad):
+        """
+        Returns:
+            int: Número desde el que hay que leer para encontrar los
+            últimos "cantidad" mensajes de la clave (0 si no se sabe)
+        """
+        i = max(0, self.total - cantidad) // INDICE_CADA - self.descartadas
+        return self.muestras[i] if 0 <= i < len(self.muestras) else 0
+
+    def recortar(self, primero):
+        """Olvida las muestras anteriores al mensaje "primero"."""
+        n = bisect.bisect_left(self.muestras, primero)
+        if n:
+            del self.muestras[:n]
+            self.descartadas += n
+
+class Historial:
+    """
+    Historial de mensajes en un directorio.
+
+    agregar() escribe cada mensaje al final del segmento activo con un
+    solo os.write(); al superar tam_segmento se empieza otro archivo y se
+    borran los más viejos si hay más de max_segmentos.
+
+    Al abrirse se reconstruyen los índices leyendo los segmentos que ya
+    existen; un último registro incompleto (caída a mitad de escritura)
+    se descarta.
+    """
+
+    def __init__(self, directorio, tam_segmento=None, max_segmentos=None):
+        self.directorio = directorio
+        self.tam_segmento = tam_segmento or comun.HISTORIAL_SEGMENTO
+        self.max_segmentos = max_segmentos or comun.HISTORIAL_SEGMENTOS
+        self.lock = threading.Lock()
+        self.segmentos = []
+        self.bases = []  # base de cada segmento, para bisect
+        self.claves = {}
+        self.siguiente = 0  # Número del próximo mensaje
+        os.makedirs(directorio, exist_ok=True)
+        self._cargar()
+
+    # --- ESCRITURA ---
+
+    def _abrir_segmento(self, base):
+        ruta = os.path.join(self.directorio, f"{base:020d}{EXTENSION}")
+        fd = os.open(ruta, os.O_RDWR | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0))
+        segmento = Segmento(base, ruta, fd)
+        self.segmentos.append(segmento)
+        self.bases.append(base)
+        return segmento
+
+    def _cerrar_segmento(self, segmento):
+        """Deja el segmento solo para lectura: su mapa cubre el archivo entero."""
+        segmento.mapear()
+        os.close(segmento.fd)
+        segmento.fd = None
+
+    def _indexar(self, segmento, numero, ms, posicion, sala, autor):
+        segmento.indexar(numero, ms, posicion)
+        for clave in ("#" + sala, "@" + autor):
+            indice = self.claves.get(clave)
+            if indice is None:
+                indice = self.claves[clave] = IndiceClave()
+            indice.agregar(numero)
+
+    def agregar(self, sala, autor, datos):
+        """
+        Guarda un mensaje.
+
+        Args:
+            sala: Sala del mensaje
+            autor: Usuario que lo envió
+            datos: Mensaje serializado (bytes o memoryview)
+
+        Returns:
+            int: Número asignado al mensaje
+        """
+        sala_b = sala.encode(comun.CODIFICACION)
+        autor_b = autor.encode(comun.CODIFICACION)
+        largo = CABECERA.size + len(sala_b) + len(autor_b) + len(datos)
+
+        with self.lock:
+            numero = self.siguiente
+            ms = int(time.time() * 1000)
+            registro = b"".join((CABECERA.pack(largo, numero, ms, len(sala_b), len(autor_b)),
+                                 sala_b, autor_b, datos))
+
+            segmento = self.segmentos[-1] if self.segmentos else None
+            if segmento is None or (segmento.tamano and segmento.tamano + largo > self.tam_segmento):
+                if segmento is not None:
+                    self._cerrar_segmento(segmento)
+                segmento = self._abrir_segmento(numero)
+                self._rotar()
+
+            os.write(segmento.fd, registro)
+            self._indexar(segmento, numero, ms, segmento.tamano, sala, autor)
+            segmento.tamano += largo
+            self.siguiente = numero + 1
+        return numero
+
+    def _rotar(self):
+        """Borra los segmentos más viejos que exceden max_segmentos."""
+        while len(self.segmentos) > self.max_segmentos:
+            viejo = self.segmentos.pop(0)
+            self.bases.pop(0)
+            try:
+                os.remove(viejo.ruta)
+            except OSError:
+                pass  # Windows no borra un archivo mapeado; queda para después
+        primero = self.bases[0]
+        for indice in self.claves.values():
+            indice.recortar(primero)
+
+    def _cargar(self):
+        """Abre los segmentos existentes y reconstruye los índices."""
+        bases = sorted(int(nombre[:-len(EXTENSION)]) for nombre in os.listdir(self.directorio)
+                       if nombre.endswith(EXTENSION) and nombre[:-len(EXTENSION)].isdigit())
+        for base in bases:
+            if self.segmentos:
+                self._cerrar_segmento(self.segmentos[-1])
+            segmento = self._abrir_segmento(base)
+            segmento.tamano = os.fstat(segmento.fd).st_size
+            valido = 0
+            if segmento.tamano:
+                mapa = segmento.mapear()
+                for numero, ms, sala, autor, posicion, largo in _registros(mapa, 0, segmento.tamano):
+                    self._indexar(segmento, numero, ms, posicion,
+                                  str(sala, comun.CODIFICACION), str(autor, comun.CODIFICACION))
+                    self.siguiente = numero + 1
+                    valido = posicion + largo
+            if valido < segmento.tamano:
+                # Registro incompleto al final: se descarta
+                segmento.mapa = None
+                os.ftruncate(segmento.fd, valido)
+                segmento.tamano = valido
+
+    # --- LECTURA ---
+
+    def _instantanea(self, desde):
+        """
+        Copia, con el lock tomado, lo necesario para leer sin él.
+
+        Returns:
+            tuple: (lista de (segmento, mapa, tamano) desde el que contiene
+            el mensaje "desde", número del próximo mensaje)
+        """
+        with self.lock:
+            i = max(0, bisect.bisect_right(self.bases, desde) - 1)
+            vistas = [(s, s.mapear(), s.tamano) for s in self.segmentos[i:] if s.tamano]
+            return vistas, self.siguiente
+
+    def _recorrer(self, desde, sala=None, autor=None, desde_ms=0):
+        """
+        Genera (número, datos) de los mensajes con número >= desde y hora
+        >= desde_ms, de la sala y el autor indicados.
+        """
+        sala_b = sala.encode(comun.CODIFICACION) if sala is not None else None
+        autor_b = autor.encode(comun.CODIFICACION) if autor is not None else None
+        vistas, _ = self._instantanea(desde)
+
+        for segmento, mapa, tamano in vistas:
+            # Saltar con el índice disperso al punto anterior más cercano
+            j = bisect.bisect_right(segmento.numeros, desde) - 1
+            if desde_ms:
+                j = max(j, bisect.bisect_left(segmento.marcas, desde_ms) - 1)
+            posicion = segmento.posiciones[j] if j >= 0 else 0
+
+            for numero, ms, s, a, posicion, largo in _registros(mapa, posicion, tamano):
+                if numero < desde or ms < desde_ms:
+                    continue
+                if sala_b is not None and s != sala_b:
+                    continue
+                if autor_b is not None and a != autor_b:
+                    continue
+                inicio = posicion + CABECERA.size + len(s) + len(a)
+                yield numero, mapa[inicio:posicion + largo]
+
+    def ultimos(self, sala, cantidad, autor=None):
+        """
+        Devuelve los últimos mensajes de una sala (y de un autor, si se indica).
+
+        Returns:
+            tuple: (lista de (número, datos) en orden, cursor para pedir
+            los que lleguen después)
+        """
+        indice = self.claves.get("@" + autor if autor is not None else "#" + sala)
+        if indice is None or cantidad <= 0:
+            return [], self.siguiente
+        cursor = self.siguiente
+        # Con autor el índice es el del autor: si sus mensajes en otras salas
+        # dejan menos de "cantidad", se vuelve a leer desde más atrás
+        ventana = cantidad
+        while True:
+            inicio = indice.inicio_de_ultimos(ventana)
+            encontrados = collections.deque(maxlen=cantidad)
+            for numero, datos in self._recorrer(inicio, sala, autor):
+                if numero >= cursor:
+                    break
+                encontrados.append((numero, datos))
+            if len(encontrados) == cantidad or inicio <= self.bases[0] or ventana >= indice.total:
+                return list(encontrados), cursor
+            ventana *= 2
+
+    def desde(self, sala, cursor=0, cantidad=None, autor=None, desde_ms=0):
+        """
+        Devuelve los mensajes de una sala a partir de un cursor (número de
+        mensaje) o de una hora en ms, hasta "cantidad".
+
+        Returns:
+            tuple: (lista de (número, datos) en orden, cursor para seguir)
+        """
+        if cantidad is None:
+            cantidad = comun.MAX_HISTORIAL
+        if cantidad <= 0:
+            return [], cursor
+        fin = self.siguiente
+        encontrados = []
+        for numero, datos in self._recorrer(cursor, sala, autor, desde_ms):
+            if numero >= fin:
+                break
+            encontrados.append((numero, datos))
+            if len(encontrados) == cantidad:
+                return encontrados, numero + 1
+        return encontrados, fin
+
+def _registros(mapa, posicion, tamano):
+    """
+    Genera (número, ms, sala, autor, posición, largo) de cada registro
+    completo entre posicion y tamano. Sala y autor van como bytes.
+    """
+    while posicion + CABECERA.size <= tamano:
+        largo, numero, ms, largo_sala, largo_autor = CABECERA.unpack_from(mapa, posicion)
+        if largo < CABECERA.size + largo_sala + largo_autor or posicion + largo > tamano:
+            return
+        inicio = posicion + CABECERA.size
+        sala = mapa[inicio:inicio + largo_sala]
+        autor = mapa[inicio + largo_sala:inicio + largo_sala + largo_autor]
+        yield numero, ms, sala, autor, posicion, largo
+        posicion += largo
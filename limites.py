@@ -0,0 +1,119 @@
+"""
+Límites de tráfico del servidor de chat
+Cubetas de fichas (token buckets) de mensajes y bytes por segundo, por
+usuario y por IP de origen, para que un solo cliente no sature la
+difusión de todos
+"""
+
+import collections
+import threading
+import time
+
+MAX_IPS = 65536  # IPs con cubeta propia; se olvidan las menos recientes
+
+class Limite:
+    """
+    Tasas de una clase de cubetas: mensajes y bytes por segundo (0 = sin
+    límite en esa medida) y segundos de tráfico que se pueden juntar para
+    una ráfaga.
+    """
+
+    __slots__ = ("tasa_mensajes", "tasa_bytes", "rafaga")
+
+    def __init__(self, tasa_mensajes, tasa_bytes, rafaga):
+        self.tasa_mensajes = tasa_mensajes
+        self.tasa_bytes = tasa_bytes
+        self.rafaga = rafaga
+
+    def activo(self):
+        return self.tasa_mensajes > 0 or self.tasa_bytes > 0
+
+class Cubeta:
+    """
+    Fichas de mensajes y de bytes de un usuario o una IP.
+
+    Se llenan a la tasa del Limite hasta "rafaga" segundos de tráfico. Un
+    mensaje pasa si queda al menos una ficha de cada medida; las de bytes
+    pueden quedar en negativo, así un mensaje más grande que la ráfaga
+    pasa igual y los siguientes esperan a que se pague.
+    """
+
+    __slots__ = ("limite", "mensajes", "bytes", "marca", "excedida")
+
+    def __init__(self, limite, ahora=None):
+        self.limite = limite
+        self.mensajes = limite.tasa_mensajes * limite.rafaga
+        self.bytes = limite.tasa_bytes * limite.rafaga
+        self.marca = time.monotonic() if ahora is None else ahora
+        self.excedida = False  # El último mensaje se rechazó (para avisar una sola vez)
+
+    def tomar(self, tamano, ahora):
+        """
+        Gasta las fichas de un mensaje de "tamano" bytes, si alcanzan.
+
+        Returns:
+            str: None si el mensaje pasa; "mensajes" o "bytes" según qué
+            límite se superó
+        """
+        limite = self.limite
+        transcurrido = ahora - self.marca
+        self.marca = ahora
+        if limite.tasa_mensajes > 0:
+            self.mensajes = min(self.mensajes + transcurrido * limite.tasa_mensajes,
+                                limite.tasa_mensajes * limite.rafaga)
+            if self.mensajes < 1:
+                return "mensajes"
+        if limite.tasa_bytes > 0:
+            self.bytes = min(self.bytes + transcurrido * limite.tasa_bytes, limite.tasa_bytes * limite.rafaga)
+            if self.bytes <= 0:
+                return "bytes"
+            self.bytes -= tamano
+        if limite.tasa_mensajes > 0:
+            self.mensajes -= 1
+        return None
+
+    def cobrar(self, tamano):
+        """
+        Gasta "tamano" bytes más del último mensaje sin controlarlos (por
+        ejemplo lo que creció al descomprimirse): pueden quedar en negativo
+        y los mensajes siguientes esperan a que se paguen.
+        """
+        if self.limite.tasa_bytes > 0:
+            self.bytes -= tamano
+
+class LimitadorIP:
+    """
+    Cubetas por IP de origen, compartidas por todas las conexiones (TCP) o
+    direcciones (UDP) de esa IP. Se guardan a lo sumo max_ips (LRU): una
+    IP olvidada vuelve con la cubeta llena, que es lo que tendría tras
+    tanto tiempo sin enviar.
+    """
+
+    def __init__(self, limite, max_ips=MAX_IPS):
+        self.limite = limite
+        self.max_ips = max_ips
+        self.cubetas = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cubetas)
+
+    def tomar(self, ip, tamano, ahora=None):
+        """Como Cubeta.tomar para la cubeta de la IP."""
+        ahora = time.monotonic() if ahora is None else ahora
+        with self.lock:
+            cubeta = self.cubetas.get(ip)
+            if cubeta is None:
+                cubeta = self.cubetas[ip] = Cubeta(self.limite, ahora)
+                if len(self.cubetas) > self.max_ips:
+                    self.cubetas.popitem(last=False)
+            else:
+                self.cubetas.move_to_end(ip)
+            return cubeta.tomar(tamano, ahora)
+
+    def cobrar(self, ip, tamano):
+        """Como Cubeta.cobrar para la cubeta de la IP (si la tiene)."""
+        with self.lock:
+            cubeta = self.cubetas.get(ip)
+            if cubeta is not None:
+                cubeta.cobrar(tamano)
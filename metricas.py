@@ -0,0 +1,156 @@
+"""
+Métricas del servidor de chat
+Contadores, histogramas y medidores expuestos por HTTP en el formato de
+texto de Prometheus (GET /metrics)
+"""
+
+import bisect
+import http.server
+import threading
+
+# Límites de los histogramas de latencia, en segundos
+LIMITES_LATENCIA = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+# Métricas registradas, en el orden en que se exponen
+registradas = []
+
+def _formatear_valor(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+def _etiquetas(nombre, valor):
+    return f'{{{nombre}="{valor}"}}' if nombre else ""
+
+class Contador:
+    """
+    Contador que solo aumenta, opcionalmente separado por una etiqueta.
+
+    Ejemplo: mensajes.inc(etiqueta="PUBLICO")
+    """
+
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiqueta=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self.valores = {}
+        self.lock = threading.Lock()
+        registradas.append(self)
+
+    def inc(self, valor=1, etiqueta=None):
+        with self.lock:
+            self.valores[etiqueta] = self.valores.get(etiqueta, 0) + valor
+
+    def muestras(self):
+        with self.lock:
+            valores = list(self.valores.items())
+        return [(self.nombre + _etiquetas(self.etiqueta, e if e is not None else ""), v)
+                for e, v in valores]
+
+class Histograma:
+    """
+    Distribución de valores (latencias en segundos) en cubetas acumulativas.
+    """
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, limites=LIMITES_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.limites = limites
+        self.cubetas = [0] * (len(limites) + 1)  # La última es +Inf
+        self.suma = 0.0
+        self.cantidad = 0
+        self.lock = threading.Lock()
+        registradas.append(self)
+
+    def observar(self, valor):
+        i = bisect.bisect_left(self.limites, valor)
+        with self.lock:
+            self.cubetas[i] += 1
+            self.suma += valor
+            self.cantidad += 1
+
+    def muestras(self):
+        with self.lock:
+            cubetas = list(self.cubetas)
+            suma, cantidad = self.suma, self.cantidad
+        muestras = []
+        acumulado = 0
+        for limite, n in zip(self.limites + (float("inf"),), cubetas):
+            acumulado += n
+            muestras.append((f'{self.nombre}_bucket{{le="{_formatear_valor(limite)}"}}', acumulado))
+        muestras.append((f"{self.nombre}_sum", suma))
+        muestras.append((f"{self.nombre}_count", cantidad))
+        return muestras
+
+class Medidor:
+    """
+    Valor que se calcula al exponer las métricas (profundidad de colas,
+    clientes conectados, contadores que ya lleva otro módulo...).
+
+    "funcion" devuelve un número, o un dict etiqueta -> número si se
+    indica "etiqueta".
+    """
+
+    def __init__(self, nombre, ayuda, funcion, etiqueta=None, tipo="gauge"):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        self.etiqueta = etiqueta
+        self.tipo = tipo
+        registradas.append(self)
+
+    def muestras(self):
+        valor = self.funcion()
+        if self.etiqueta is None:
+            return [(self.nombre, valor)]
+        return [(self.nombre + _etiquetas(self.etiqueta, e), v) for e, v in valor.items()]
+
+def exponer():
+    """
+    Returns:
+        str: Todas las métricas registradas en formato de texto de Prometheus
+    """
+    lineas = []
+    for metrica in registradas:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        for nombre, valor in metrica.muestras():
+            lineas.append(f"{nombre} {_formatear_valor(valor)}")
+    return "\n".join(lineas) + "\n"
+
+class ManejadorMetricas(http.server.BaseHTTPRequestHandler):
+    """Responde GET /metrics con exponer()."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = exponer().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", TIPO_CONTENIDO)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass  # Sin una línea de log por cada consulta
+
+def iniciar_servidor_http(host, puerto):
+    """
+    Sirve las métricas en http://host:puerto/metrics desde un hilo propio.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Servidor iniciado
+    """
+    servidor = http.server.ThreadingHTTPServer((host, puerto), ManejadorMetricas)
+    servidor.daemon_threads = True
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor
@@ -0,0 +1,196 @@
+"""
+Micro-benchmark de la serialización de comun
+Mide ns/op y memoria por operación de empaquetar_mensaje,
+desempaquetar_mensaje, serializar_mensaje y formatear_mensaje_para_mostrar
+para todos los tipos, formatos, tamaños y contenido ASCII o Unicode
+
+Uso:
+    python microbench.py
+    python microbench.py --filtro desempaquetar --salida micro.json
+"""
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import time
+import timeit
+import tracemalloc
+import comun
+
+# --- CASOS ---
+# Tamaños de contenido en bytes codificados, de un mensaje corto a casi
+# BUFSIZE (se deja lugar para el resto de los campos)
+TAMANOS = (8, 64, 512, comun.BUFSIZE - 256)
+TEXTO_ASCII = "Hola a todos, este es un mensaje de prueba. "
+TEXTO_UNICODE = "¡Hola! ñandú, canción, 漢字かな, Ελληνικά, emoji 😀🚀 "
+
+def contenido_de(tamano, unicode):
+    """
+    Returns:
+        str: Texto que ocupa como máximo "tamano" bytes en CODIFICACION
+    """
+    base = TEXTO_UNICODE if unicode else TEXTO_ASCII
+    texto = base * (tamano // len(base.encode(comun.CODIFICACION)) + 1)
+    while len(texto.encode(comun.CODIFICACION)) > tamano:
+        texto = texto[:-1]
+    return texto
+
+def generar_casos(filtro=None):
+    """
+    Genera (nombre, función) para cada combinación de operación, tipo,
+    formato, tamaño y texto.
+
+    Args:
+        filtro: Solo los casos cuyo nombre contenga este texto
+
+    Returns:
+        list: Casos a medir
+    """
+    casos = []
+    for tipo in comun.TIPOS_BINARIOS:
+        destino = "beto" if tipo == "PRIVADO" else None
+        for formato in (comun.FORMATO_JSON, comun.FORMATO_BINARIO):
+            for tamano in TAMANOS:
+                for unicode in (False, True):
+                    contenido = contenido_de(tamano, unicode)
+                    datos = comun.empaquetar_mensaje(tipo, "ana", contenido, destino, formato)
+                    msg = comun.desempaquetar_mensaje(datos)
+                    otro = (comun.FORMATO_BINARIO if formato == comun.FORMATO_JSON
+                            else comun.FORMATO_JSON)
+                    texto = "unicode" if unicode else "ascii"
+                    sufijo = f"{tipo}/{formato}/{tamano}B/{texto}"
+
+                    casos.append((f"empaquetar/{sufijo}",
+                                  lambda t=tipo, c=contenido, d=destino, f=formato:
+                                      comun.empaquetar_mensaje(t, "ana", c, d, f)))
+                    casos.append((f"desempaquetar/{sufijo}",
+                                  lambda d=datos: comun.desempaquetar_mensaje(d)))
+                    casos.append((f"serializar_a_{otro}/{sufijo}",
+                                  lambda m=msg, f=otro: comun.serializar_mensaje(m, f)))
+                    # El formateo no depende del formato de origen
+                    if formato == comun.FORMATO_JSON:
+                        casos.append((f"formatear/{tipo}/{tamano}B/{texto}",
+                                      lambda m=msg: comun.formatear_mensaje_para_mostrar(m)))
+
+    if filtro:
+        casos = [c for c in casos if filtro in c[0]]
+    return casos
+
+# --- MEDICIÓN ---
+
+def medir_tiempo(funcion, repeticiones, tiempo_min):
+    """
+    Mide el tiempo por operación.
+
+    Primero se calienta la función y se elige el número de iteraciones
+    para que cada repetición dure al menos tiempo_min segundos; luego se
+    mide "repeticiones" veces con el recolector de basura desactivado
+    (como timeit).
+
+    Returns:
+        dict: min, mediana y desviación estándar en ns/op, e iteraciones
+    """
+    temporizador = timeit.Timer(funcion)
+
+    # Calentamiento y calibración
+    iteraciones = 1
+    while True:
+        duracion = temporizador.timeit(iteraciones)
+        if duracion >= tiempo_min:
+            break
+        # Estimar cuántas iteraciones alcanzan tiempo_min (a lo sumo x10 por paso)
+        iteraciones = int(iteraciones * min(10.0, 1.2 * tiempo_min / max(duracion, 1e-9))) + 1
+
+    tiempos = [t / iteraciones * 1e9 for t in temporizador.repeat(repeticiones, iteraciones)]
+    return {
+        "min_ns": min(tiempos),
+        "mediana_ns": statistics.median(tiempos),
+        "desvio_ns": statistics.stdev(tiempos) if len(tiempos) > 1 else 0.0,
+        "iteraciones": iteraciones,
+    }
+
+def medir_memoria(funcion, operaciones=200):
+    """
+    Mide la memoria que pide cada operación con tracemalloc.
+
+    Returns:
+        dict: pico_bytes (memoria temporal máxima de una operación) y
+        bloques (bloques de memoria que quedan vivos por operación; el
+        resultado devuelto se descarta, así que debería ser 0)
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        funcion()
+        pico = 0
+        for _ in range(operaciones):
+            antes, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            funcion()
+            _, maximo = tracemalloc.get_traced_memory()
+            pico = max(pico, maximo - antes)
+
+        inicial = tracemalloc.take_snapshot()
+        for _ in range(operaciones):
+            funcion()
+        final = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    bloques = sum(d.count_diff for d in final.compare_to(inicial, "filename"))
+    return {"pico_bytes": pico, "bloques": bloques / operaciones}
+
+def ejecutar(casos, repeticiones, tiempo_min, memoria):
+    """
+    Mide todos los casos y muestra una línea por caso.
+
+    Returns:
+        list: Resultados por caso
+    """
+    resultados = []
+    ancho = max(len(nombre) for nombre, _ in casos)
+    for nombre, funcion in casos:
+        resultado = {"caso": nombre, **medir_tiempo(funcion, repeticiones, tiempo_min)}
+        linea = f"{nombre:<{ancho}}  {resultado['mediana_ns']:>9.0f} ns/op ±{resultado['desvio_ns']:.0f}"
+        if memoria:
+            resultado.update(medir_memoria(funcion))
+            linea += f"  {resultado['pico_bytes']:>7} B pico"
+        print(linea)
+        resultados.append(resultado)
+    return resultados
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark de la serialización de comun")
+    parser.add_argument("--filtro", help="Medir solo los casos que contengan este texto")
+    parser.add_argument("--repeticiones", type=int, default=7,
+                        help="Repeticiones por caso para las estadísticas")
+    parser.add_argument("--tiempo-min", type=float, default=0.05,
+                        help="Segundos mínimos de cada repetición")
+    parser.add_argument("--sin-memoria", action="store_true",
+                        help="No medir memoria (más rápido)")
+    parser.add_argument("--salida", help="Archivo JSON donde guardar los resultados")
+    args = parser.parse_args()
+
+    casos = generar_casos(args.filtro)
+    if not casos:
+        parser.error("Ningún caso coincide con el filtro")
+
+    resultados = ejecutar(casos, args.repeticiones, args.tiempo_min, not args.sin_memoria)
+
+    if args.salida:
+        informe = {
+            "fecha": time.strftime(comun.FORMATO_FECHA),
+            "python": platform.python_version(),
+            "sistema": platform.platform(),
+            "repeticiones": args.repeticiones,
+            "tiempo_min": args.tiempo_min,
+            "resultados": resultados,
+        }
+        with open(args.salida, "w", encoding=comun.CODIFICACION) as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+if __name__ == "__main__":
+    main()
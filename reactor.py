@@ -0,0 +1,142 @@
+"""
+Reactor de un solo hilo para el servidor de chat
+Bucle de eventos con selectors (epoll, kqueue o select según el sistema):
+cada socket registra la función que atiende sus eventos, los otros hilos
+le pasan tareas despertándolo con un socketpair y hay temporizadores
+simples, sin depender de asyncio
+"""
+
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import time
+import traceback
+
+LEER = selectors.EVENT_READ
+ESCRIBIR = selectors.EVENT_WRITE
+
+class Reactor:
+    """
+    Bucle de eventos de un hilo.
+
+    registrar(sock, eventos, funcion) hace que se llame funcion(eventos
+    listos) cuando el socket se pueda leer o escribir. Todo lo registrado
+    se usa solo desde el hilo del bucle; desde otros hilos se usa
+    llamar_desde_hilo(), que encola la tarea y escribe un byte en el
+    socketpair para despertar al select().
+
+    Los escritores con datos nuevos se anotan con por_escribir() y se
+    vacían una vez por vuelta, antes de volver a esperar: lo que se encoló
+    al atender varios eventos sale junto.
+
+    Una excepción en una función registrada, una tarea o un temporizador
+    no corta el bucle: se pasa a al_fallar(excepción) o, si no se indicó,
+    se imprime en stderr.
+    """
+
+    def __init__(self, al_fallar=None):
+        self.al_fallar = al_fallar
+        self.selector = selectors.DefaultSelector()
+        self.tareas = collections.deque()
+        self.temporizadores = []  # heap de (vence, orden, funcion, args)
+        self.orden = itertools.count()
+        self.escritores = {}  # Escritores con datos por escribir (dict como conjunto ordenado)
+        self._despertador, self._timbre = socket.socketpair()
+        self._despertador.setblocking(False)
+        self._timbre.setblocking(False)
+        self.registrar(self._despertador, LEER, self._despertado)
+
+    def registrar(self, sock, eventos, funcion):
+        self.selector.register(sock, eventos, funcion)
+
+    def modificar(self, sock, eventos):
+        """Cambia los eventos que se esperan de un socket ya registrado."""
+        clave = self.selector.get_key(sock)
+        if clave.events != eventos:
+            self.selector.modify(sock, eventos, clave.data)
+
+    def quitar(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def por_escribir(self, escritor):
+        """Anota un escritor para llamar a su vaciar() al final de la vuelta."""
+        self.escritores[escritor] = None
+
+    def llamar_en(self, segundos, funcion, *args):
+        """Programa funcion(*args) dentro de "segundos" (solo desde el hilo del bucle)."""
+        heapq.heappush(self.temporizadores,
+                       (time.monotonic() + segundos, next(self.orden), funcion, args))
+
+    def llamar_desde_hilo(self, funcion, *args):
+        """Encola funcion(*args) para el hilo del bucle; se puede usar desde cualquier hilo."""
+        self.tareas.append((funcion, args))
+        try:
+            self._timbre.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # El socketpair ya está lleno: el bucle se va a despertar igual
+
+    def _despertado(self, eventos):
+        try:
+            while self._despertador.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _llamar(self, funcion, *args):
+        try:
+            funcion(*args)
+        except Exception as e:
+            if self.al_fallar is not None:
+                self.al_fallar(e)
+            else:
+                traceback.print_exc()
+
+    def _correr_tareas(self):
+        for _ in range(len(self.tareas)):
+            funcion, args = self.tareas.popleft()
+            self._llamar(funcion, *args)
+
+    def _correr_vencidos(self):
+        ahora = time.monotonic()
+        while self.temporizadores and self.temporizadores[0][0] <= ahora:
+            _, _, funcion, args = heapq.heappop(self.temporizadores)
+            self._llamar(funcion, *args)
+
+    def _vaciar_escritores(self):
+        escritores = self.escritores
+        self.escritores = {}
+        for escritor in escritores:
+            self._llamar(escritor.vaciar)
+
+    def correr(self, revisar=None):
+        """
+        Atiende eventos sin fin (hasta una excepción de revisar() o que no
+        sea Exception, como KeyboardInterrupt).
+
+        Args:
+            revisar: Función que se llama en cada vuelta antes de esperar;
+                devuelve los segundos máximos hasta la próxima llamada (o
+                None si no le hace falta)
+        """
+        while True:
+            espera = revisar() if revisar is not None else None
+            self._vaciar_escritores()
+            if self.tareas or self.escritores:
+                espera = 0
+            elif self.temporizadores:
+                hasta = max(0.0, self.temporizadores[0][0] - time.monotonic())
+                espera = hasta if espera is None else min(espera, hasta)
+            for clave, eventos in self.selector.select(espera):
+                self._llamar(clave.data, eventos)
+            self._correr_tareas()
+            self._correr_vencidos()
+
+    def cerrar(self):
+        self.selector.close()
+        self._despertador.close()
+        self._timbre.close()
@@ -5,258 +5,799 @@ Maneja múltiples clientes, mensajes públicos y privados
 
 import socket
 import threading
-import sys
+import asyncio
+import argparse
+import os
+import select
 import comun
+import difusion
+import sesiones
+import trabajadores
+import metricas
+import bitacora
+import historial as historial_mensajes
+import limites
+import reactor
 import time
 
-# Estructura para guardar clientes conectados
-# TCP: {"nombre": {"addr": direccion, "conn": socket, "last_seen": timestamp}}
-# UDP: {"nombre": {"addr": direccion, "last_seen": timestamp}}
-clientes = {}
-lock = threading.Lock()
+# Clientes conectados (ver sesiones.py). Cada sesión guarda su escritor de
+# salida: EscritorHilo o EscritorAsyncio en TCP, EscritorUDP en UDP.
+clientes = sesiones.RegistroClientes()
+# Protege solo al registro: los envíos se hacen después de soltarlo
+lock = clientes.lock
+# Bus hacia los demás procesos en modo --workers (ver trabajadores.py)
+bus = None
+# Capa confiable del servidor UDP (ver comun.CapaConfiable), al arrancar en UDP
+capa_udp = None
+# Historial persistente de mensajes públicos (ver historial.py), si está activado
+historial = None
+# Últimas tramas de cada sala, para quien entra (se crea al arrancar el motor)
+recientes = None
+# Rueda de inactividad (ver sesiones.RuedaInactividad), salvo que esté desactivada
+inactividad = None
+# Límites de tráfico (ver limites.py): el de cada usuario y las cubetas por IP
+limite_usuario = None
+limites_ip = None
 
-def log(texto):
-    """Imprime log en consola con flush forzado para GUI."""
-    print(texto)
-    sys.stdout.flush()
+# --- MÉTRICAS ---
+# Expuestas en http://127.0.0.1:<metricas_puerto>/metrics (ver metricas.py)
+mensajes_recibidos = metricas.Contador("chat_mensajes_recibidos_total",
+                                       "Mensajes recibidos de los clientes", "tipo")
+bytes_recibidos = metricas.Contador("chat_bytes_recibidos_total",
+                                    "Bytes de mensajes recibidos de los clientes")
+registros = metricas.Contador("chat_registros_total",
+                              "Intentos de registro por resultado", "resultado")
+bajas = metricas.Contador("chat_bajas_total",
+                          "Usuarios dados de baja por motivo", "motivo")
+comprimidos_recibidos = metricas.Contador("chat_bytes_comprimidos_recibidos_total",
+                                          "Bytes de mensajes recibidos comprimidos (antes de descomprimir)")
+limitados = metricas.Contador("chat_limitados_total",
+                              "Mensajes descartados por superar un límite de tráfico", "limite")
+mensajes_enviados = metricas.Contador("chat_mensajes_enviados_total",
+                                      "Mensajes encolados para los clientes", "tipo")
+errores_envio = metricas.Contador("chat_errores_envio_total",
+                                  "Tramas que un escritor rechazó (cerrado o desbordado)")
+latencia_procesamiento = metricas.Histograma("chat_procesamiento_segundos",
+                                             "Tiempo de procesar un mensaje recibido")
+# Contadores de salida de los clientes que ya se fueron
+salida_cerrados = {}
+lock_salida_cerrados = threading.Lock()
 
-def enviar_a_cliente(datos, info_cliente, es_tcp, sock_servidor=None):
+def log(texto, nivel=bitacora.INFO, **campos):
     """
-    Envía datos a un cliente específico.
+    Agrega una línea a la bitácora del servidor.
+    
+    No escribe en el momento: un hilo de bitacora.py escribe por lotes, así
+    el log no frena la difusión aunque la consola o la GUI sean lentas.
     
     Args:
-        datos: Bytes a enviar
-        info_cliente: Información del cliente
-        es_tcp: True para TCP, False para UDP
-        sock_servidor: Socket del servidor (para UDP)
+        texto: Línea de log
+        nivel: bitacora.DEPURACION, INFO, AVISO o ERROR
+        **campos: Datos extra para el formato JSON
     """
-    try:
-        if es_tcp:
-            info_cliente['conn'].send(datos)
-        else:
-            if sock_servidor and 'addr' in info_cliente:
-                sock_servidor.sendto(datos, info_cliente['addr'])
-    except Exception as e:
-        log(f"Error enviando a cliente: {e}")
+    bitacora.registrar(nivel, texto, **campos)
+
+def enviar_a_cliente(trama, sesion):
+    """
+    Envía una trama a un cliente específico a través de su escritor.
+    
+    Args:
+        trama: difusion.Trama a enviar
+        sesion: sesiones.Sesion del destinatario
+    """
+    salida = sesion.salida
+    if not salida.encolar(trama.para(salida.formato, salida.comprimir)):
+        errores_envio.inc()
+        log("Error enviando a cliente: conexión cerrada", bitacora.AVISO, usuario=sesion.nombre)
+    else:
+        contar_salida(trama)
+
+def contar_salida(trama, cantidad=1):
+    """Cuenta mensajes encolados para los clientes, por tipo."""
+    if cantidad:
+        mensajes_enviados.inc(cantidad, etiqueta=trama.tipo or "desconocido")
+
+def difundir(trama, escritores, excepto=None):
+    """
+    difusion.difundir contando los rechazos como errores de envío y lo
+    encolado por tipo.
+    
+    Args:
+        escritores: Tupla de escritores (ver sesiones.Clientes.escritores)
+    """
+    rechazados = difusion.difundir(trama, escritores, excepto)
+    if rechazados:
+        errores_envio.inc(len(rechazados))
+    omitidos = 1 if excepto is not None and excepto in escritores else 0
+    contar_salida(trama, len(escritores) - len(rechazados) - omitidos)
+
+def enviar_lote(tramas, salida):
+    """difusion.enviar_lote contando lo encolado por tipo."""
+    if difusion.enviar_lote(tramas, salida):
+        for trama in tramas:
+            contar_salida(trama)
+
+def mensaje_servidor(tipo, contenido, es_tcp, sala=None):
+    """
+    Crea un mensaje del servidor ("SISTEMA", "ERROR" o "SALAS") listo para enviar.
+    
+    Los bytes salen de comun.cache_mensajes: un mismo aviso repetido en el
+    mismo segundo no se vuelve a serializar.
+    
+    Args:
+        sala: Sala a la que se refiere el aviso (va en "destino")
+    
+    Returns:
+        difusion.Trama: Se serializa solo en los formatos que se usen
+    """
+    return difusion.Trama(es_tcp, plantilla=(tipo, "SERVER", contenido, sala))
+
+def responder(trama, addr, conn, sock_servidor, formato=comun.FORMATO_JSON):
+    """
+    Envía una trama al cliente que hizo la petición.
+    
+    Args:
+        trama: difusion.Trama a enviar
+        addr: Dirección del cliente
+        conn: Escritor del cliente (TCP, o UDP ya registrado) o None
+        sock_servidor: Socket del servidor (UDP sin registrar)
+        formato: Formato del cliente cuando no hay escritor
+    """
+    if conn is not None:
+        if conn.encolar(trama.para(conn.formato, conn.comprimir)):
+            contar_salida(trama)
+    else:
+        sock_servidor.sendto(trama.para(formato), addr)
+        contar_salida(trama)
 
-def manejar_registro(usuario, addr, conn, es_tcp, sock_servidor):
+def nombre_en_uso(usuario):
+    """Indica si el nombre está registrado aquí o en otro trabajador."""
+    return usuario in clientes or (bus is not None and usuario in bus.remotos)
+
+def total_conectados():
+    """Usuarios conectados, contando los de otros trabajadores."""
+    return len(clientes) + (len(bus.remotos) if bus is not None else 0)
+
+def contar_entrada(msg, datos):
+    """Cuenta un mensaje recibido por tipo y sus bytes."""
+    mensajes_recibidos.inc(etiqueta=msg.get('tipo') if msg else "invalido")
+    bytes_recibidos.inc(len(datos))
+
+def acumular_salida(escritor):
+    """Guarda los contadores de salida de un cliente que se desconecta."""
+    with lock_salida_cerrados:
+        for clave, valor in escritor.estadisticas().items():
+            salida_cerrados[clave] = salida_cerrados.get(clave, 0) + int(valor)
+
+def estadisticas_salida():
+    """
+    Returns:
+        dict: estadisticas_colas() más lo ya enviado a clientes desconectados
+    """
+    totales = estadisticas_colas()
+    with lock_salida_cerrados:
+        for clave in ("escrituras", "tramas_enviadas", "bytes_enviados", "tramas_descartadas",
+                      "bytes_descartados"):
+            totales[clave] = totales.get(clave, 0) + salida_cerrados.get(clave, 0)
+    return totales
+
+def estadisticas_colas():
+    """
+    Suma los contadores de las colas de salida de los clientes conectados.
+    
+    Returns:
+        dict: Totales de mensajes/bytes encolados, enviados y descartados
+    """
+    totales = {}
+    for escritor in clientes.escritores():
+        for clave, valor in escritor.estadisticas().items():
+            totales[clave] = totales.get(clave, 0) + int(valor)
+    return totales
+
+def manejar_registro(usuario, addr, conn, es_tcp, sock_servidor, formato=comun.FORMATO_JSON,
+                     compresion=None):
     """
     Registra un nuevo usuario en el servidor.
     
+    Args:
+        conn: Escritor de la conexión (TCP) o None (UDP)
+        formato: Formato en que llegó el REGISTRO; se usa para responderle
+        compresion: Compresión que pidió el cliente en el REGISTRO, si pidió
+    
     Returns:
         bool: True si registro exitoso, False si error
     """
+    if es_tcp:
+        conn.formato = formato
+    
     with lock:
         # Verificar si el usuario ya existe
-        if usuario in clientes:
-            error = comun.empaquetar_mensaje("ERROR", "SERVER", "Nombre de usuario ya está en uso.")
-            if es_tcp:
-                conn.send(error)
-            else:
-                sock_servidor.sendto(error, addr)
+        if nombre_en_uso(usuario):
+            registros.inc(etiqueta="nombre_en_uso")
+            error = mensaje_servidor("ERROR", "Nombre de usuario ya está en uso.", es_tcp)
+            responder(error, addr, conn, sock_servidor, formato)
+            return False
+        
+        # En UDP la dirección identifica al remitente: una por usuario
+        if not es_tcp and clientes.obtener_por_addr(addr):
+            registros.inc(etiqueta="direccion_en_uso")
+            error = mensaje_servidor("ERROR", "Esta dirección ya tiene un usuario registrado.", es_tcp)
+            responder(error, addr, conn, sock_servidor, formato)
             return False
         
         # Verificar límite de clientes
-        if len(clientes) >= comun.MAX_CLIENTES:
-            error = comun.empaquetar_mensaje("ERROR", "SERVER", "Sala llena. Máximo 5 usuarios.")
-            if es_tcp:
-                conn.send(error)
-            else:
-                sock_servidor.sendto(error, addr)
+        if total_conectados() >= comun.MAX_CLIENTES:
+            registros.inc(etiqueta="sala_llena")
+            error = mensaje_servidor("ERROR", f"Sala llena. Máximo {comun.MAX_CLIENTES} usuarios.", es_tcp)
+            responder(error, addr, conn, sock_servidor, formato)
             return False
         
         # Registrar nuevo cliente
         if es_tcp:
-            clientes[usuario] = {"addr": addr, "conn": conn, "last_seen": time.time()}
+            salida = conn
         else:
-            clientes[usuario] = {"addr": addr, "last_seen": time.time()}
-        
-        log(f"[+] Usuario registrado: {usuario} desde {addr}")
-        
-        # Notificar a todos los clientes existentes (excepto el nuevo)
-        msg_bienvenida = comun.empaquetar_mensaje("SISTEMA", "SERVER", f"{usuario} se ha unido al chat.")
-        for user, info in clientes.items():
-            if user != usuario:
-                enviar_a_cliente(msg_bienvenida, info, es_tcp, sock_servidor)
+            salida = difusion.EscritorUDP(sock_servidor, addr, formato)
+        salida.comprimir = compresion == comun.COMPRESION_ZLIB and comun.COMPRESION
+        sesion = sesiones.Sesion(usuario, addr, salida)
+        if limite_usuario is not None:
+            sesion.cubeta = limites.Cubeta(limite_usuario)
+        # Las recientes se toman antes de unirse: lo que llegue después ya
+        # le llega en vivo
+        contexto = recientes.tramas(comun.SALA_GENERAL)
+        clientes.agregar(sesion)
+        clientes.unir(sesion, comun.SALA_GENERAL)
+        if not es_tcp and capa_udp is not None:
+            capa_udp.proteger(addr)
+        if inactividad is not None:
+            inactividad.agregar(sesion)
         
-        # Enviar confirmación al nuevo usuario
-        confirmacion = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
-                                              f"Bienvenido {usuario}! Hay {len(clientes)} usuarios conectados.")
-        if es_tcp:
-            conn.send(confirmacion)
+        # Enviar confirmación al nuevo usuario (antes que cualquier difusión);
+        # si acepta la compresión lo dice aquí, y la bienvenida va sin comprimir
+        texto = f"Bienvenido {usuario}! Hay {total_conectados()} usuarios conectados."
+        if salida.comprimir:
+            bienvenida = comun.crear_mensaje("SISTEMA", "SERVER", texto)
+            bienvenida['compresion'] = comun.COMPRESION_ZLIB
+            trama = difusion.Trama(es_tcp, msg=bienvenida)
+            if salida.encolar(trama.para(salida.formato)):
+                contar_salida(trama)
         else:
-            sock_servidor.sendto(confirmacion, addr)
+            responder(mensaje_servidor("SISTEMA", texto, es_tcp), addr, salida, sock_servidor)
+        enviar_lote(contexto, salida)
         
-        return True
+        destinatarios = clientes.escritores()
+    
+    registros.inc(etiqueta="aceptado")
+    log(f"[+] Usuario registrado: {usuario} desde {addr}", usuario=usuario, addr=addr)
+    if bus is not None:
+        bus.publicar(trabajadores.BUS_ALTA, usuario)
+    
+    # Notificar a todos los clientes existentes (excepto el nuevo)
+    msg_bienvenida = mensaje_servidor("SISTEMA", f"{usuario} se ha unido al chat.", es_tcp)
+    difundir(msg_bienvenida, destinatarios, excepto=salida)
+    
+    return True
 
-def broadcast_mensaje(datos, usuario_remitente, es_tcp, sock_servidor):
+def broadcast_mensaje(datos, remitente, es_tcp, msg=None, sala=comun.SALA_GENERAL):
     """
-    Envía un mensaje a todos los clientes excepto al remitente.
+    Envía un mensaje a los miembros de una sala excepto al remitente.
+    
+    La trama se crea una sola vez (por formato) y se comparte entre los
+    destinatarios; el lock se suelta antes de encolar. La misma trama se
+    guarda en las recientes de la sala.
     
     Args:
         datos: Mensaje a broadcast
-        usuario_remitente: Usuario que envía el mensaje (no recibe)
+        remitente: sesiones.Sesion de quien envía el mensaje (no recibe)
         es_tcp: True para TCP, False para UDP
-        sock_servidor: Socket del servidor (para UDP)
+        msg: Mensaje ya deserializado, si se tiene
+        sala: Sala destino
     """
-    with lock:
-        usuarios_a_eliminar = []
-        for usuario, info in clientes.items():
-            if usuario != usuario_remitente:
-                try:
-                    enviar_a_cliente(datos, info, es_tcp, sock_servidor)
-                except:
-                    usuarios_a_eliminar.append(usuario)
+    if not isinstance(datos, bytes):
+        datos = bytes(datos)  # En UDP es una vista sobre un buffer de lectura que se reutiliza
+    trama = difusion.crear_trama(datos, es_tcp, msg)
+    difundir(trama, clientes.escritores_sala(sala), remitente.salida)
+    recientes.agregar(sala, trama)
+    if bus is not None:
+        bus.publicar(trabajadores.BUS_DIFUSION, datos)
+
+def sala_del_mensaje(msg, es_tcp, addr, sesion, sock_servidor):
+    """
+    Sala a la que va un PUBLICO o HISTORIAL (la general si no indica).
+    Si "destino" no es texto o el remitente no está en esa sala, le
+    responde con un ERROR.
+    
+    Returns:
+        str: Nombre de la sala, o None si no es válida para el remitente
+    """
+    sala = msg.get('destino') or comun.SALA_GENERAL
+    if not isinstance(sala, str):
+        error = mensaje_servidor("ERROR", "Nombre de sala inválido.", es_tcp)
+    elif sala not in sesion.salas:
+        error = mensaje_servidor("ERROR", f"No estás en la sala '{sala}'.", es_tcp)
+    else:
+        return sala
+    responder(error, addr, sesion.salida, sock_servidor)
+    return None
+
+def manejar_mensaje_publico(msg, datos, sesion, es_tcp, sock_servidor=None, addr=None):
+    """
+    Procesa un mensaje público y lo reenvía a los demás miembros de su sala.
+    
+    Args:
+        sesion: sesiones.Sesion del remitente, ya resuelta por quien llama
+    """
+    sala = sala_del_mensaje(msg, es_tcp, addr, sesion, sock_servidor)
+    if sala is None:
+        return
+    
+    # Log en servidor
+    if comun.LOG_CONTENIDO:
+        log(f"[PUBLICO] {sesion.nombre}: {msg.get('contenido')}", tipo="PUBLICO",
+            usuario=sesion.nombre, sala=sala, contenido=msg.get('contenido'))
+    else:
+        log(f"[PUBLICO] {sesion.nombre}", tipo="PUBLICO", usuario=sesion.nombre, sala=sala)
+    
+    # Reenviar a los demás miembros de la sala
+    broadcast_mensaje(datos, sesion, es_tcp, msg, sala)
+    guardar_en_historial(msg, datos, sala)
+
+def guardar_en_historial(msg, datos, sala):
+    """
+    Agrega un mensaje público al historial, en formato binario.
+    
+    Args:
+        msg: Mensaje deserializado
+        datos: El mismo mensaje serializado, tal como llegó
+        sala: Sala del mensaje
+    """
+    if historial is None:
+        return
+    if comun.formato_de(datos) != comun.FORMATO_BINARIO:
+        datos = comun.serializar_mensaje(msg, comun.FORMATO_BINARIO)
+    try:
+        historial.agregar(sala, msg.get('usuario') or "", datos)
+    except OSError as e:
+        log(f"[ERROR] No se pudo guardar en el historial: {e}", bitacora.ERROR)
+
+def leer_fecha(fecha):
+    """Convierte una fecha comun.FORMATO_FECHA a ms (None si no es válida)."""
+    try:
+        return int(time.mktime(time.strptime(fecha, comun.FORMATO_FECHA)) * 1000)
+    except (TypeError, ValueError):
+        return None
+
+def manejar_historial(msg, sesion, es_tcp, sock_servidor, addr):
+    """
+    Procesa un HISTORIAL: reenvía al cliente los mensajes guardados de una
+    sala a la que pertenece y termina con el cursor para seguir.
+    
+    Args:
+        sesion: sesiones.Sesion del remitente, ya resuelta por quien llama
+    """
+    if historial is None:
+        error = mensaje_servidor("ERROR", "Este servidor no guarda historial.", es_tcp)
+        responder(error, addr, sesion.salida, sock_servidor)
+        return
+    sala = sala_del_mensaje(msg, es_tcp, addr, sesion, sock_servidor)
+    if sala is None:
+        return
+    
+    autor = msg.get('autor')
+    if autor is not None and not isinstance(autor, str):
+        error = mensaje_servidor("ERROR", "Autor inválido.", es_tcp)
+        responder(error, addr, sesion.salida, sock_servidor)
+        return
+    try:
+        cantidad = max(1, min(int(msg.get('contenido') or comun.MAX_HISTORIAL), comun.MAX_HISTORIAL))
+    except ValueError:
+        cantidad = comun.MAX_HISTORIAL
+    desde = msg.get('desde')
+    desde_ms = leer_fecha(msg.get('desde_fecha'))
+    
+    if isinstance(desde, int) or desde_ms is not None:
+        encontrados, cursor = historial.desde(sala, desde if isinstance(desde, int) else 0,
+                                              cantidad, autor, desde_ms or 0)
+    else:
+        encontrados, cursor = historial.ultimos(sala, cantidad, autor)
+    
+    fin = comun.crear_mensaje("HISTORIAL", "SERVER",
+                              f"{len(encontrados)} mensajes del historial de {sala}.", sala)
+    fin['cursor'] = cursor
+    # Todo junto: una escritura en TCP, y un solo lote si comprime
+    # El historial solo guarda mensajes públicos
+    tramas = [difusion.Trama(es_tcp, datos=datos, tipo="PUBLICO") for _, datos in encontrados]
+    tramas.append(difusion.Trama(es_tcp, msg=fin))
+    enviar_lote(tramas, sesion.salida)
+    log(f"[HISTORIAL] {sesion.nombre}: {len(encontrados)} mensajes de {sala}", bitacora.DEPURACION,
+        usuario=sesion.nombre, sala=sala)
+
+def avisar_sala(sala, texto, es_tcp, excepto=None):
+    """
+    Envía un aviso del servidor a los miembros de una sala (también a los
+    conectados a otros trabajadores).
+    """
+    difundir(mensaje_servidor("SISTEMA", texto, es_tcp, sala), clientes.escritores_sala(sala), excepto)
+    if bus is not None:
+        aviso = comun.empaquetar_mensaje("SISTEMA", "SERVER", texto, sala, comun.FORMATO_BINARIO)
+        bus.publicar(trabajadores.BUS_DIFUSION, aviso)
+
+def manejar_sala(msg, sesion, es_tcp, sock_servidor, addr):
+    """
+    Procesa UNIRSE, SALIR y SALAS.
+    
+    Args:
+        sesion: sesiones.Sesion del remitente, ya resuelta por quien llama
+    """
+    tipo = msg.get('tipo')
+    sala = msg.get('destino') or ""
+    sala = sala.strip() if isinstance(sala, str) else ""
+    contexto = ()  # Mensajes recientes para quien entra a la sala
+    
+    if tipo == "SALAS":
+        lista = ", ".join(f"{nombre} ({n})" for nombre, n in clientes.listar_salas())
+        respuesta = mensaje_servidor("SALAS", f"Salas: {lista}", es_tcp)
+    
+    elif not sala or len(sala) > comun.MAX_NOMBRE_SALA:
+        respuesta = mensaje_servidor(
+            "ERROR", f"Nombre de sala inválido (1 a {comun.MAX_NOMBRE_SALA} caracteres).", es_tcp)
+    
+    elif tipo == "UNIRSE":
+        recientes_sala = recientes.tramas(sala)
+        if clientes.unir(sesion, sala):
+            # Quien ya era miembro ya vio esos mensajes
+            contexto = recientes_sala
+            log(f"[SALA] {sesion.nombre} se unió a {sala}", usuario=sesion.nombre, sala=sala)
+            avisar_sala(sala, f"{sesion.nombre} se unió a la sala {sala}.", es_tcp, sesion.salida)
+        miembros = len(clientes.escritores_sala(sala))
+        respuesta = mensaje_servidor("SISTEMA", f"Estás en la sala {sala} ({miembros} miembros).",
+                                     es_tcp, sala)
+    
+    else:  # SALIR
+        if not clientes.dejar(sesion, sala):
+            respuesta = mensaje_servidor("ERROR", f"No estás en la sala '{sala}'.", es_tcp)
+        else:
+            log(f"[SALA] {sesion.nombre} dejó {sala}", usuario=sesion.nombre, sala=sala)
+            avisar_sala(sala, f"{sesion.nombre} dejó la sala {sala}.", es_tcp)
+            respuesta = mensaje_servidor("SISTEMA", f"Saliste de la sala {sala}.", es_tcp, sala)
+    
+    responder(respuesta, addr, sesion.salida, sock_servidor)
+    enviar_lote(contexto, sesion.salida)
+
+def manejar_mensaje_privado(msg_dict, datos, sesion, es_tcp, sock_servidor, addr):
+    """
+    Procesa un mensaje privado entre dos usuarios.
+    
+    Args:
+        sesion: sesiones.Sesion del remitente, ya resuelta por quien llama
+    """
+    destino = msg_dict.get('destino')
+    conn = sesion.salida
+    
+    info_destino = clientes.obtener(destino)
+    remoto = info_destino is None and bus is not None and destino in bus.remotos
+    if info_destino or remoto:
+        log(f"[PRIVADO] {sesion.nombre} -> {destino}", tipo="PRIVADO",
+            usuario=sesion.nombre, destino=destino)
         
-        # Eliminar clientes con error de envío
-        for usuario in usuarios_a_eliminar:
-            if usuario in clientes:
-                del clientes[usuario]
-                log(f"[-] Usuario eliminado (error envío): {usuario}")
+        # Enviar mensaje al destino (o al trabajador donde está conectado)
+        if info_destino:
+            enviar_a_cliente(difusion.crear_trama(datos, es_tcp, msg_dict), info_destino)
+        else:
+            bus.publicar(trabajadores.BUS_PRIVADO, datos)
+        
+        # Confirmación al remitente
+        confirmacion = mensaje_servidor("SISTEMA", f"Mensaje privado enviado a {destino}", es_tcp)
+        responder(confirmacion, addr, conn, sock_servidor)
+    else:
+        error = mensaje_servidor("ERROR", f"Usuario '{destino}' no encontrado.", es_tcp)
+        responder(error, addr, conn, sock_servidor)
 
-def manejar_mensaje_publico(datos, usuario, es_tcp, sock_servidor):
+def controlar_trafico(datos, addr, sesion, es_tcp):
+    """
+    Aplica los límites de tráfico (ver limites.py) a un mensaje recibido,
+    antes de deserializarlo: primero el de su IP y después el del usuario.
+    Al primer mensaje descartado se le avisa al usuario, no a cada uno.
+    
+    Args:
+        sesion: Sesión del remitente, o None si todavía no se registró
+    
+    Returns:
+        bool: True si el mensaje se procesa, False si se descarta
     """
-    Procesa un mensaje público y lo reenvía a todos.
+    ahora = time.monotonic()
+    cubeta = sesion.cubeta if sesion is not None else None
+    excedido = None
+    if limites_ip is not None:
+        excedido = limites_ip.tomar(addr[0], len(datos), ahora)
+        if excedido:
+            excedido = "ip_" + excedido
+    if excedido is None and cubeta is not None:
+        excedido = cubeta.tomar(len(datos), ahora)
+        if excedido:
+            excedido = "usuario_" + excedido
+    if excedido is None:
+        if cubeta is not None:
+            cubeta.excedida = False
+        return True
+    
+    limitados.inc(etiqueta=excedido)
+    bytes_recibidos.inc(len(datos))
+    if cubeta is not None and not cubeta.excedida:
+        cubeta.excedida = True
+        log(f"[!] {sesion.nombre} superó el límite de tráfico ({excedido})", bitacora.AVISO,
+            usuario=sesion.nombre, addr=addr, limite=excedido)
+        aviso = mensaje_servidor("ERROR", "Demasiados mensajes: se descartan hasta que bajes el ritmo.",
+                                 es_tcp)
+        enviar_a_cliente(aviso, sesion)
+    return False
+
+def descomprimir_entrada(datos, addr, sesion):
     """
-    with lock:
-        if usuario not in clientes:
+    Descomprime un mensaje recibido comprimido, así lo que se reenvía,
+    se guarda y se pasa a otros trabajadores es siempre el mensaje normal.
+    
+    controlar_trafico() solo pudo cobrar el tamaño comprimido: lo que
+    creció al descomprimir se cobra ahora a las cubetas de bytes de la IP
+    y del usuario, así unos pocos KB que se expanden a 1 MB no esquivan
+    el límite.
+    
+    Args:
+        sesion: Sesión del remitente, o None si todavía no se registró
+    
+    Returns:
+        bytes: El mensaje (el mismo si no venía comprimido), o None si
+        estaba dañado
+    """
+    if not comun.esta_comprimido(datos):
+        return datos
+    try:
+        comprimidos_recibidos.inc(len(datos))
+        mensaje = comun.descomprimir(datos)
+    except ValueError:
+        return None
+    crecimiento = len(mensaje) - len(datos)
+    if crecimiento > 0:
+        if limites_ip is not None:
+            limites_ip.cobrar(addr[0], crecimiento)
+        if sesion is not None and sesion.cubeta is not None:
+            sesion.cubeta.cobrar(crecimiento)
+    return mensaje
+
+def validar_registro(datos):
+    """
+    Valida el primer mensaje de una conexión TCP.
+    
+    Returns:
+        tuple: (usuario, formato, compresión pedida) si es un REGISTRO
+        válido, (None, None, None) en otro caso
+    """
+    if not datos:
+        return None, None, None
+    
+    msg = comun.desempaquetar_mensaje(datos)
+    contar_entrada(msg, datos)
+    if not msg or msg.get('tipo') != "REGISTRO" or not msg.get('usuario'):
+        registros.inc(etiqueta="invalido")
+        return None, None, None
+    
+    return msg.get('usuario'), comun.formato_de(datos), msg.get('compresion')
+
+def procesar_mensaje_tcp(datos, usuario_actual, addr, conn):
+    """
+    Procesa un mensaje recibido de un cliente TCP ya registrado.
+    """
+    inicio = time.perf_counter()
+    try:
+        sesion = clientes.obtener(usuario_actual)
+        if not sesion or not controlar_trafico(datos, addr, sesion, True):
             return
         
-        # Actualizar timestamp de actividad
-        clientes[usuario]['last_seen'] = time.time()
+        recibido, datos = datos, descomprimir_entrada(datos, addr, sesion)
+        msg = comun.desempaquetar_mensaje(datos) if datos else None
+        contar_entrada(msg, recibido)
+        if not msg:
+            responder(mensaje_servidor("ERROR", "Mensaje inválido.", True), addr, conn, None)
+            return
         
-        # Log en servidor
-        msg_dict = comun.desempaquetar_mensaje(datos)
-        if msg_dict:
-            log(f"[PUBLICO] {usuario}: {msg_dict['contenido']}")
+        tipo = msg.get('tipo')
+        usuario = msg.get('usuario')
         
-        # Reenviar a todos los demás
-        broadcast_mensaje(datos, usuario, es_tcp, sock_servidor)
+        # Verificar que el mensaje sea del usuario registrado
+        if usuario != usuario_actual:
+            return
+        # Cualquier mensaje (también un LATIDO) cuenta como actividad
+        sesion.last_seen = time.time()
+        
+        if tipo == "PUBLICO":
+            manejar_mensaje_publico(msg, datos, sesion, True)
+        elif tipo == "PRIVADO":
+            manejar_mensaje_privado(msg, datos, sesion, True, None, addr)
+        elif tipo in comun.TIPOS_SALA:
+            manejar_sala(msg, sesion, True, None, addr)
+        elif tipo == "HISTORIAL":
+            manejar_historial(msg, sesion, True, None, addr)
+    finally:
+        latencia_procesamiento.observar(time.perf_counter() - inicio)
 
-def manejar_mensaje_privado(msg_dict, datos, usuario, es_tcp, sock_servidor, addr, conn):
+def dar_de_baja(usuario, es_tcp, salida=None, motivo="desconexion"):
     """
-    Procesa un mensaje privado entre dos usuarios.
+    Elimina a un usuario del registro y avisa a los demás.
+    
+    Args:
+        salida: Escritor de la conexión que termina; si el nombre ya está
+            registrado con otro (volvió a conectarse), no se quita
+        motivo: "desconexion" o "inactividad"
+    
+    Returns:
+        sesiones.Sesion: La sesión eliminada o None
     """
-    destino = msg_dict.get('destino')
+    sesion = clientes.quitar(usuario, salida)
+    if sesion is None:
+        return None
+    acumular_salida(sesion.salida)
+    destinatarios = clientes.escritores()
+    bajas.inc(etiqueta=motivo)
     
-    with lock:
-        if usuario not in clientes:
+    sufijo = " por inactividad" if motivo == "inactividad" else ""
+    log(f"[-] Usuario desconectado{sufijo}: {usuario}", usuario=usuario, motivo=motivo)
+    if bus is not None:
+        bus.publicar(trabajadores.BUS_BAJA, usuario)
+    
+    # Notificar a los demás usuarios
+    msg_desconexion = mensaje_servidor("SISTEMA", f"{usuario} ha abandonado el chat.", es_tcp)
+    difundir(msg_desconexion, destinatarios)
+    return sesion
+
+def manejar_desconexion_tcp(usuario_actual, salida=None):
+    """
+    Elimina a un usuario TCP del registro y avisa a los demás.
+    """
+    dar_de_baja(usuario_actual, True, salida)
+
+def expulsar_inactivo(sesion, es_tcp):
+    """
+    Da de baja a un cliente que pasó comun.TIEMPO_INACTIVIDAD sin enviar
+    nada: deja de ocupar lugar y de recibir difusiones.
+    """
+    if clientes.obtener(sesion.nombre) is not sesion:
+        return  # Ya se había ido
+    aviso = mensaje_servidor("ERROR", "Desconectado por inactividad.", es_tcp)
+    enviar_a_cliente(aviso, sesion)
+    if dar_de_baja(sesion.nombre, es_tcp, sesion.salida, "inactividad") is None:
+        return
+    sesion.salida.cortar()
+    if not es_tcp and capa_udp is not None:
+        capa_udp.olvidar(sesion.addr)
+
+def revisar_inactivos(es_tcp):
+    """
+    Avanza la rueda de inactividad y da de baja a los clientes vencidos.
+    
+    Returns:
+        float: Segundos hasta la próxima revisión, o None si está desactivada
+    """
+    if inactividad is None:
+        return None
+    for sesion in inactividad.avanzar(time.time()):
+        expulsar_inactivo(sesion, es_tcp)
+    return inactividad.resolucion
+
+def vigilar_inactivos(es_tcp):
+    """Hilo que revisa la inactividad (motor de hilos en TCP)."""
+    while True:
+        espera = revisar_inactivos(es_tcp)
+        if espera is None:
             return
-        
-        # Actualizar timestamp
-        clientes[usuario]['last_seen'] = time.time()
-        
-        if destino in clientes:
-            log(f"[PRIVADO] {usuario} -> {destino}")
-            
-            # Enviar mensaje al destino
-            enviar_a_cliente(datos, clientes[destino], es_tcp, sock_servidor)
-            
-            # Confirmación al remitente
-            confirmacion = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
-                                                  f"Mensaje privado enviado a {destino}")
-            if es_tcp:
-                conn.send(confirmacion)
-            else:
-                sock_servidor.sendto(confirmacion, addr)
-        else:
-            error = comun.empaquetar_mensaje("ERROR", "SERVER", 
-                                           f"Usuario '{destino}' no encontrado.")
-            if es_tcp:
-                conn.send(error)
-            else:
-                sock_servidor.sendto(error, addr)
+        time.sleep(espera)
+
+def programar_inactivos(es_tcp):
+    """Revisa la inactividad desde el bucle de eventos (motor asyncio)."""
+    espera = revisar_inactivos(es_tcp)
+    if espera is not None:
+        asyncio.get_running_loop().call_later(espera, programar_inactivos, es_tcp)
+
+def recibir_del_bus(tipo, datos, es_tcp):
+    """
+    Entrega a los clientes de este proceso lo que llega de otro trabajador.
+    
+    Args:
+        tipo: Tipo de mensaje del bus (trabajadores.BUS_*)
+        datos: Mensaje serializado, nombre o lista de nombres según el tipo
+        es_tcp: True para TCP, False para UDP
+    """
+    if tipo == trabajadores.BUS_DIFUSION:
+        msg = comun.desempaquetar_mensaje(datos)
+        sala = (msg.get('destino') if msg else None) or comun.SALA_GENERAL
+        trama = difusion.crear_trama(datos, es_tcp, msg)
+        difundir(trama, clientes.escritores_sala(sala))
+        # Cada trabajador guarda su propia copia de recientes e historial
+        if msg and msg.get('tipo') == "PUBLICO":
+            recientes.agregar(sala, trama)
+            guardar_en_historial(msg, datos, sala)
+    
+    elif tipo == trabajadores.BUS_PRIVADO:
+        msg = comun.desempaquetar_mensaje(datos)
+        info_destino = clientes.obtener(msg.get('destino')) if msg else None
+        if info_destino:
+            enviar_a_cliente(difusion.crear_trama(datos, es_tcp, msg), info_destino)
+    
+    elif tipo == trabajadores.BUS_ALTA:
+        aviso = mensaje_servidor("SISTEMA", f"{datos} se ha unido al chat.", es_tcp)
+        difundir(aviso, clientes.escritores())
+    
+    elif tipo in (trabajadores.BUS_BAJA, trabajadores.BUS_CAIDA):
+        nombres = [datos] if tipo == trabajadores.BUS_BAJA else datos
+        for nombre in nombres:
+            aviso = mensaje_servidor("SISTEMA", f"{nombre} ha abandonado el chat.", es_tcp)
+            difundir(aviso, clientes.escritores())
 
 def manejar_cliente_tcp(conn, addr):
     """
     Maneja la conexión de un cliente TCP.
+    
+    El hilo lee y procesa mensajes; todo lo que se envía a este cliente
+    pasa por su EscritorHilo, que escribe desde su propio hilo.
     """
     usuario_actual = None
-    es_tcp = True
+    salida = difusion.EscritorHilo(conn)
     
     try:
         # Primer mensaje debe ser REGISTRO
-        datos = conn.recv(comun.BUFSIZE)
-        if not datos:
-            conn.close()
-            return
-            
-        msg = comun.desempaquetar_mensaje(datos)
-        if not msg or msg.get('tipo') != "REGISTRO":
-            conn.close()
-            return
-            
-        usuario = msg.get('usuario')
+        tramas = comun.leer_tramas(conn)
+        usuario, formato, compresion = validar_registro(next(tramas, None))
         if not usuario:
-            conn.close()
             return
         
         # Intentar registro
-        if not manejar_registro(usuario, addr, conn, es_tcp, None):
-            conn.close()
+        if not manejar_registro(usuario, addr, salida, True, None, formato, compresion):
             return
             
         usuario_actual = usuario
         
         # Bucle principal para recibir mensajes
-        while True:
-            datos = conn.recv(comun.BUFSIZE)
-            if not datos:
-                break
-            
-            msg = comun.desempaquetar_mensaje(datos)
-            if not msg:
-                continue
-            
-            tipo = msg.get('tipo')
-            usuario = msg.get('usuario')
-            
-            # Verificar que el mensaje sea del usuario registrado
-            if usuario == usuario_actual:
-                if tipo == "PUBLICO":
-                    manejar_mensaje_publico(datos, usuario, es_tcp, None)
-                elif tipo == "PRIVADO":
-                    manejar_mensaje_privado(msg, datos, usuario, es_tcp, None, addr, conn)
+        for datos in tramas:
+            procesar_mensaje_tcp(datos, usuario_actual, addr, salida)
     
     except ConnectionResetError:
-        log(f"Conexión TCP cerrada abruptamente: {addr}")
+        log(f"Conexión TCP cerrada abruptamente: {addr}", bitacora.AVISO)
     except Exception as e:
-        log(f"Error con cliente TCP {addr}: {e}")
+        log(f"Error con cliente TCP {addr}: {e}", bitacora.ERROR)
     finally:
+        if salida.desbordado:
+            log(f"[-] Cliente lento desconectado (cola de salida llena): {usuario_actual or addr}",
+                bitacora.AVISO)
+        
         # Limpiar desconexión
         if usuario_actual:
-            with lock:
-                if usuario_actual in clientes:
-                    del clientes[usuario_actual]
-                    log(f"[-] Usuario desconectado: {usuario_actual}")
-                    
-                    # Notificar a los demás usuarios
-                    msg_desconexion = comun.empaquetar_mensaje("SISTEMA", "SERVER", 
-                                                             f"{usuario_actual} ha abandonado el chat.")
-                    for user, info in clientes.items():
-                        enviar_a_cliente(msg_desconexion, info, es_tcp, None)
+            manejar_desconexion_tcp(usuario_actual, salida)
         
-        try:
-            conn.close()
-        except:
-            pass
+        # El escritor envía lo pendiente y cierra el socket
+        salida.cerrar()
+
+def mostrar_inicio(protocolo, motor):
+    """Muestra el encabezado de arranque del servidor."""
+    ip_local = comun.obtener_ip_local()
+    log("=" * 50)
+    log(f">>> SERVIDOR {protocolo} INICIADO <<<")
+    log(f"IP: {ip_local}")
+    log(f"Puerto: {comun.PORT}")
+    log(f"Motor: {motor}")
+    log(f"Máximo clientes: {comun.MAX_CLIENTES}")
+    log("=" * 50)
+    log("Esperando conexiones..." if protocolo == "TCP" else "Esperando mensajes...")
 
 def iniciar_servidor_tcp():
     """Inicia el servidor en modo TCP."""
-    servidor = comun.crear_socket_tcp()
+    servidor = comun.crear_socket_tcp(reusar_puerto=bus is not None)
     
     try:
         servidor.bind((comun.HOST, comun.PORT))
         servidor.listen(5)
         
-        ip_local = comun.obtener_ip_local()
-        log("=" * 50)
-        log(">>> SERVIDOR TCP INICIADO <<<")
-        log(f"IP: {ip_local}")
-        log(f"Puerto: {comun.PORT}")
-        log(f"Máximo clientes: {comun.MAX_CLIENTES}")
-        log("=" * 50)
-        log("Esperando conexiones...")
+        mostrar_inicio("TCP", "hilos")
+        if bus is not None:
+            bus.escuchar(lambda tipo, datos: recibir_del_bus(tipo, datos, True))
+        threading.Thread(target=vigilar_inactivos, args=(True,), daemon=True).start()
         
         while True:
             conn, addr = servidor.accept()
@@ -268,82 +809,637 @@ def iniciar_servidor_tcp():
     except KeyboardInterrupt:
         log("\n[!] Servidor detenido por el usuario.")
     except Exception as e:
-        log(f"[ERROR] Error en servidor TCP: {e}")
+        log(f"[ERROR] Error en servidor TCP: {e}", bitacora.ERROR)
     finally:
         servidor.close()
 
+def procesar_datagrama_udp(datos, addr, sock_servidor):
+    """
+    Procesa un datagrama UDP recibido por el servidor.
+    
+    El remitente se identifica por su dirección (índice del registro), no
+    por el campo "usuario" del datagrama: un mensaje que dice venir de otro
+    usuario se descarta, así nadie puede hablar en nombre de otro ni
+    desviar su tráfico.
+    
+    Args:
+        datos: Bytes del datagrama
+        addr: Dirección del remitente
+        sock_servidor: Objeto con sendto() (socket UDP o transporte asyncio)
+    """
+    inicio = time.perf_counter()
+    try:
+        sesion = clientes.obtener_por_addr(addr)
+        if not controlar_trafico(datos, addr, sesion, False):
+            return
+        
+        recibido, datos = datos, descomprimir_entrada(datos, addr, sesion)
+        msg = comun.desempaquetar_mensaje(datos) if datos else None
+        contar_entrada(msg, recibido)
+        if not msg:
+            # Solo se le contesta a un remitente registrado (no a cualquier dirección)
+            if sesion is not None:
+                enviar_a_cliente(mensaje_servidor("ERROR", "Mensaje inválido.", False), sesion)
+            return
+        
+        tipo = msg.get('tipo')
+        usuario = msg.get('usuario')
+        
+        # REGISTRO
+        if tipo == "REGISTRO":
+            if usuario:
+                manejar_registro(usuario, addr, None, False, sock_servidor, comun.formato_de(datos),
+                                 msg.get('compresion'))
+            return
+        
+        if sesion is None or usuario != sesion.nombre:
+            return
+        # Cualquier mensaje (también un LATIDO) cuenta como actividad
+        sesion.last_seen = time.time()
+        
+        # MENSAJE PÚBLICO
+        if tipo == "PUBLICO":
+            manejar_mensaje_publico(msg, datos, sesion, False, sock_servidor, addr)
+        
+        # MENSAJE PRIVADO
+        elif tipo == "PRIVADO":
+            manejar_mensaje_privado(msg, datos, sesion, False, sock_servidor, addr)
+        
+        # SALAS
+        elif tipo in comun.TIPOS_SALA:
+            manejar_sala(msg, sesion, False, sock_servidor, addr)
+        
+        # HISTORIAL
+        elif tipo == "HISTORIAL":
+            manejar_historial(msg, sesion, False, sock_servidor, addr)
+    finally:
+        latencia_procesamiento.observar(time.perf_counter() - inicio)
+
+def leer_lote_udp(sock, buffers, espera=None):
+    """
+    Espera a que haya datagramas y lee todos los disponibles, hasta uno
+    por buffer, sin volver a esperar.
+    
+    Args:
+        sock: Socket UDP no bloqueante
+        buffers: Lista de memoryview preasignadas (una por datagrama)
+        espera: Segundos máximos de espera (None = sin límite)
+    
+    Returns:
+        list: Tuplas (datos, addr); datos es una vista sobre su buffer
+        (vacía si se cumplió la espera)
+    """
+    listos, _, _ = select.select([sock], [], [], espera)
+    if not listos:
+        return []
+    return leer_disponibles_udp(sock, buffers)
+
+def leer_disponibles_udp(sock, buffers):
+    """
+    Lee sin esperar los datagramas que ya llegaron, hasta uno por buffer.
+    
+    Returns:
+        list: Tuplas (datos, addr) como leer_lote_udp
+    """
+    lote = []
+    for buffer in buffers:
+        try:
+            n, addr = sock.recvfrom_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            break
+        except ConnectionResetError:
+            # ICMP "puerto inalcanzable" de un envío anterior (Windows)
+            continue
+        lote.append((buffer[:n], addr))
+    return lote
+
 def iniciar_servidor_udp():
-    """Inicia el servidor en modo UDP."""
-    servidor = comun.crear_socket_udp()
+    """
+    Inicia el servidor en modo UDP.
+    
+    En cada despertar se leen hasta comun.LOTE_UDP datagramas en buffers
+    preasignados, se procesan todos y luego se envían juntas las respuestas
+    y difusiones que generaron (difusion.SalidaUDPEnLote), con un ack por
+    cliente de la capa confiable (comun.CapaConfiable). La espera del
+    select() se acota al próximo reenvío pendiente y a la próxima
+    revisión de inactividad.
+    """
+    global capa_udp
+    servidor = comun.crear_socket_udp(reusar_puerto=bus is not None)
     
     try:
         servidor.bind((comun.HOST, comun.PORT))
+        servidor.setblocking(False)
+        salida = difusion.SalidaUDPEnLote(servidor)
+        capa_udp = comun.CapaConfiable(salida)
+        tam_buffer = comun.BUFSIZE + comun.CABECERA_DATOS.size
+        buffers = [memoryview(bytearray(tam_buffer)) for _ in range(comun.LOTE_UDP)]
         
-        ip_local = comun.obtener_ip_local()
-        log("=" * 50)
-        log(">>> SERVIDOR UDP INICIADO <<<")
-        log(f"IP: {ip_local}")
-        log(f"Puerto: {comun.PORT}")
-        log(f"Máximo clientes: {comun.MAX_CLIENTES}")
-        log("=" * 50)
-        log("Esperando mensajes...")
+        mostrar_inicio("UDP", "hilos")
+        if bus is not None:
+            bus.escuchar(lambda tipo, datos: recibir_del_bus(tipo, datos, False))
         
         while True:
-            datos, addr = servidor.recvfrom(comun.BUFSIZE)
-            
-            msg = comun.desempaquetar_mensaje(datos)
-            if not msg:
-                continue
-            
-            tipo = msg.get('tipo')
-            usuario = msg.get('usuario')
+            esperas = [e for e in (capa_udp.revisar(), revisar_inactivos(False)) if e is not None]
+            for datos, addr in leer_lote_udp(servidor, buffers, min(esperas, default=None)):
+                try:
+                    for mensaje in capa_udp.recibir(datos, addr):
+                        procesar_datagrama_udp(mensaje, addr, capa_udp)
+                except Exception as e:
+                    log(f"Error con datagrama UDP de {addr}: {e}", bitacora.ERROR)
+            capa_udp.enviar_acks()
+            # Enviar antes de reutilizar los buffers
+            salida.vaciar()
+    
+    except KeyboardInterrupt:
+        log("\n[!] Servidor detenido por el usuario.")
+    except Exception as e:
+        log(f"[ERROR] Error en servidor UDP: {e}", bitacora.ERROR)
+    finally:
+        servidor.close()
+
+# --- MOTOR ASYNCIO ---
+# Un único hilo con un bucle de eventos atiende todas las conexiones, sin un
+# hilo por cliente. Las funciones de ruteo de arriba se reutilizan tal cual:
+# cada conexión usa un difusion.EscritorAsyncio como escritor y el transporte
+# UDP de asyncio ya tiene sendto().
+
+async def leer_tramas_asyncio(reader):
+    """
+    Generador asíncrono equivalente a comun.leer_tramas para un StreamReader.
+    """
+    decodificador = comun.DecodificadorTramas()
+    while True:
+        fragmento = await reader.read(comun.TAM_LECTURA_TCP)
+        if not fragmento:
+            return
+        for datos in decodificador.alimentar(fragmento):
+            yield datos
+
+async def primera_trama(tramas):
+    """Devuelve el primer mensaje de un generador asíncrono o None si termina."""
+    async for datos in tramas:
+        return datos
+    return None
+
+async def manejar_cliente_asyncio(reader, writer):
+    """
+    Maneja la conexión de un cliente TCP dentro del bucle de eventos.
+    """
+    addr = writer.get_extra_info('peername')
+    conn = difusion.EscritorAsyncio(writer)
+    usuario_actual = None
+    log(f"Nueva conexión TCP desde {addr}")
+    
+    try:
+        # Primer mensaje debe ser REGISTRO
+        tramas = leer_tramas_asyncio(reader)
+        usuario, formato, compresion = validar_registro(await primera_trama(tramas))
+        if not usuario or not manejar_registro(usuario, addr, conn, True, None, formato, compresion):
+            return
+        
+        usuario_actual = usuario
+        
+        # Bucle principal para recibir mensajes
+        async for datos in tramas:
+            procesar_mensaje_tcp(datos, usuario_actual, addr, conn)
+            # Dejar de leer a este cliente si su propio buffer de salida crece
+            await conn.drenado.wait()
+    
+    except ConnectionResetError:
+        log(f"Conexión TCP cerrada abruptamente: {addr}", bitacora.AVISO)
+    except Exception as e:
+        log(f"Error con cliente TCP {addr}: {e}", bitacora.ERROR)
+    finally:
+        if conn.desbordado:
+            log(f"[-] Cliente lento desconectado (cola de salida llena): {usuario_actual or addr}",
+                bitacora.AVISO)
+        
+        if usuario_actual:
+            manejar_desconexion_tcp(usuario_actual, conn)
+        
+        conn.cerrar()
+
+class ProtocoloUDPAsyncio(asyncio.DatagramProtocol):
+    """
+    Recibe datagramas UDP en el bucle de eventos.
+    
+    Los acks de la capa confiable se juntan hasta el final de la vuelta
+    del bucle y los reenvíos se programan con call_later.
+    """
+    
+    def __init__(self):
+        self.transport = None
+        self.capa = None
+        self.acks_programados = False
+        self.revision = None
+    
+    def connection_made(self, transport):
+        global capa_udp
+        self.transport = transport
+        self.capa = capa_udp = comun.CapaConfiable(transport)
+    
+    def datagram_received(self, datos, addr):
+        for mensaje in self.capa.recibir(datos, addr):
+            procesar_datagrama_udp(mensaje, addr, self.capa)
+        loop = asyncio.get_running_loop()
+        if self.capa.con_ack and not self.acks_programados:
+            self.acks_programados = True
+            loop.call_soon(self.enviar_acks)
+        if self.revision is None:
+            self.revision = loop.call_later(comun.RTO_MIN, self.revisar)
+    
+    def enviar_acks(self):
+        self.acks_programados = False
+        self.capa.enviar_acks()
+    
+    def revisar(self):
+        """Reenvía lo vencido y vuelve a programarse mientras haya canales."""
+        espera = self.capa.revisar()
+        self.revision = None
+        if espera is not None:
+            self.revision = asyncio.get_running_loop().call_later(espera, self.revisar)
+
+async def servir_asyncio(protocolo):
+    """Crea el servidor asyncio y lo mantiene activo."""
+    loop = asyncio.get_running_loop()
+    reusar_puerto = bus is not None
+    
+    if bus is not None:
+        # Los mensajes del bus se atienden en el hilo del bucle
+        es_tcp = protocolo == "TCP"
+        bus.escuchar(lambda tipo, datos: loop.call_soon_threadsafe(recibir_del_bus, tipo, datos, es_tcp))
+    
+    loop.call_soon(programar_inactivos, protocolo == "TCP")
+    
+    if protocolo == "UDP":
+        transporte, _ = await loop.create_datagram_endpoint(
+            ProtocoloUDPAsyncio, local_addr=(comun.HOST, comun.PORT), reuse_port=reusar_puerto)
+        mostrar_inicio("UDP", "asyncio")
+        try:
+            await asyncio.Future()
+        finally:
+            transporte.close()
+    else:
+        servidor = await asyncio.start_server(
+            manejar_cliente_asyncio, comun.HOST, comun.PORT, backlog=comun.BACKLOG,
+            reuse_port=reusar_puerto)
+        mostrar_inicio("TCP", "asyncio")
+        async with servidor:
+            await servidor.serve_forever()
+
+def iniciar_servidor_asyncio(protocolo):
+    """Inicia el servidor con el motor asyncio."""
+    try:
+        asyncio.run(servir_asyncio(protocolo))
+    except KeyboardInterrupt:
+        log("\n[!] Servidor detenido por el usuario.")
+    except Exception as e:
+        log(f"[ERROR] Error en servidor {protocolo} (asyncio): {e}", bitacora.ERROR)
+
+# --- MOTOR REACTOR ---
+# Un único hilo con un reactor de selectors (ver reactor.py) atiende el
+# socket de escucha, todas las conexiones TCP o el socket UDP, sin asyncio
+# ni un hilo por cliente. Las lecturas son no bloqueantes y se enmarcan
+# con comun.DecodificadorTramas; cada conexión escribe con un
+# difusion.EscritorReactor. El ruteo es el mismo de los otros motores.
+
+class ConexionReactor:
+    """
+    Lado de lectura de una conexión TCP del motor reactor: rearma las
+    tramas de cada recv() y las pasa al registro o al ruteo.
+    """
+    
+    def __init__(self, bucle, conn, addr):
+        self.addr = addr
+        self.conn = conn
+        self.decodificador = comun.DecodificadorTramas()
+        self.usuario = None
+        self.terminada = False
+        self.salida = difusion.EscritorReactor(bucle, conn, self.leer)
+    
+    def leer(self):
+        try:
+            fragmento = self.conn.recv(comun.TAM_LECTURA_TCP)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionResetError:
+            log(f"Conexión TCP cerrada abruptamente: {self.addr}", bitacora.AVISO)
+            fragmento = b""
+        except OSError:
+            fragmento = b""
+        if not fragmento:
+            self.terminar()
+            return
+        
+        try:
+            for datos in self.decodificador.alimentar(fragmento):
+                if self.terminada:
+                    return
+                if self.usuario is not None:
+                    procesar_mensaje_tcp(datos, self.usuario, self.addr, self.salida)
+                    continue
+                # Primer mensaje debe ser REGISTRO
+                usuario, formato, compresion = validar_registro(datos)
+                if not usuario or not manejar_registro(usuario, self.addr, self.salida, True, None,
+                                                       formato, compresion):
+                    self.terminar()
+                    return
+                self.usuario = usuario
+        except Exception as e:
+            log(f"Error con cliente TCP {self.addr}: {e}", bitacora.ERROR)
+            self.terminar()
+    
+    def terminar(self):
+        if self.terminada:
+            return
+        self.terminada = True
+        if self.salida.desbordado:
+            log(f"[-] Cliente lento desconectado (cola de salida llena): {self.usuario or self.addr}",
+                bitacora.AVISO)
+        if self.usuario:
+            manejar_desconexion_tcp(self.usuario, self.salida)
+        # El escritor envía lo pendiente y cierra el socket
+        self.salida.cerrar()
+
+def aceptar_reactor(bucle, servidor):
+    """Acepta todas las conexiones pendientes del socket de escucha."""
+    while True:
+        try:
+            conn, addr = servidor.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # Sin descriptores, por ejemplo: se reintenta en la próxima vuelta
+            log(f"[ERROR] No se pudo aceptar una conexión: {e}", bitacora.ERROR)
+            return
+        log(f"Nueva conexión TCP desde {addr}")
+        ConexionReactor(bucle, conn, addr)
+
+def iniciar_servidor_reactor(protocolo):
+    """
+    Inicia el servidor con el motor reactor.
+    
+    En TCP el socket de escucha y cada conexión se registran en el
+    reactor. En UDP se lee como el motor de hilos (lotes en buffers
+    preasignados, capa confiable, envíos juntos al final de la vuelta),
+    pero desde el reactor. Los mensajes del bus de trabajadores llegan al
+    hilo del reactor con llamar_desde_hilo(), así todo el estado se toca
+    desde un solo hilo.
+    """
+    global capa_udp
+    es_tcp = protocolo == "TCP"
+    bucle = reactor.Reactor(al_fallar=lambda e: log(f"[ERROR] Error en el reactor: {e}", bitacora.ERROR))
+    if es_tcp:
+        servidor = comun.crear_socket_tcp(reusar_puerto=bus is not None)
+    else:
+        servidor = comun.crear_socket_udp(reusar_puerto=bus is not None)
+    
+    try:
+        servidor.bind((comun.HOST, comun.PORT))
+        servidor.setblocking(False)
+        if es_tcp:
+            servidor.listen(comun.BACKLOG)
+            bucle.registrar(servidor, reactor.LEER, lambda eventos: aceptar_reactor(bucle, servidor))
             
-            if not usuario:
-                continue
+            def revisar():
+                return revisar_inactivos(True)
+        else:
+            salida = difusion.SalidaUDPEnLote(servidor)
+            capa_udp = comun.CapaConfiable(salida)
+            tam_buffer = comun.BUFSIZE + comun.CABECERA_DATOS.size
+            buffers = [memoryview(bytearray(tam_buffer)) for _ in range(comun.LOTE_UDP)]
             
-            # REGISTRO
-            if tipo == "REGISTRO":
-                manejar_registro(usuario, addr, None, False, servidor)
+            def leer_udp(eventos):
+                for datos, addr in leer_disponibles_udp(servidor, buffers):
+                    try:
+                        for mensaje in capa_udp.recibir(datos, addr):
+                            procesar_datagrama_udp(mensaje, addr, capa_udp)
+                    except Exception as e:
+                        log(f"Error con datagrama UDP de {addr}: {e}", bitacora.ERROR)
             
-            # MENSAJE PÚBLICO
-            elif tipo == "PUBLICO":
-                with lock:
-                    if usuario in clientes:
-                        # Actualizar dirección (UDP puede cambiar)
-                        clientes[usuario]['addr'] = addr
-                        clientes[usuario]['last_seen'] = time.time()
-                        manejar_mensaje_publico(datos, usuario, False, servidor)
+            def revisar():
+                esperas = [e for e in (capa_udp.revisar(), revisar_inactivos(False)) if e is not None]
+                capa_udp.enviar_acks()
+                # Enviar antes de volver a leer en los buffers
+                salida.vaciar()
+                return min(esperas, default=None)
             
-            # MENSAJE PRIVADO
-            elif tipo == "PRIVADO":
-                with lock:
-                    if usuario in clientes:
-                        clientes[usuario]['addr'] = addr
-                        clientes[usuario]['last_seen'] = time.time()
-                        manejar_mensaje_privado(msg, datos, usuario, False, servidor, addr, None)
+            bucle.registrar(servidor, reactor.LEER, leer_udp)
+        
+        mostrar_inicio(protocolo, "reactor")
+        if bus is not None:
+            bus.escuchar(lambda tipo, datos: bucle.llamar_desde_hilo(recibir_del_bus, tipo, datos, es_tcp))
+        bucle.correr(revisar)
     
     except KeyboardInterrupt:
         log("\n[!] Servidor detenido por el usuario.")
     except Exception as e:
-        log(f"[ERROR] Error en servidor UDP: {e}")
+        log(f"[ERROR] Error en servidor {protocolo} (reactor): {e}", bitacora.ERROR)
     finally:
         servidor.close()
+        bucle.cerrar()
+
+MOTORES = ("hilos", "asyncio", "reactor")
+
+def medir_escritores(clave):
+    return lambda: estadisticas_salida().get(clave, 0)
+
+def medir_capa_udp(clave):
+    return lambda: capa_udp.estadisticas().get(clave, 0) if capa_udp is not None else 0
+
+def medir_rearmado(clave):
+    return lambda: capa_udp.reensamblador.estadisticas()[clave] if capa_udp is not None else 0
+
+def iniciar_metricas():
+    """
+    Registra los medidores calculados y sirve /metrics si hay puerto
+    configurado. En modo --workers cada trabajador usa puerto + su número.
+    """
+    metricas.Medidor("chat_clientes_conectados", "Usuarios registrados en este proceso",
+                     lambda: len(clientes))
+    metricas.Medidor("chat_clientes_comprimidos", "Usuarios que negociaron compresión",
+                     lambda: sum(1 for s in clientes.sesiones() if s.salida.comprimir))
+    metricas.Medidor("chat_limites_ips", "IPs de origen con cubeta de límite de tráfico",
+                     lambda: len(limites_ip) if limites_ip is not None else 0)
+    metricas.Medidor("chat_clientes_remotos", "Usuarios registrados en otros trabajadores",
+                     lambda: len(bus.remotos) if bus is not None else 0)
+    metricas.Medidor("chat_cola_mensajes", "Tramas pendientes en las colas de salida",
+                     medir_escritores("mensajes_encolados"))
+    metricas.Medidor("chat_cola_bytes", "Bytes pendientes en las colas de salida",
+                     medir_escritores("bytes_encolados"))
+    metricas.Medidor("chat_tramas_enviadas_total", "Tramas escritas a los clientes",
+                     medir_escritores("tramas_enviadas"), tipo="counter")
+    metricas.Medidor("chat_escrituras_total", "Escrituras a los sockets (una puede llevar varias tramas)",
+                     medir_escritores("escrituras"), tipo="counter")
+    metricas.Medidor("chat_bytes_enviados_total", "Bytes escritos a los clientes",
+                     medir_escritores("bytes_enviados"), tipo="counter")
+    metricas.Medidor("chat_tramas_descartadas_total", "Tramas descartadas por colas llenas o errores",
+                     medir_escritores("tramas_descartadas"), tipo="counter")
+    metricas.Medidor("chat_udp_confiable_canales", "Clientes UDP que usan la capa confiable",
+                     medir_capa_udp("canales"))
+    metricas.Medidor("chat_udp_confiable_pendientes", "Datagramas sin confirmar de la capa confiable",
+                     medir_capa_udp("pendientes"))
+    metricas.Medidor("chat_udp_confiable_total", "Eventos de la capa confiable UDP",
+                     lambda: {clave: valor for clave, valor in
+                              (capa_udp.estadisticas() if capa_udp is not None else {}).items()
+                              if clave not in ("canales", "pendientes")},
+                     etiqueta="evento", tipo="counter")
+    metricas.Medidor("chat_udp_rearmado_bytes", "Bytes de mensajes UDP fragmentados a medio rearmar",
+                     medir_rearmado("bytes"))
+    metricas.Medidor("chat_udp_fragmentados_total", "Mensajes UDP fragmentados recibidos, por resultado",
+                     lambda: {resultado: medir_rearmado(resultado)()
+                              for resultado in ("rearmados", "vencidos", "descartados")},
+                     etiqueta="resultado", tipo="counter")
+    metricas.Medidor("chat_historial_mensajes_total", "Mensajes guardados en el historial",
+                     lambda: historial.siguiente if historial is not None else 0, tipo="counter")
+    metricas.Medidor("chat_cache_mensajes_total", "Consultas a la caché de mensajes del servidor",
+                     lambda: {"acierto": comun.cache_mensajes.aciertos,
+                              "fallo": comun.cache_mensajes.fallos},
+                     etiqueta="resultado", tipo="counter")
+    metricas.Medidor("chat_log_descartadas_total", "Líneas del log perdidas por buffer lleno",
+                     lambda: bitacora.bitacora.descartadas, tipo="counter")
+    
+    if comun.METRICAS_PUERTO:
+        puerto = comun.METRICAS_PUERTO + (bus.id if bus is not None else 0)
+        try:
+            metricas.iniciar_servidor_http(comun.METRICAS_HOST, puerto)
+            log(f"Métricas en http://{comun.METRICAS_HOST}:{puerto}/metrics")
+        except OSError as e:
+            log(f"[ERROR] No se pudo iniciar el servidor de métricas: {e}", bitacora.ERROR)
+
+def iniciar_historial():
+    """
+    Abre el historial si hay directorio configurado. En modo --workers
+    cada trabajador guarda una copia completa en su propio subdirectorio.
+    """
+    global historial
+    if not comun.HISTORIAL_DIR:
+        return
+    directorio = comun.HISTORIAL_DIR
+    if bus is not None:
+        directorio = os.path.join(directorio, f"trabajador-{bus.id}")
+    try:
+        historial = historial_mensajes.Historial(directorio)
+        log(f"Historial en {directorio} ({historial.siguiente} mensajes guardados)")
+    except OSError as e:
+        log(f"[ERROR] No se pudo abrir el historial: {e}", bitacora.ERROR)
+
+def arrancar_motor(protocolo, motor):
+    """Corre el servidor con el motor elegido hasta que se detenga."""
+    global recientes, inactividad, limite_usuario, limites_ip
+    recientes = difusion.Recientes()
+    if comun.TIEMPO_INACTIVIDAD > 0:
+        inactividad = sesiones.RuedaInactividad(comun.TIEMPO_INACTIVIDAD, comun.RESOLUCION_INACTIVIDAD)
+    limite = limites.Limite(comun.LIMITE_MENSAJES, comun.LIMITE_BYTES, comun.RAFAGA_LIMITE)
+    if limite.activo():
+        limite_usuario = limite
+    limite = limites.Limite(comun.LIMITE_MENSAJES_IP, comun.LIMITE_BYTES_IP, comun.RAFAGA_LIMITE)
+    if limite.activo():
+        limites_ip = limites.LimitadorIP(limite)
+    iniciar_metricas()
+    iniciar_historial()
+    if motor == "asyncio":
+        iniciar_servidor_asyncio(protocolo)
+    elif motor == "reactor":
+        iniciar_servidor_reactor(protocolo)
+    elif protocolo == "UDP":
+        iniciar_servidor_udp()
+    else:
+        iniciar_servidor_tcp()
+
+def arrancar_trabajador(bus_trabajador, protocolo, motor):
+    """Punto de entrada de cada proceso en modo --workers."""
+    global bus
+    bus = bus_trabajador
+    log(f"[trabajador {bus.id}] pid {os.getpid()}")
+    try:
+        arrancar_motor(protocolo, motor)
+    finally:
+        # El hijo termina con os._exit, sin pasar por atexit
+        bitacora.cerrar()
 
 def iniciar_servidor():
     """
     Función principal para iniciar el servidor.
-    Uso: python servidor.py [TCP/UDP]
+    Uso: python servidor.py [TCP/UDP] [--engine=hilos|asyncio|reactor] [--workers=N]
     """
-    protocolo = "TCP"
-    if len(sys.argv) > 1:
-        protocolo = sys.argv[1].upper()
+    parser = argparse.ArgumentParser(description="Servidor de chat TCP/UDP")
+    parser.add_argument("protocolo", nargs="?", default="TCP", type=str.upper,
+                        choices=["TCP", "UDP"], help="Protocolo de transporte")
+    parser.add_argument("--engine", default="hilos", choices=MOTORES,
+                        help="Motor de E/S: un hilo por cliente, bucle asyncio o reactor de selectors")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Procesos que comparten el puerto (SO_REUSEPORT)")
+    parser.add_argument("--metricas-puerto", type=int,
+                        help="Puerto HTTP para /metrics (0 lo desactiva)")
+    parser.add_argument("--log-nivel", choices=list(bitacora.NIVELES),
+                        help="Nivel mínimo de la bitácora")
+    parser.add_argument("--log-formato", choices=[bitacora.FORMATO_TEXTO, bitacora.FORMATO_JSON],
+                        help="Líneas de texto o JSON")
+    parser.add_argument("--log-contenido", action="store_true", default=None,
+                        help="Registrar el texto de los mensajes públicos")
+    parser.add_argument("--recientes", type=int,
+                        help="Mensajes recientes que recibe quien entra a una sala (0 lo desactiva)")
+    parser.add_argument("--historial", dest="historial_dir",
+                        help="Directorio donde guardar el historial de mensajes públicos")
+    parser.add_argument("--sin-compresion", dest="compresion", action="store_false", default=None,
+                        help="No aceptar la compresión que piden los clientes")
+    parser.add_argument("--ventana-escritura", type=float,
+                        help="Segundos que cada escritor TCP espera para juntar tramas en una escritura")
+    parser.add_argument("--limite-mensajes", type=float,
+                        help="Mensajes por segundo de cada usuario (0 = sin límite)")
+    parser.add_argument("--limite-bytes", type=int,
+                        help="Bytes por segundo de cada usuario (0 = sin límite)")
+    parser.add_argument("--limite-mensajes-ip", type=float,
+                        help="Mensajes por segundo de cada IP de origen (0 = sin límite)")
+    parser.add_argument("--limite-bytes-ip", type=int,
+                        help="Bytes por segundo de cada IP de origen (0 = sin límite)")
+    parser.add_argument("--inactividad", type=float,
+                        help="Segundos sin mensajes para dar de baja a un cliente (0 = nunca)")
+    parser.add_argument("--mtu-udp", type=int,
+                        help=f"Tamaño máximo de los datagramas UDP hacia los clientes del proyecto (mínimo {comun.MTU_UDP_MIN})")
+    parser.add_argument("--config", 
+                        help=f"Archivo de configuración INI (por defecto {comun.ARCHIVO_CONFIGURACION})")
+    parser.add_argument("--puerto", type=int, help="Puerto de escucha")
+    parser.add_argument("--max-clientes", type=int, help="Máximo de usuarios conectados")
+    parser.add_argument("--cola-mensajes", type=int,
+                        help="Máximo de tramas pendientes por cliente")
+    parser.add_argument("--cola-bytes", type=int,
+                        help="Máximo de bytes pendientes por cliente")
+    parser.add_argument("--desborde", 
+                        choices=[comun.DESBORDE_DESCARTAR, comun.DESBORDE_DESCONECTAR],
+                        help="Qué hacer cuando un cliente lento llena su cola")
+    args = parser.parse_args()
+    
+    # Prioridad: valores por defecto < archivo < entorno < línea de comandos
+    try:
+        comun.cargar_configuracion(args.config)
+        for opcion in ("puerto", "max_clientes", "cola_mensajes", "cola_bytes", "desborde",
+                       "metricas_puerto", "log_nivel", "log_formato", "log_contenido",
+                       "recientes", "historial_dir", "mtu_udp", "inactividad",
+                       "compresion", "limite_mensajes", "limite_bytes", "limite_mensajes_ip",
+                       "limite_bytes_ip", "ventana_escritura"):
+            valor = getattr(args, opcion)
+            if valor is not None:
+                comun.aplicar_opcion(opcion, valor)
+        bitacora.configurar(comun.LOG_NIVEL, comun.LOG_FORMATO)
+    except ValueError as e:
+        parser.error(f"Configuración inválida: {e}")
     
-    log(f"Iniciando servidor en modo {protocolo}...")
+    if not 1 <= args.workers <= trabajadores.MAX_TRABAJADORES:
+        parser.error(f"--workers debe estar entre 1 y {trabajadores.MAX_TRABAJADORES}")
+    if args.workers > 1 and not trabajadores.disponible():
+        parser.error("--workers necesita fork() y SO_REUSEPORT (Linux/BSD)")
     
-    if protocolo == "UDP":
-        iniciar_servidor_udp()
+    log(f"Iniciando servidor en modo {args.protocolo} (motor {args.engine})...")
+    
+    if args.workers > 1:
+        log(f"Modo multiproceso: {args.workers} trabajadores")
+        trabajadores.iniciar_trabajadores(
+            args.workers, lambda b: arrancar_trabajador(b, args.protocolo, args.engine))
     else:
-        iniciar_servidor_tcp()
+        arrancar_motor(args.protocolo, args.engine)
 
 if __name__ == "__main__":
-    iniciar_servidor()
\ No newline at end of file
+    iniciar_servidor()
@@ -0,0 +1,274 @@
+"""
+Registro de clientes conectados al servidor de chat
+Sesiones con __slots__ e índices por nombre y por dirección, y una rueda
+de temporizadores para dar de baja a los inactivos
+"""
+
+import threading
+import time
+
+MAX_RANURAS = 4096  # Ranuras de la rueda de inactividad, sea cual sea el tiempo
+
+class Sesion:
+    """
+    Datos de un cliente registrado.
+
+    Atributos:
+        nombre: Nombre de usuario
+        addr: Dirección (ip, puerto) del cliente
+        salida: Escritor de la conexión (ver difusion.py)
+        last_seen: Timestamp de la última actividad
+        salas: Nombres de las salas a las que está unido
+        cubeta: limites.Cubeta con su límite de tráfico, o None
+    """
+
+    __slots__ = ("nombre", "addr", "salida", "last_seen", "salas", "cubeta")
+
+    def __init__(self, nombre, addr, salida):
+        self.nombre = nombre
+        self.addr = addr
+        self.salida = salida
+        self.last_seen = time.time()
+        self.salas = set()
+        self.cubeta = None
+
+class Sala:
+    """
+    Miembros de una sala, con su propia instantánea de escritores para
+    que la difusión cueste según el tamaño de la sala y no del servidor.
+    """
+
+    __slots__ = ("nombre", "miembros", "_escritores")
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.miembros = {}  # nombre -> Sesion
+        self._escritores = ()
+
+class RegistroClientes:
+    """
+    Clientes conectados, indexados por nombre y por dirección.
+
+    Buscar a un destinatario privado o identificar al remitente de un
+    datagrama UDP es O(1). Las operaciones compuestas (comprobar y
+    agregar, por ejemplo) se hacen con "with registro.lock".
+
+    Las lecturas no toman el lock: las búsquedas son un dict.get() y la
+    difusión recorre una tupla inmutable de escritores (copia al escribir),
+    así varios remitentes difunden en paralelo y un registro solo espera
+    a otro registro o desconexión, nunca a una difusión.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.por_nombre = {}
+        self.por_addr = {}
+        self._escritores = ()  # Instantánea de escritores para difusión (None = rehacer)
+        self.salas = {}  # nombre -> Sala
+
+    def __len__(self):
+        return len(self.por_nombre)
+
+    def __contains__(self, nombre):
+        return nombre in self.por_nombre
+
+    def obtener(self, nombre):
+        """
+        Returns:
+            Sesion: La sesión del usuario o None
+        """
+        return self.por_nombre.get(nombre)
+
+    def obtener_por_addr(self, addr):
+        """
+        Returns:
+            Sesion: La sesión registrada en esa dirección o None
+        """
+        return self.por_addr.get(addr)
+
+    def agregar(self, sesion):
+        """Agrega una sesión (el nombre debe estar libre)."""
+        with self.lock:
+            self.por_nombre[sesion.nombre] = sesion
+            self.por_addr[sesion.addr] = sesion
+            self._escritores = None
+
+    def quitar(self, nombre, salida=None):
+        """
+        Elimina una sesión de ambos índices.
+
+        Args:
+            salida: Si se indica, solo se quita la sesión si usa este
+                escritor (el nombre pudo volver a registrarse con otro)
+
+        Returns:
+            Sesion: La sesión eliminada o None si no existía
+        """
+        with self.lock:
+            sesion = self.por_nombre.get(nombre)
+            if sesion is None or (salida is not None and sesion.salida is not salida):
+                return None
+            del self.por_nombre[nombre]
+            if self.por_addr.get(sesion.addr) is sesion:
+                del self.por_addr[sesion.addr]
+            for sala in list(sesion.salas):
+                self.dejar(sesion, sala)
+            self._escritores = None
+            return sesion
+
+    def unir(self, sesion, nombre_sala):
+        """
+        Agrega una sesión a una sala (la crea si no existe).
+
+        Returns:
+            bool: False si ya era miembro
+        """
+        with self.lock:
+            sala = self.salas.get(nombre_sala)
+            if sala is None:
+                sala = self.salas[nombre_sala] = Sala(nombre_sala)
+            if sesion.nombre in sala.miembros:
+                return False
+            sala.miembros[sesion.nombre] = sesion
+            sala._escritores = None
+            sesion.salas.add(nombre_sala)
+            return True
+
+    def dejar(self, sesion, nombre_sala):
+        """
+        Quita una sesión de una sala; las salas vacías se eliminan.
+
+        Returns:
+            bool: False si no era miembro
+        """
+        with self.lock:
+            sala = self.salas.get(nombre_sala)
+            if sala is None or sala.miembros.pop(sesion.nombre, None) is None:
+                return False
+            sesion.salas.discard(nombre_sala)
+            if sala.miembros:
+                sala._escritores = None
+            else:
+                del self.salas[nombre_sala]
+            return True
+
+    def escritores_sala(self, nombre_sala):
+        """
+        Escritores de los miembros de una sala, sin lock (como escritores()).
+
+        Returns:
+            tuple: Escritores de salida (vacía si la sala no existe)
+        """
+        sala = self.salas.get(nombre_sala)
+        if sala is None:
+            return ()
+        escritores = sala._escritores
+        if escritores is None:
+            with self.lock:
+                if sala._escritores is None:
+                    sala._escritores = tuple(s.salida for s in sala.miembros.values())
+                escritores = sala._escritores
+        return escritores
+
+    def listar_salas(self):
+        """
+        Returns:
+            list: Tuplas (nombre, cantidad de miembros) ordenadas por nombre
+        """
+        with self.lock:
+            return sorted((nombre, len(sala.miembros)) for nombre, sala in self.salas.items())
+
+    def escritores(self):
+        """
+        Escritores de todos los clientes, para difundir.
+
+        Sin lock en el caso común. La tupla se rehace (con lock) solo la
+        primera vez que se pide después de un cambio en el registro; quien
+        ya tenía la anterior la sigue usando sin problemas.
+
+        Returns:
+            tuple: Escritores de salida
+        """
+        escritores = self._escritores
+        if escritores is None:
+            with self.lock:
+                if self._escritores is None:
+                    self._escritores = tuple(s.salida for s in self.por_nombre.values())
+                escritores = self._escritores
+        return escritores
+
+    def sesiones(self):
+        """
+        Returns:
+            list: Copia de las sesiones registradas
+        """
+        with self.lock:
+            return list(self.por_nombre.values())
+
+class RuedaInactividad:
+    """
+    Rueda de temporizadores que encuentra las sesiones sin actividad en
+    los últimos "tiempo" segundos.
+
+    Cada sesión está en la ranura de su vencimiento (last_seen + tiempo),
+    de "resolucion" segundos de ancho. La actividad solo actualiza
+    last_seen, sin tocar la rueda: al pasar por una ranura, las sesiones
+    que siguen inactivas vencen y las demás se mueven a la ranura de su
+    nuevo vencimiento. Así cada avance cuesta según lo que vence (más lo
+    que se reprograma, a lo sumo una vez por período de cada sesión) y no
+    según el total de sesiones.
+
+    Las sesiones que se quitan del registro no se sacan de la rueda:
+    avanzar() las devuelve cuando les toca y quien llama las ignora.
+
+    La rueda tiene a lo sumo MAX_RANURAS ranuras: si el tiempo abarca
+    varias vueltas, una sesión pasa por su ranura antes de vencer y se
+    vuelve a ubicar (una vez por vuelta), como con un contador de vueltas.
+    """
+
+    def __init__(self, tiempo, resolucion=1.0):
+        self.tiempo = tiempo
+        self.resolucion = resolucion
+        self.ranuras = [[] for _ in range(min(int(tiempo / resolucion) + 2, MAX_RANURAS))]
+        self.actual = int(time.time() / resolucion)  # Primera ranura sin revisar
+        self.lock = threading.Lock()
+
+    def _ubicar(self, sesion, vence):
+        tic = max(int(vence / self.resolucion), self.actual)
+        self.ranuras[tic % len(self.ranuras)].append(sesion)
+
+    def agregar(self, sesion):
+        """Empieza a vigilar una sesión recién registrada."""
+        with self.lock:
+            self._ubicar(sesion, sesion.last_seen + self.tiempo)
+
+    def avanzar(self, ahora):
+        """
+        Revisa las ranuras que ya pasaron.
+
+        Returns:
+            list: Sesiones vencidas (incluye las que ya se quitaron del
+            registro)
+        """
+        vencidas = []
+        with self.lock:
+            fin = int(ahora / self.resolucion)  # La ranura en curso todavía no terminó
+            if fin <= self.actual:
+                return vencidas
+            # Después de una pausa larga alcanza con una vuelta a la rueda
+            tics = range(max(self.actual, fin - len(self.ranuras)), fin)
+            self.actual = fin
+            for tic in tics:
+                i = tic % len(self.ranuras)
+                ranura = self.ranuras[i]
+                self.ranuras[i] = []
+                for sesion in ranura:
+                    vence = sesion.last_seen + self.tiempo
+                    if vence <= ahora:
+                        vencidas.append(sesion)
+                    else:
+                        self._ubicar(sesion, vence)
+        return vencidas
+
+    def __len__(self):
+        return sum(len(ranura) for ranura in self.ranuras)
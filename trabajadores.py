@@ -0,0 +1,171 @@
+"""
+Modo multiproceso del servidor de chat (--workers N)
+Varios procesos comparten el puerto con SO_REUSEPORT y se reenvían los
+mensajes por un bus de sockets Unix que atiende el proceso principal
+"""
+
+import os
+import select
+import signal
+import socket
+import threading
+import comun
+
+# --- MENSAJES DEL BUS ---
+# Cada mensaje del bus es una trama (comun.enmarcar) con el tipo (1 byte),
+# el número del trabajador de origen (1 byte) y los datos.
+BUS_DIFUSION = b"D"  # Mensaje serializado para todos los usuarios
+BUS_PRIVADO = b"P"   # Mensaje serializado para su destino
+BUS_ALTA = b"A"      # Nombre de un usuario registrado en el origen
+BUS_BAJA = b"B"      # Nombre de un usuario que se desconectó del origen
+BUS_CAIDA = b"X"     # El trabajador de origen terminó (lo envía el principal)
+
+MAX_TRABAJADORES = 255  # El origen ocupa un byte
+
+def disponible():
+    """
+    Returns:
+        bool: True si el sistema permite fork() y SO_REUSEPORT
+    """
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+class Bus:
+    """
+    Extremo del bus en un trabajador.
+
+    Mantiene el directorio de los usuarios conectados a otros trabajadores
+    (nombre -> trabajador), con el que el servidor comprueba nombres en uso
+    y capacidad, y decide si un mensaje privado debe reenviarse.
+
+    El directorio se actualiza solo con lo que llega por el bus, así que
+    dos registros simultáneos con el mismo nombre en distintos trabajadores
+    pueden aceptarse ambos.
+    """
+
+    def __init__(self, sock, id_trabajador):
+        self.sock = sock
+        self.id = id_trabajador
+        self.origen = bytes((id_trabajador,))
+        self.remotos = {}
+        self.lock_envio = threading.Lock()
+
+    def publicar(self, tipo, datos):
+        """
+        Envía un mensaje a los demás trabajadores.
+
+        Args:
+            tipo: BUS_DIFUSION, BUS_PRIVADO, BUS_ALTA o BUS_BAJA
+            datos: Mensaje serializado (bytes o memoryview) o nombre (str)
+        """
+        if isinstance(datos, str):
+            datos = datos.encode(comun.CODIFICACION)
+        trama = comun.enmarcar(b"".join((tipo, self.origen, datos)))
+        with self.lock_envio:
+            self.sock.sendall(trama)
+
+    def escuchar(self, manejador):
+        """
+        Lee el bus en un hilo propio.
+
+        Por cada mensaje llama a manejador(tipo, datos), donde datos es el
+        mensaje serializado (BUS_DIFUSION, BUS_PRIVADO), el nombre
+        (BUS_ALTA, BUS_BAJA) o la lista de nombres del trabajador caído
+        (BUS_CAIDA). El directorio ya está actualizado al llamarlo.
+        """
+        hilo = threading.Thread(target=self._leer, args=(manejador,), daemon=True)
+        hilo.start()
+
+    def _leer(self, manejador):
+        try:
+            for mensaje in comun.leer_tramas(self.sock, comun.MAX_TRAMA + 2):
+                tipo, origen, datos = mensaje[:1], mensaje[1], mensaje[2:]
+
+                if tipo == BUS_ALTA:
+                    datos = str(datos, comun.CODIFICACION)
+                    self.remotos[datos] = origen
+                elif tipo == BUS_BAJA:
+                    datos = str(datos, comun.CODIFICACION)
+                    self.remotos.pop(datos, None)
+                elif tipo == BUS_CAIDA:
+                    datos = [n for n, o in list(self.remotos.items()) if o == origen]
+                    for nombre in datos:
+                        del self.remotos[nombre]
+
+                manejador(tipo, datos)
+        except (OSError, ValueError):
+            pass
+        # Sin bus el proceso principal ya terminó: este trabajador también
+        os.kill(os.getpid(), signal.SIGTERM)
+
+def repartir(extremos):
+    """
+    Bucle del proceso principal: reenvía cada mensaje del bus a todos los
+    trabajadores menos al de origen.
+
+    Args:
+        extremos: dict socket -> número de trabajador (se vacía al terminar)
+    """
+    decodificadores = {sock: comun.DecodificadorTramas(comun.MAX_TRAMA + 2) for sock in extremos}
+
+    while extremos:
+        listos, _, _ = select.select(list(extremos), [], [])
+        for sock in listos:
+            try:
+                fragmento = sock.recv(comun.TAM_LECTURA_TCP)
+                mensajes = decodificadores[sock].alimentar(fragmento)
+            except (OSError, ValueError):
+                fragmento = b""
+
+            if not fragmento:
+                origen = extremos.pop(sock)
+                sock.close()
+                mensajes = [BUS_CAIDA + bytes((origen,))]
+
+            for mensaje in mensajes:
+                trama = comun.enmarcar(mensaje)
+                for otro in extremos:
+                    if otro is sock:
+                        continue
+                    try:
+                        otro.sendall(trama)
+                    except OSError:
+                        pass
+
+def iniciar_trabajadores(cantidad, arrancar):
+    """
+    Crea los procesos trabajadores y hace de bus hasta que terminen.
+
+    Args:
+        cantidad: Número de trabajadores (2 a MAX_TRABAJADORES)
+        arrancar: Función que corre en cada hijo y recibe su Bus
+    """
+    extremos = {}
+    pids = []
+
+    for numero in range(cantidad):
+        principal, hijo = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            principal.close()
+            for otro in extremos:
+                otro.close()
+            try:
+                arrancar(Bus(hijo, numero))
+            finally:
+                os._exit(0)
+        hijo.close()
+        extremos[principal] = numero
+        pids.append(pid)
+
+    try:
+        repartir(extremos)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)